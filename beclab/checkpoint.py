@@ -0,0 +1,136 @@
+"""
+Saving and restoring the state of long evolutions.
+"""
+
+import os
+import time
+import threading
+import cPickle as pickle
+import numpy
+
+
+def getCallbackState(callback):
+	"""
+	Returns the data of the callback which has to be saved.
+	Callbacks can define getCheckpointState()/setCheckpointState();
+	otherwise all picklable attributes are saved (collected data, counters and so on;
+	meters and other helpers are created anew by the resumed script).
+	"""
+	if hasattr(callback, 'getCheckpointState'):
+		return callback.getCheckpointState()
+
+	state = {}
+	for name, value in getattr(callback, '__dict__', {}).items():
+		try:
+			pickle.dumps(value, protocol=2)
+		except Exception:
+			continue
+		state[name] = value
+
+	return state
+
+def _setCallbackState(callback, state):
+	if hasattr(callback, 'setCheckpointState'):
+		callback.setCheckpointState(state)
+	else:
+		callback.__dict__.update(state)
+
+def restoreCallbacks(callbacks, states):
+	callbacks = [] if callbacks is None else callbacks
+	if len(callbacks) != len(states):
+		raise ValueError("Number of callbacks differs from the one in the checkpoint")
+
+	for callback, state in zip(callbacks, states):
+		_setCallbackState(callback, state)
+
+def loadCheckpoint(path):
+	with open(path, 'rb') as f:
+		return pickle.load(f)
+
+
+class Checkpoint:
+	"""
+	Policy for periodic saving of the evolution state (passed to Evolution.run()).
+	The state is saved every given number of steps and/or seconds of wall time;
+	the evolution can be continued from the saved file with Evolution.resume().
+	The data is serialized in the calling thread, because the evolution changes it
+	after the call, and written to disk in the background.
+	The file is replaced atomically, so it is never left half-written.
+	"""
+
+	def __init__(self, path, steps=None, seconds=None):
+		self._path = path
+		self._steps = steps
+		self._seconds = seconds
+
+		self._step = 0
+		self._last_save = time.time()
+
+		self._thread = None
+		self._error = None
+
+	def update(self, evolution, cloud, callbacks, loop):
+		"""Called by the evolution after every step; saves the state if it is time to"""
+		self._step += 1
+
+		due = (self._steps is not None and self._step % self._steps == 0) or \
+			(self._seconds is not None and time.time() - self._last_save >= self._seconds)
+
+		if due:
+			self.save(evolution, cloud, callbacks, loop)
+
+	def save(self, evolution, cloud, callbacks, loop):
+		"""
+		Saves the state of the evolution.
+		loop: dictionary with the variables of the evolution loop, necessary to continue it.
+		"""
+		# only one write can be in progress, so that memory usage is bounded
+		self._wait()
+
+		callbacks = [] if callbacks is None else callbacks
+
+		# callbacks processing the data in background must have all of it
+		for callback in callbacks:
+			if hasattr(callback, 'finish'):
+				callback.finish()
+
+		env = evolution._env
+		data = dict(
+			a=env.fromDevice(cloud.a.data),
+			b=env.fromDevice(cloud.b.data),
+			time=cloud.time,
+			loop=loop,
+			evolution=evolution._getCheckpointState(),
+			random=numpy.random.get_state(),
+			callbacks=[getCallbackState(callback) for callback in callbacks])
+
+		payload = pickle.dumps(data, protocol=2)
+		self._last_save = time.time()
+
+		self._thread = threading.Thread(target=self._write, args=(payload,))
+		self._thread.start()
+
+	def _write(self, payload):
+		temp_path = self._path + '.tmp'
+		try:
+			with open(temp_path, 'wb') as f:
+				f.write(payload)
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(temp_path, self._path)
+		except Exception as e:
+			self._error = e
+
+	def _wait(self):
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+		if self._error is not None:
+			error = self._error
+			self._error = None
+			raise error
+
+	def finish(self):
+		"""Waits until the last checkpoint is written"""
+		self._wait()
@@ -1,13 +1,159 @@
 import numpy
 import math
+import threading
+import Queue
 
 from helpers import *
 from .state import ParticleStatistics, Projection, Slice, Uncertainty
-from .evolution import TerminateEvolution
+from .meters import getPhaseNoise, getPzNoise, getSpins, getXiSquared
+from .evolution import TerminateEvolution, X_SPACE, K_SPACE
+from .checkpoint import getCallbackState, restoreCallbacks
 from .pulse import Pulse
 
 
-class ParticleNumberCollector:
+class AsyncCollectors:
+	"""
+	Runs collectors in a background thread, so that the evolution does not wait for them.
+	On every call the state is copied to a snapshot from a pool, and the snapshot
+	is queued for the worker thread; collectors are called in time order.
+	At most max_snapshots snapshots exist at the same time; if all of them are busy,
+	the evolution waits for the worker.
+	Collectors raising TerminateEvolution (like ParticleNumberCondition) should
+	not be wrapped, since the exception could only be passed on with a delay.
+	Evolution.run() calls finish() at the end, after which collectors contain all the data.
+	GPU contexts are bound to the thread which created them, so for GPU environments
+	collectors are called synchronously.
+	"""
+
+	def __init__(self, env, collectors, max_snapshots=4):
+		self._env = env
+		self._collectors = collectors
+		self._max_snapshots = max_snapshots
+
+		# snapshot is taken in the representation all collectors can work with
+		representations = set(getattr(c, 'representation', X_SPACE) for c in collectors)
+		self.representation = representations.pop() if len(representations) == 1 else X_SPACE
+
+		self._snapshots = 0
+		self._free = Queue.Queue()
+		self._tasks = Queue.Queue()
+		self._thread = None
+		self._error = None
+
+	def _worker(self):
+		while True:
+			task = self._tasks.get()
+			if task is None:
+				break
+
+			t, snapshot = task
+			if self._error is None:
+				try:
+					for collector in self._collectors:
+						collector(t, snapshot)
+				except Exception as e:
+					self._error = e
+
+			self._free.put(snapshot)
+
+	def _raiseError(self):
+		if self._error is not None:
+			error = self._error
+			self._error = None
+			raise error
+
+	def _getSnapshot(self, cloud):
+		if self._free.empty() and self._snapshots < self._max_snapshots:
+			self._snapshots += 1
+			return cloud.copy(prepare=False)
+
+		snapshot = self._free.get()
+		self._env.copyBuffer(cloud.a.data, dest=snapshot.a.data)
+		self._env.copyBuffer(cloud.b.data, dest=snapshot.b.data)
+		return snapshot
+
+	def __call__(self, t, cloud):
+		if self._env.gpu:
+			for collector in self._collectors:
+				collector(t, cloud)
+			return
+
+		self._raiseError()
+
+		if self._thread is None:
+			self._thread = threading.Thread(target=self._worker)
+			self._thread.daemon = True
+			self._thread.start()
+
+		snapshot = self._getSnapshot(cloud)
+		snapshot.time = t
+		for psi, snapshot_psi in ((cloud.a, snapshot.a), (cloud.b, snapshot.b)):
+			snapshot_psi.in_mspace = getattr(psi, 'in_mspace', False)
+
+		self._tasks.put((t, snapshot))
+
+	def finish(self):
+		"""Waits until all queued snapshots are processed"""
+		if self._thread is not None:
+			self._tasks.put(None)
+			self._thread.join()
+			self._thread = None
+
+		self._raiseError()
+
+	def getCheckpointState(self):
+		self.finish()
+		return [getCallbackState(collector) for collector in self._collectors]
+
+	def setCheckpointState(self, state):
+		restoreCallbacks(self._collectors, state)
+
+
+class MergeableCollector:
+	"""
+	Base class for collectors, whose results can be combined with the results
+	of the same collectors from independent runs over other parts of the ensemble
+	(see parallel.runSharded()).
+	Collected data is stored either as sums over trajectories (attributes listed
+	in _summed) or as values for every trajectory (attributes listed in _concatenated),
+	one element per collection time; final values are calculated in getData().
+	"""
+
+	# collected quantities are integrals, which are the same in mode space,
+	# so the evolution does not have to transform the state to x-space
+	representation = K_SPACE
+
+	_summed = ()
+	_concatenated = ()
+
+	# attributes which are only necessary during collection
+	# (and usually cannot be pickled)
+	_helpers = ()
+
+	def __getstate__(self):
+		d = dict(self.__dict__)
+		for attr in self._helpers:
+			d.pop(attr, None)
+		return d
+
+	def merge(self, other):
+		"""Adds data collected by other collector of the same type"""
+		if len(self.times) != len(other.times):
+			raise ValueError("Collectors were called at different times")
+
+		for attr in self._summed:
+			setattr(self, attr, [x + y for x, y in
+				zip(getattr(self, attr), getattr(other, attr))])
+
+		for attr in self._concatenated:
+			setattr(self, attr, [numpy.concatenate([x, y]) for x, y in
+				zip(getattr(self, attr), getattr(other, attr))])
+
+
+class ParticleNumberCollector(MergeableCollector):
+
+	_summed = ('_Na', '_Nb', '_ensembles')
+	_helpers = ('stats', '_pulse')
 
 	def __init__(self, env, constants, verbose=False, pulse=None, matrix_pulse=True):
 		self.stats = ParticleStatistics(env, constants)
@@ -15,9 +161,13 @@ class ParticleNumberCollector:
 		self._pulse = pulse
 		self._matrix_pulse = matrix_pulse
 
+		# pulse is applied in x-space
+		self.representation = K_SPACE if pulse is None else X_SPACE
+
 		self.times = []
-		self.Na = []
-		self.Nb = []
+		self._Na = []
+		self._Nb = []
+		self._ensembles = []
 
 	def __call__(self, t, cloud):
 		cloud = cloud.copy(prepare=False)
@@ -25,18 +175,22 @@ class ParticleNumberCollector:
 		if self._pulse is not None:
 			self._pulse.apply(cloud, theta=0.5 * math.pi, matrix=self._matrix_pulse)
 
-		Na = self.stats.countParticles(cloud.a)
-		Nb = self.stats.countParticles(cloud.b)
+		Na = self.stats.getPopulations(cloud.a)
+		Nb = self.stats.getPopulations(cloud.b)
 		if self.verbose:
-			print "Particle counter: " + str((t, int(Na), int(Nb), int(Na + Nb)))
+			Na_mean = Na.mean()
+			Nb_mean = Nb.mean()
+			print "Particle counter: " + str((t, int(Na_mean), int(Nb_mean), int(Na_mean + Nb_mean)))
 
 		self.times.append(t)
-		self.Na.append(Na)
-		self.Nb.append(Nb)
+		self._Na.append(Na.sum())
+		self._Nb.append(Nb.sum())
+		self._ensembles.append(Na.size)
 
 	def getData(self):
-		Na = numpy.array(self.Na)
-		Nb = numpy.array(self.Nb)
+		ensembles = numpy.array(self._ensembles, dtype=numpy.float64)
+		Na = numpy.array(self._Na) / ensembles
+		Nb = numpy.array(self._Nb) / ensembles
 		return numpy.array(self.times), Na, Nb, Na + Nb
 
 
@@ -52,7 +206,7 @@ class ParticleNumberCondition:
 		self._previous_Na = None
 		self._previous_ratio = None
 
-	def __call__(self, t, cloud):
+	def _getRatio(self, t, cloud):
 		cloud = cloud.copy(prepare=False)
 
 		if self._pulse is not None:
@@ -66,6 +220,11 @@ class ParticleNumberCondition:
 		if self._verbose:
 			print "Particle ratio: " + str((t, Na, Nb, ratio))
 
+		return ratio
+
+	def __call__(self, t, cloud):
+		ratio = self._getRatio(t, cloud)
+
 		if self._previous_ratio is None:
 			self._previous_ratio = ratio
 
@@ -73,71 +232,101 @@ class ParticleNumberCondition:
 				(ratio < self._ratio and self._previous_ratio > self._ratio):
 			raise TerminateEvolution()
 
+		self._previous_ratio = ratio
 
-class PhaseNoiseCollector:
+	def event(self, t, cloud):
+		"""
+		Event function for evolutions with dense output (see AdaptiveRKEvolution.run()):
+		changes sign when the population ratio crosses the target value.
+		"""
+		return self._getRatio(t, cloud) - self._ratio
+
+
+class PhaseNoiseCollector(MergeableCollector):
+
+	_concatenated = ('_interactions',)
+	_helpers = ('_stats', '_constants')
 
 	def __init__(self, env, constants, verbose=False):
 		self._stats = ParticleStatistics(env, constants)
 		self._constants = constants
-		self._times = []
-		self._var = []
+		self.times = []
+		self._interactions = []
 		self._verbose = verbose
 
 	def __call__(self, t, cloud):
-		noise = self._stats.getPhaseNoise(cloud.a, cloud.b)
+		i = self._stats.getInteractions(cloud.a, cloud.b)
 
 		if self._verbose:
-			print "Phase noise: " + repr((t, noise))
+			print "Phase noise: " + repr((t, getPhaseNoise(i)))
 
-		self._times.append(t)
-		self._var.append(noise)
+		self.times.append(t)
+		self._interactions.append(i)
 
 	def getData(self):
-		return numpy.array(self._times), numpy.array(self._var)
+		return numpy.array(self.times), numpy.array([getPhaseNoise(i) for i in self._interactions])
+
 
+class PzNoiseCollector(MergeableCollector):
 
-class PzNoiseCollector:
+	_concatenated = ('_Na', '_Nb')
+	_helpers = ('_stats', '_constants')
 
 	def __init__(self, env, constants, verbose=False):
 		self._stats = ParticleStatistics(env, constants)
 		self._constants = constants
-		self._times = []
-		self._var = []
+		self.times = []
+		self._Na = []
+		self._Nb = []
 		self._verbose = verbose
 
 	def __call__(self, t, cloud):
-		noise = self._stats.getPzNoise(cloud.a, cloud.b)
+		Na = self._stats.getPopulations(cloud.a)
+		Nb = self._stats.getPopulations(cloud.b)
 
 		if self._verbose:
-			print "Pz noise: " + repr((t, noise))
+			print "Pz noise: " + repr((t, getPzNoise(Na, Nb)))
 
-		self._times.append(t)
-		self._var.append(noise)
+		self.times.append(t)
+		self._Na.append(Na)
+		self._Nb.append(Nb)
 
 	def getData(self):
-		return numpy.array(self._times), numpy.array(self._var)
+		return numpy.array(self.times), \
+			numpy.array([getPzNoise(Na, Nb) for Na, Nb in zip(self._Na, self._Nb)])
+
 
+class VisibilityCollector(MergeableCollector):
 
-class VisibilityCollector:
+	_summed = ('_interaction', '_Na', '_Nb')
+	_helpers = ('stats',)
 
 	def __init__(self, env, constants, verbose=False):
 		self.stats = ParticleStatistics(env, constants)
 		self.verbose = verbose
 
 		self.times = []
-		self.visibility = []
+		self._interaction = []
+		self._Na = []
+		self._Nb = []
 
 	def __call__(self, t, cloud):
-		v = self.stats.getVisibility(cloud.a, cloud.b)
+		interaction = self.stats.getInteractions(cloud.a, cloud.b).sum()
+		Na = self.stats.getPopulations(cloud.a).sum()
+		Nb = self.stats.getPopulations(cloud.b).sum()
 
 		if self.verbose:
-			print "Visibility: " + str((t, v))
+			print "Visibility: " + str((t, 2.0 * numpy.abs(interaction) / (Na + Nb)))
 
 		self.times.append(t)
-		self.visibility.append(v)
+		self._interaction.append(interaction)
+		self._Na.append(Na)
+		self._Nb.append(Nb)
 
 	def getData(self):
-		return numpy.array(self.times), numpy.array(self.visibility)
+		visibility = 2.0 * numpy.abs(numpy.array(self._interaction)) / \
+			(numpy.array(self._Na) + numpy.array(self._Nb))
+		return numpy.array(self.times), visibility
 
 
 class SurfaceProjectionCollector:
@@ -241,27 +430,37 @@ class AxialProjectionCollector:
 		return numpy.array(self.times), numpy.concatenate(self.snapshots).reshape(len(self.times), self.snapshots[0].size).transpose()
 
 
-class UncertaintyCollector:
+class UncertaintyCollector(MergeableCollector):
+
+	_concatenated = ('_i', '_Na', '_Nb')
+	_helpers = ('_unc',)
 
 	def __init__(self, env, constants):
 		self._unc = Uncertainty(env, constants)
 		self.times = []
-		self.Na_stddev = []
-		self.Nb_stddev = []
-		self.XiSquared = []
+		self._i = []
+		self._Na = []
+		self._Nb = []
 
 	def __call__(self, t, cloud):
+		i, Na, Nb = self._unc.getSpinComponents(cloud.a, cloud.b)
 		self.times.append(t)
-		self.Na_stddev.append(self._unc.getNstddev(cloud.a))
-		self.Nb_stddev.append(self._unc.getNstddev(cloud.b))
-		self.XiSquared.append(self._unc.getXiSquared(cloud.a, cloud.b))
+		self._i.append(i)
+		self._Na.append(Na)
+		self._Nb.append(Nb)
 
 	def getData(self):
+		Na_stddev = [Na.std() for Na in self._Na]
+		Nb_stddev = [Nb.std() for Nb in self._Nb]
+		xi_squared = [getXiSquared(i, Na, Nb) for i, Na, Nb in zip(self._i, self._Na, self._Nb)]
 		return [numpy.array(x) for x in
-			(self.times, self.Na_stddev, self.Nb_stddev, self.XiSquared)]
+			(self.times, Na_stddev, Nb_stddev, xi_squared)]
+
 
+class SpinCloudCollector(MergeableCollector):
 
-class SpinCloudCollector:
+	_concatenated = ('phi', 'yps')
+	_helpers = ('_unc',)
 
 	def __init__(self, env, constants):
 		self._unc = Uncertainty(env, constants)
@@ -271,7 +470,7 @@ class SpinCloudCollector:
 
 	def __call__(self, t, cloud):
 		self.times.append(t)
-		phi, yps = self._unc.getSpins(cloud.a, cloud.b)
+		phi, yps = getSpins(*self._unc.getSpinComponents(cloud.a, cloud.b))
 		self.phi.append(phi)
 		self.yps.append(yps)
 
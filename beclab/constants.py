@@ -3,6 +3,8 @@ Module, containing class with calculation constants
 """
 
 import copy
+import weakref
+import functools
 import numpy
 
 from .helpers import *
@@ -38,15 +40,77 @@ _DEFAULTS = {
 	'itmax': 3,
 }
 
+# Immutable snapshots of constants and grids, see _Immutable.copy()
+_snapshots = weakref.WeakValueDictionary()
+
+def _shared(func):
+	"""Makes function of (env, constants, grid) return data shared with other callers"""
+	@functools.wraps(func)
+	def wrapper(env, constants, grid):
+		key = (func.__name__, constants._getFingerprint(), grid._getFingerprint())
+		return getShared(env, key, lambda: func(env, constants, grid))
+	return wrapper
+
+
+class _Immutable:
+	"""
+	Base class for constants and grids.
+	copy() returns an immutable snapshot, which is the same object for all equal sources,
+	so calculations can keep their own references without duplicating the data.
+	Equality and hash are defined by the values of attributes.
+	"""
+
+	def _getFingerprint(self):
+		fingerprint = self.__dict__.get('_fingerprint')
+		if fingerprint is not None:
+			return fingerprint
+
+		nested = dict((name, value._getFingerprint())
+			for name, value in self.__dict__.items() if isinstance(value, _Immutable))
+		return getFingerprint(self.__class__.__name__, getPlainAttributes(self), nested)
+
+	def __setattr__(self, name, value):
+		if '_fingerprint' in self.__dict__:
+			raise AttributeError(self.__class__.__name__ + " snapshot is immutable")
+		self.__dict__[name] = value
+
+	def __eq__(self, other):
+		return isinstance(other, _Immutable) and \
+			self._getFingerprint() == other._getFingerprint()
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self._getFingerprint())
+
+	def copy(self):
+		fingerprint = self._getFingerprint()
+		snapshot = _snapshots.get(fingerprint)
+
+		if snapshot is None:
+			snapshot = copy.deepcopy(self)
+			for name, value in snapshot.__dict__.items():
+				if isinstance(value, _Immutable):
+					snapshot.__dict__[name] = value.copy()
+				else:
+					makeReadOnly(value)
+			snapshot.__dict__['_fingerprint'] = fingerprint
+			_snapshots[fingerprint] = snapshot
+
+		return snapshot
+
+
+@_shared
 def getPotentials(env, constants, grid):
 	"""Returns array with values of external potential energy (in hbar units)."""
 
 	if grid.dim == 1:
-		z = grid.z_full
+		z = grid.z_broadcast
 
 		potentials = constants.m * ((constants.wz * z) ** 2) / (2.0 * constants.hbar)
 	else:
-		x, y, z = grid.x_full, grid.y_full, grid.z_full
+		x, y, z = grid.x_broadcast, grid.y_broadcast, grid.z_broadcast
 
 		potentials = constants.m * (
 			(constants.wx * x) ** 2 +
@@ -60,6 +124,7 @@ def getPotentials(env, constants, grid):
 	else:
 		return potentials
 
+@_shared
 def getPlaneWaveEnergy(env, constants, grid):
 	"""
 	Returns array with values of k-space energy
@@ -68,10 +133,10 @@ def getPlaneWaveEnergy(env, constants, grid):
 	assert isinstance(grid, UniformGrid)
 
 	if grid.dim == 1:
-		E = constants.hbar * grid.kz_full ** 2 / (2.0 * constants.m)
+		E = constants.hbar * grid.kz_broadcast ** 2 / (2.0 * constants.m)
 	else:
-		E = constants.hbar * \
-			(grid.kx_full ** 2 + grid.ky_full ** 2 + grid.kz_full ** 2) / (2.0 * constants.m)
+		E = constants.hbar * (grid.kx_broadcast ** 2 + grid.ky_broadcast ** 2 +
+			grid.kz_broadcast ** 2) / (2.0 * constants.m)
 
 	E = E.astype(constants.scalar.dtype)
 
@@ -80,6 +145,7 @@ def getPlaneWaveEnergy(env, constants, grid):
 	else:
 		return E
 
+@_shared
 def getHarmonicEnergy(env, constants, grid):
 	"""
 	Returns array with energy values in harmonic mode space in hbar units
@@ -88,11 +154,11 @@ def getHarmonicEnergy(env, constants, grid):
 	assert isinstance(grid, HarmonicGrid)
 
 	if grid.dim == 3:
-		mx, my, mz = grid.mx_full, grid.my_full, grid.mz_full
+		mx, my, mz = grid.mx_broadcast, grid.my_broadcast, grid.mz_broadcast
 		wx, wy, wz = constants.wx, constants.wy, constants.wz
 		E = (wx * (mx + 0.5) + wy * (my + 0.5) + wz * (mz + 0.5))
 	else:
-		E = (constants.wz * (grid.mz_full + 0.5))
+		E = (constants.wz * (grid.mz_broadcast + 0.5))
 
 	E = E.astype(constants.scalar.dtype)
 
@@ -101,20 +167,41 @@ def getHarmonicEnergy(env, constants, grid):
 	else:
 		return env.toDevice(E)
 
-def getProjectorMask(env, constants, grid):
+def _getProjectedModes(constants, grid):
+	"""Returns boolean array marking modes with energy below the cutoff"""
 	if isinstance(grid, UniformGrid):
 		E = getPlaneWaveEnergy(None, constants, grid)
 	else:
 		E = getHarmonicEnergy(None, constants, grid)
 
-	mask_func = lambda x: 0.0 if x > constants.e_cut else 1.0
-	mask_map = numpy.vectorize(mask_func)
-
-	mask = mask_map(E * constants.hbar).astype(constants.scalar.dtype)
-	modes = numpy.sum(mask)
+	return E * constants.hbar <= constants.e_cut
 
+@_shared
+def getProjectorMask(env, constants, grid):
+	mask = _getProjectedModes(constants, grid).astype(constants.scalar.dtype)
 	return env.toDevice(mask)
 
+@_shared
+def getProjectorModes(env, constants, grid):
+	"""
+	Returns flat indices of modes kept by the projector
+	(compact representation of the projected subspace).
+	"""
+	modes = numpy.flatnonzero(_getProjectedModes(constants, grid)).astype(numpy.int32)
+
+	if env is not None:
+		return env.toDevice(modes)
+	else:
+		return modes
+
+def getPlan(env, constants, grid):
+	"""Returns (shared) plan of transformation between x-space and mode space"""
+	key = ('plan', constants._getFingerprint(), grid._getFingerprint())
+	if isinstance(grid, UniformGrid):
+		return getShared(env, key, lambda: createFFTPlan(env, constants, grid))
+	else:
+		return getShared(env, key, lambda: createFHTPlan(env, constants, grid, 1))
+
 def getIntegrationCoefficients(pts):
 	"""
 	Returns integration coefficients for simple trapezoidal rule.
@@ -127,7 +214,7 @@ def getIntegrationCoefficients(pts):
 
 	#return numpy.array([0.5] + [1.0] * (N - 2) + [0.5])
 
-class UniformGrid:
+class UniformGrid(_Immutable):
 
 	def __init__(self, env, constants, shape, box_size):
 
@@ -145,6 +232,7 @@ class UniformGrid:
 		self.dim = len(shape)
 		self.shape = shape
 		self.mshape = shape
+		self.box_size = tuple(box_size)
 
 		# spatial step and grid for every component of shape
 		d_space = [box_size[i] / (shape[i] - 1) for i in xrange(self.dim)]
@@ -172,29 +260,31 @@ class UniformGrid:
 			self.y = grid_space[1]
 			self.z = grid_space[0]
 
-			# tiled grid arrays to use in elementwise numpy operations
-			self.x_full, self.y_full, self.z_full = tile3D(self.x, self.y, self.z)
+			# views to use in elementwise numpy operations
+			self.x_broadcast, self.y_broadcast, self.z_broadcast = \
+				broadcast3D(self.x, self.y, self.z)
 
 			self.kx = kvalues(d_space[2], self.shape[2])
 			self.ky = kvalues(d_space[1], self.shape[1])
 			self.kz = kvalues(d_space[0], self.shape[0])
 
-			self.kx_full, self.ky_full, self.kz_full = tile3D(self.kx, self.ky, self.kz)
+			self.kx_broadcast, self.ky_broadcast, self.kz_broadcast = \
+				broadcast3D(self.kx, self.ky, self.kz)
 
 			# coefficients for integration
 			self.dx = getIntegrationCoefficients(self.x)
 			self.dy = getIntegrationCoefficients(self.y)
 			self.dz = getIntegrationCoefficients(self.z)
-			dx, dy, dz = tile3D(self.dx, self.dy, self.dz)
+			dx, dy, dz = broadcast3D(self.dx, self.dy, self.dz)
 			self.dV = dx * dy * dz
 
 		else:
 			# using 'z' axis for 1D, because it seems more natural
 			self.z = grid_space[0]
-			self.z_full = self.z
+			self.z_broadcast = self.z
 
 			self.kz = kvalues(d_space[0], self.shape[0])
-			self.kz_full = self.kz
+			self.kz_broadcast = self.kz
 
 			self.dz = getIntegrationCoefficients(self.z)
 			self.dV = self.dz
@@ -216,17 +306,40 @@ class UniformGrid:
 
 		return cls(env, constants, shape, box_size)
 
-	def copy(self):
-		return copy.deepcopy(self)
+	def __getattr__(self, name):
+		# full arrays (x_full, kx_full and so on) are created only on request,
+		# as read-only views of 1D arrays
+		broadcast = self.__dict__.get(name[:-len('_full')] + '_broadcast')
+		if not name.endswith('_full') or broadcast is None:
+			raise AttributeError(name)
+
+		return numpy.broadcast_to(broadcast, self.shape)
 
 	def get_dV(self, env):
-		return env.toDevice(self.dV.astype(self._constants.scalar.dtype))
+		return getShared(env, ('dV', self._getFingerprint()),
+			lambda: env.toDevice(self.dV.astype(self._constants.scalar.dtype)))
 
-	def __eq__(self, other):
-		return self.shape == other.shape and self.size == other.size
 
+class _PerOrder:
+	"""
+	Dictionary-like container of grid data for different transformation orders.
+	Values are calculated by grid._getOrderData() on the first request and are read-only.
+	"""
+
+	def __init__(self, grid, name):
+		self._grid = grid
+		self._name = name
+		self._values = {}
 
-class HarmonicGrid:
+	def __getitem__(self, order):
+		if order not in self._values:
+			value = self._grid._getOrderData(self._name, order)
+			makeReadOnly(value)
+			self._values[order] = value
+		return self._values[order]
+
+
+class HarmonicGrid(_Immutable):
 
 	def __init__(self, env, constants, mshape):
 
@@ -244,9 +357,9 @@ class HarmonicGrid:
 			mx = numpy.arange(mshape[2])
 			my = numpy.arange(mshape[1])
 			mz = numpy.arange(mshape[0])
-			self.mx_full, self.my_full, self.mz_full = tile3D(mx, my, mz)
+			self.mx_broadcast, self.my_broadcast, self.mz_broadcast = broadcast3D(mx, my, mz)
 		else:
-			self.mz_full = numpy.arange(mshape[0])
+			self.mz_broadcast = numpy.arange(mshape[0])
 
 		self.msize = 1
 		for i in xrange(self.dim):
@@ -265,95 +378,86 @@ class HarmonicGrid:
 
 		# Spatial grids for collectors which work in x-space
 		# and for nonlinear terms in GPEs
-		# We have to create a set of grid for every transformation order used
-		self.shapes = {}
-		self.dVs = {}
+		# We need a set of grids for every transformation order used;
+		# they are calculated when requested for the first time.
+		names = ['shapes', 'dVs', 'zs', 'zs_broadcast', 'dzs']
+		if self.dim == 3:
+			names += ['xs', 'ys', 'xs_broadcast', 'ys_broadcast', 'dxs', 'dys']
+		for name in names:
+			setattr(self, name, _PerOrder(self, name))
+
+		# Create aliases for 1st order arrays,
+		# making it look like UniformGrid
+		# (high orders are used only inside evolution classes anyway)
+		self.shape = self.shapes[1]
+		self.dV = self.dVs[1]
+
+		self.size = 1
+		for i in xrange(self.dim):
+			self.size *= self.shape[i]
 
 		if self.dim == 3:
-			self.xs = {}
-			self.ys = {}
-			self.zs = {}
-			self.xs_full = {}
-			self.ys_full = {}
-			self.zs_full = {}
-			self.dxs = {}
-			self.dys = {}
-			self.dzs = {}
+			self.x = self.xs[1]
+			self.y = self.ys[1]
+			self.x_broadcast = self.xs_broadcast[1]
+			self.y_broadcast = self.ys_broadcast[1]
+			self.dx = self.dxs[1]
+			self.dy = self.dys[1]
+
+		self.z = self.zs[1]
+		self.z_broadcast = self.zs_broadcast[1]
+		self.dz = self.dzs[1]
+
+	def _getOrderData(self, name, l):
+		"""Calculates the value of per-order attribute for the transformation order l"""
+		axes = ['z', 'y', 'x'] if self.dim == 3 else ['z']
+
+		if name in ('xs', 'ys', 'zs'):
+			# non-uniform grid used in Gauss-Hermite quadrature
+			axis = axes.index(name[0])
+			points, _ = getHarmonicGrid(self.mshape[axis], l)
+			return points * getattr(self, 'l' + name[0])
+		elif name in ('dxs', 'dys', 'dzs'):
+			# coefficients for integration
+			return getIntegrationCoefficients(getattr(self, name[1:])[l])
+		elif name == 'shapes':
+			return tuple(len(getattr(self, axis + 's')[l]) for axis in axes)
+		elif name.endswith('_broadcast'):
+			# views to use in elementwise numpy operations
+			if self.dim == 1:
+				return self.zs[l]
+			views = broadcast3D(self.xs[l], self.ys[l], self.zs[l])
+			return views[['x', 'y', 'z'].index(name[0])]
+		elif name == 'dVs':
+			if self.dim == 1:
+				return self.dzs[l]
+			dx, dy, dz = broadcast3D(self.dxs[l], self.dys[l], self.dzs[l])
+			return dx * dy * dz
+		elif name.endswith('_full'):
+			return numpy.broadcast_to(getattr(self, name[:-len('_full')] + '_broadcast')[l],
+				self.shapes[l])
+
+	def __getattr__(self, name):
+		# full arrays (x_full, xs_full, mx_full and so on) are created only on request,
+		# as read-only views of 1D arrays
+		if name in ('xs_full', 'ys_full', 'zs_full'):
+			return _PerOrder(self, name)
+
+		broadcast = self.__dict__.get(name[:-len('_full')] + '_broadcast')
+		if not name.endswith('_full') or broadcast is None:
+			raise AttributeError(name)
+
+		if name.startswith('m'):
+			return numpy.broadcast_to(broadcast, self.mshape)
 		else:
-			self.zs = {}
-			self.zs_full = {}
-			self.dzs = {}
-
-		for l in (1, 2, 3, 4):
-			if self.dim == 3:
-				# non-uniform grid used in Gauss-Hermite quadrature
-				self.xs[l], _ = getHarmonicGrid(mshape[2], l)
-				self.ys[l], _ = getHarmonicGrid(mshape[1], l)
-				self.zs[l], _ = getHarmonicGrid(mshape[0], l)
-
-				self.shapes[l] = (len(self.zs[l]), len(self.ys[l]), len(self.xs[l]))
-
-				self.xs[l] *= self.lx
-				self.ys[l] *= self.ly
-				self.zs[l] *= self.lz
-
-				# tiled grid arrays to use in elementwise numpy operations
-				self.xs_full[l], self.ys_full[l], self.zs_full[l] = \
-					tile3D(self.xs[l], self.ys[l], self.zs[l])
-
-				# Coefficients for integration
-				self.dxs[l] = getIntegrationCoefficients(self.xs[l])
-				self.dys[l] = getIntegrationCoefficients(self.ys[l])
-				self.dzs[l] = getIntegrationCoefficients(self.zs[l])
-
-				dx, dy, dz = tile3D(
-					self.dxs[l],
-					self.dys[l],
-					self.dzs[l])
-				self.dVs[l] = dx * dy * dz
-
-			else:
-				self.zs[l], _ = getHarmonicGrid(mshape[0], l)
-				self.zs[l] *= self.lz
-
-				self.shapes[l] = (len(self.zs[l]),)
-
-				self.zs_full[l] = self.zs[l]
-
-				# dVs for debugging (integration in x-space)
-				self.dzs[l] = getIntegrationCoefficients(self.zs[l])
-				self.dVs[l] = self.dzs[l]
-
-			# Create aliases for 1st order arrays,
-			# making it look like UniformGrid
-			# (high orders are used only inside evolution classes anyway)
-			self.shape = self.shapes[1]
-			self.dV = self.dVs[1]
-
-			self.size = 1
-			for i in xrange(self.dim):
-				self.size *= self.shape[i]
-
-			if self.dim == 3:
-				self.x = self.xs[1]
-				self.y = self.ys[1]
-				self.x_full = self.xs_full[1]
-				self.y_full = self.ys_full[1]
-				self.dx = self.dxs[1]
-				self.dy = self.dys[1]
-
-			self.z = self.zs[1]
-			self.z_full = self.zs_full[1]
-			self.dz = self.dzs[1]
-
-	def copy(self):
-		return copy.deepcopy(self)
+			return numpy.broadcast_to(broadcast, self.shape)
 
 	def get_dV(self, env, order=1):
-		return env.toDevice(self.dVs[order].astype(self._constants.scalar.dtype))
+		return getShared(env, ('dV', self._getFingerprint(), order),
+			lambda: env.toDevice(self.dVs[order].astype(self._constants.scalar.dtype)))
 
 
-class Constants:
+class Constants(_Immutable):
 
 	hbar = 1.054571628e-34 # Planck constant
 	r_bohr = 5.2917720859e-11 # Bohr radius
@@ -409,13 +513,3 @@ class Constants:
 		"""get TF-approximated chemical potential"""
 		return ((0.75 * g * N) ** (2.0 / 3)) * \
 			((self.m * self.wz * self.wz / 2) ** (1.0 / 3))
-
-	def __eq__(self, other):
-		for key in _DEFAULTS.keys() + ['double']:
-			if getattr(self, key) != getattr(other, key):
-				return False
-
-		return True
-
-	def copy(self):
-		return copy.deepcopy(self)
@@ -8,6 +8,14 @@ import numpy
 from .helpers import *
 from .globals import *
 from .constants import PSI_FUNC, WIGNER, COMP_1_minus1, COMP_2_1
+from .checkpoint import loadCheckpoint, restoreCallbacks
+
+
+# Representations of the state, which callbacks can request by setting
+# their 'representation' attribute (X_SPACE is assumed if it is not set).
+X_SPACE = 'x' # coordinate space
+K_SPACE = 'k' # mode space (in_mspace flag of the wavefunctions is set for the call)
+NO_SPACE = 'none' # callback does not access the wavefunction data
 
 
 class TerminateEvolution(Exception):
@@ -16,6 +24,9 @@ class TerminateEvolution(Exception):
 
 class Evolution(PairedCalculation):
 
+	# attributes, which are saved in checkpoints
+	_checkpoint_attrs = ()
+
 	def __init__(self, env):
 		PairedCalculation.__init__(self, env)
 		self._env = env
@@ -26,6 +37,18 @@ class Evolution(PairedCalculation):
 	def _toEvolutionSpace(self, cloud):
 		pass
 
+	def _toModeSpace(self, cloud):
+		self._toCanonicalSpace(cloud)
+		batch = cloud.a.size / self._constants.cells
+		self._plan.execute(cloud.a.data, batch=batch)
+		self._plan.execute(cloud.b.data, batch=batch)
+
+	def _fromModeSpace(self, cloud):
+		batch = cloud.a.size / self._constants.cells
+		self._plan.execute(cloud.a.data, batch=batch, inverse=True)
+		self._plan.execute(cloud.b.data, batch=batch, inverse=True)
+		self._toEvolutionSpace(cloud)
+
 	def _collectMetrics(self, t):
 		pass
 
@@ -33,21 +56,129 @@ class Evolution(PairedCalculation):
 		if callbacks is None:
 			return
 
-		self._toCanonicalSpace(cloud)
+		# callbacks are grouped by the representation they need,
+		# so that the state is transformed at most once for each group
+		groups = {NO_SPACE: [], K_SPACE: [], X_SPACE: []}
 		for callback in callbacks:
+			groups[getattr(callback, 'representation', X_SPACE)].append(callback)
+
+		for callback in groups[NO_SPACE]:
 			callback(cloud.time, cloud)
-		self._toEvolutionSpace(cloud)
 
-	def run(self, cloud, time, callbacks=None, callback_dt=0):
+		if len(groups[K_SPACE]) > 0:
+			self._toModeSpace(cloud)
+			cloud.a.in_mspace = cloud.b.in_mspace = True
+			try:
+				for callback in groups[K_SPACE]:
+					callback(cloud.time, cloud)
+			finally:
+				cloud.a.in_mspace = cloud.b.in_mspace = False
+			self._fromModeSpace(cloud)
+
+		if len(groups[X_SPACE]) > 0:
+			self._toCanonicalSpace(cloud)
+			for callback in groups[X_SPACE]:
+				callback(cloud.time, cloud)
+			self._toEvolutionSpace(cloud)
 
-		starting_time = cloud.time
-		ending_time = cloud.time + time
-		callback_t = 0
+	def _finishCallbacks(self, callbacks):
+		"""Waits for callbacks, which process the data in background (see AsyncCollectors)"""
+		if callbacks is None:
+			return
 
-		self._toEvolutionSpace(cloud)
+		for callback in callbacks:
+			if hasattr(callback, 'finish'):
+				callback.finish()
 
+	def _finishRun(self, callbacks, checkpoint, failed):
+		"""
+		Waits for background callbacks and checkpoint writes at the end of run().
+		If the run failed, their errors are ignored,
+		so that they do not replace the exception which is being raised.
+		"""
+		try:
+			try:
+				self._finishCallbacks(callbacks)
+			finally:
+				if checkpoint is not None:
+					checkpoint.finish()
+		except Exception:
+			if not failed:
+				raise
+
+	def _getCheckpointState(self):
+		state = dict((name, getattr(self, name)) for name in self._checkpoint_attrs)
+
+		# random generators with own streams (see helpers.random.CPURandom)
+		random = getattr(self, '_random', None)
+		if hasattr(random, 'getState'):
+			state['_random'] = random.getState()
+
+		return state
+
+	def _setCheckpointState(self, state):
+		state = dict(state)
+		if '_random' in state:
+			self._random.setState(state.pop('_random'))
+
+		for name, value in state.items():
+			setattr(self, name, value)
+
+	def _popResumedLoop(self):
+		"""
+		If the evolution is resumed from a checkpoint, restores its state
+		and returns saved variables of the evolution loop; otherwise returns None.
+		"""
+		data = getattr(self, '_resumed', None)
+		self._resumed = None
+		if data is None:
+			return None
+
+		self._setCheckpointState(data['evolution'])
+		return data['loop']
+
+	def resume(self, path, cloud, callbacks=None, checkpoint=None, **kwds):
+		"""
+		Continues the evolution from the file saved by checkpoint.Checkpoint.
+		cloud, callbacks and the evolution itself must be created in the same way
+		as for the original run; their data is replaced by the saved one.
+		"""
+		data = loadCheckpoint(path)
+
+		self._env.copyBuffer(self._env.toDevice(data['a']), dest=cloud.a.data)
+		self._env.copyBuffer(self._env.toDevice(data['b']), dest=cloud.b.data)
+		cloud.time = data['time']
+		numpy.random.set_state(data['random'])
+		restoreCallbacks(callbacks, data['callbacks'])
+
+		self._resumed = data
+		loop = data['loop']
+		return self.run(cloud, loop['time'], callbacks=callbacks, callback_dt=loop['callback_dt'],
+			checkpoint=checkpoint, starting_phase=data['evolution']['_phi'], **kwds)
+
+	def run(self, cloud, time, callbacks=None, callback_dt=0, checkpoint=None,
+			in_evolution_space=False):
+		"""
+		in_evolution_space: if True, the cloud is already in the evolution space
+		and is left there after the run (used by pulse.PulseSequence to avoid
+		transformations between consecutive segments).
+		"""
+
+		loop = self._popResumedLoop()
+		if loop is None:
+			starting_time = cloud.time
+			callback_t = 0
+			if not in_evolution_space:
+				self._toEvolutionSpace(cloud)
+		else:
+			# the state was saved in the evolution space
+			starting_time = loop['starting_time']
+			callback_t = loop['callback_t']
+
+		failed = True
 		try:
-			self._runCallbacks(cloud, callbacks)
+			if loop is None:
+				self._runCallbacks(cloud, callbacks)
 
 			while cloud.time - starting_time < time:
 				dt_used = self.propagate(cloud, cloud.time - starting_time, callback_dt - callback_t)
@@ -60,22 +191,39 @@ class Evolution(PairedCalculation):
 					self._runCallbacks(cloud, callbacks)
 					callback_t = 0
 
+				if checkpoint is not None:
+					checkpoint.update(self, cloud, callbacks, dict(time=time,
+						callback_dt=callback_dt, starting_time=starting_time, callback_t=callback_t))
+
 			if callback_dt > time:
 				self._runCallbacks(cloud, callbacks)
 
-			self._toCanonicalSpace(cloud)
+			if not in_evolution_space:
+				self._toCanonicalSpace(cloud)
+
+			failed = False
 
 		except TerminateEvolution:
+			failed = False
 			return cloud.time
 
+		finally:
+			self._finishRun(callbacks, checkpoint, failed)
+
 
 class SplitStepEvolution(Evolution):
 	"""
 	Calculates evolution of two-component BEC, using split-step propagation
 	of paired GPEs.
+	If eps is given, time step is chosen adaptively (using step doubling),
+	so that the relative local error stays below eps; dt is the initial step then,
+	and dt_min/dt_max limit the step size.
+	order=4 makes each step a composition of three Strang steps
+	(Forest-Ruth/Yoshida scheme), which is fourth-order for the deterministic part.
 	"""
 
-	def __init__(self, env, constants, rabi_freq=0, detuning=0, dt=None, noise=True):
+	def __init__(self, env, constants, rabi_freq=0, detuning=0, dt=None, noise=True,
+			eps=None, dt_min=0, dt_max=None, tiny=1e-3, order=2):
 		PairedCalculation.__init__(self, env)
 		self._env = env
 		self._constants = constants
@@ -84,6 +232,31 @@ class SplitStepEvolution(Evolution):
 		self._dt = dt if dt is not None else self._constants.dt_evo
 		self._noise = noise
 
+		if eps is not None and env.gpu:
+			raise NotImplementedError("Adaptive time step is only supported on CPU")
+
+		self._eps = eps
+		self._dt_min = dt_min
+		self._dt_max = dt_max
+		self._tiny = tiny
+
+		if order == 2:
+			self._weights = (1.0,)
+		elif order == 4:
+			w1 = 1.0 / (2.0 - 2.0 ** (1.0 / 3))
+			self._weights = (w1, 1.0 - 2.0 * w1, w1)
+		else:
+			raise ValueError("Unsupported order: " + str(order))
+		self._order = order
+
+		self._dt_used = self._dt
+		self._dt_times = []
+		self._dts = []
+
+		# time step of the last Strang step (its final k-space propagation
+		# is postponed in midstep)
+		self._last_substep = self._dt
+
 		self._detuning = 2 * math.pi * detuning
 		self._rabi_freq = 2 * math.pi * rabi_freq
 
@@ -99,22 +272,23 @@ class SplitStepEvolution(Evolution):
 
 		self._projector_mask = getProjectorMask(self._env, self._constants)
 
+		# temporary buffers for CPU propagation, reused between steps
+		# (one set for every ensemble slab processed in parallel)
+		self._workspaces = [Workspace(env) for i in xrange(getattr(env, 'threads', 1))]
+
+		# k-space propagation coefficients for CPU, cached by (dt, projector)
+		self._kcoeffs = {}
+
 		self._prepare()
 
+	_checkpoint_attrs = ('_dt', '_dt_used', '_last_substep', '_midstep', '_phi',
+		'_dt_times', '_dts')
+
 	def _cpu__projector(self, cloud):
-		nvz = self._constants.nvz
-		a_data = cloud.a.data
-		b_data = cloud.b.data
-
-		for e in xrange(self._constants.ensembles):
-			start = e * nvz
-			stop = (e + 1) * nvz
-			if self._constants.dim == 3:
-				a_data[start:stop,:,:] *= self._projector_mask
-				b_data[start:stop,:,:] *= self._projector_mask
-			else:
-				a_data[start:stop] *= self._projector_mask
-				b_data[start:stop] *= self._projector_mask
+		mask = self._projector_mask
+		for data in (cloud.a.data, cloud.b.data):
+			view = ensembleView(data, mask.shape)
+			view *= mask
 
 	def _gpu__projector(self, cloud):
 		self._projector_func(cloud.a.size, cloud.a.data, cloud.b.data, self._projector_mask)
@@ -354,36 +528,46 @@ class SplitStepEvolution(Evolution):
 
 	def _toKSpace(self, cloud):
 		batch = cloud.a.size / self._constants.cells
-		self._plan.execute(cloud.a.data, batch=batch, inverse=True)
-		self._plan.execute(cloud.b.data, batch=batch, inverse=True)
+		self._plan.execute(cloud.a.data, batch=batch)
+		self._plan.execute(cloud.b.data, batch=batch)
 
 	def _toXSpace(self, cloud):
 		batch = cloud.a.size / self._constants.cells
-		self._plan.execute(cloud.a.data, batch=batch)
-		self._plan.execute(cloud.b.data, batch=batch)
+		self._plan.execute(cloud.a.data, batch=batch, inverse=True)
+		self._plan.execute(cloud.b.data, batch=batch, inverse=True)
 
-	def _gpu__kpropagate(self, cloud, dt):
+	def _gpu__kpropagate(self, cloud, dt, projector=False):
 		self._kpropagate_func(cloud.a.size,
 			cloud.a.data, cloud.b.data, self._constants.scalar.cast(dt), self._kvectors)
+		if projector:
+			self._projector(cloud)
 
-	def _cpu__kpropagate(self, cloud, dt):
-		kcoeff = numpy.exp(self._kvectors * (-1j * dt / 2))
-		data1 = cloud.a.data
-		data2 = cloud.b.data
-		nvz = self._constants.nvz
-
-		if self._constants.dim == 1:
-			for e in xrange(cloud.a.size / self._constants.cells):
-				start = e * nvz
-				stop = (e + 1) * nvz
-				data1[start:stop] *= kcoeff
-				data2[start:stop] *= kcoeff
-		else:
-			for e in xrange(cloud.a.size / self._constants.cells):
-				start = e * nvz
-				stop = (e + 1) * nvz
-				data1[start:stop,:,:] *= kcoeff
-				data2[start:stop,:,:] *= kcoeff
+	def _getKCoeff(self, dt, projector):
+		"""
+		Returns k-space propagation coefficients for given time step.
+		If projector is True, projector mask is already applied to them,
+		so that both operations take a single pass over the data.
+		"""
+		key = (dt, projector)
+		if key not in self._kcoeffs:
+			# do not let the cache grow indefinitely if time step changes
+			if len(self._kcoeffs) >= 16:
+				self._kcoeffs.clear()
+
+			kcoeff = numpy.exp(self._kvectors * (-1j * dt / 2))
+			if projector:
+				kcoeff *= self._projector_mask
+			self._kcoeffs[key] = kcoeff.astype(self._constants.complex.dtype)
+
+		return self._kcoeffs[key]
+
+	def _cpu__kpropagate(self, cloud, dt, projector=False):
+		self._kpropagateSlab(cloud.a.data, cloud.b.data, self._getKCoeff(dt, projector))
+
+	def _kpropagateSlab(self, a, b, kcoeff):
+		for data in (a, b):
+			view = ensembleView(data, kcoeff.shape)
+			view *= kcoeff
 
 	def _gpu__xpropagate(self, cloud, dt, t):
 		cast = self._constants.scalar.cast
@@ -391,13 +575,26 @@ class SplitStepEvolution(Evolution):
 			cast(dt), cast(t), self._potentials, cast(self._phi))
 
 	def _cpu__xpropagate(self, cloud, dt, t):
-		a = cloud.a
-		b = cloud.b
-		a0 = a.data.copy()
-		b0 = b.data.copy()
+		self._xpropagateSlab(self._workspaces[0], cloud.a.data, cloud.b.data,
+			cloud.a.comp, cloud.b.comp, dt, t)
+
+	def _xpropagateSlab(self, ws, a, b, comp1, comp2, dt, t):
+		shape = a.shape
+		cdtype = a.dtype
+		sdtype = self._constants.scalar.dtype
+
+		a0 = ws.get('a0', shape, cdtype)
+		b0 = ws.get('b0', shape, cdtype)
+		n_a = ws.get('n_a', shape, sdtype)
+		n_b = ws.get('n_b', shape, sdtype)
+		temp = ws.get('temp', shape, sdtype)
+		N1 = ws.get('N1', shape, cdtype)
+		N2 = ws.get('N2', shape, cdtype)
+		ctemp = ws.get('ctemp', shape, cdtype)
+
+		a0[...] = a
+		b0[...] = b
 
-		comp1 = cloud.a.comp
-		comp2 = cloud.b.comp
 		g_by_hbar = self._constants.g_by_hbar
 		g11_by_hbar = g_by_hbar[(comp1, comp1)]
 		g12_by_hbar = g_by_hbar[(comp1, comp2)]
@@ -407,34 +604,63 @@ class SplitStepEvolution(Evolution):
 		l12 = self._constants.l12
 		l22 = self._constants.l22
 
-		p = -self._potentials * 1j
-		nvz = self._constants.nvz
+		V = self._potentials
 
-		m = numpy.empty((2, 2, a.data.size), dtype=a.data.dtype)
+		if self._rabi_freq == 0.0:
+			da = ws.get('da', shape, cdtype)
+			db = ws.get('db', shape, cdtype)
+		else:
+			m = ws.get('m', (2, 2) + shape, cdtype)
+			rt = ws.get('rt', shape, cdtype)
+			l1 = ws.get('l1', shape, cdtype)
+			l2 = ws.get('l2', shape, cdtype)
+			ev10 = ws.get('ev10', shape, cdtype)
+			ev11 = ws.get('ev11', shape, cdtype)
+			ev_inv_coeff = ws.get('ev_inv_coeff', shape, cdtype)
 
 		for iter in xrange(self._constants.itmax):
-			n_a = numpy.abs(a.data) ** 2
-			n_b = numpy.abs(b.data) ** 2
-
-			N1 = n_a * n_a * (-l111 / 2) + n_b * (-l12 / 2) - \
-				1j * (n_a * g11_by_hbar + n_b * g12_by_hbar)
-
-			N2 = n_b * (-l22 / 2) + n_a * (-l12 / 2) - \
-				1j * (n_b * g22_by_hbar + n_a * g12_by_hbar)
-
-			for e in xrange(cloud.a.size / self._constants.cells):
-				start = e * nvz
-				stop = (e + 1) * nvz
-				N1[start:stop] += p
-				N2[start:stop] += p
+			numpy.abs(a, out=n_a)
+			numpy.square(n_a, out=n_a)
+			numpy.abs(b, out=n_b)
+			numpy.square(n_b, out=n_b)
+
+			# N1 = n_a ** 2 * (-l111 / 2) + n_b * (-l12 / 2) -
+			#	1j * (V + n_a * g11_by_hbar + n_b * g12_by_hbar)
+			N1_re = N1.real
+			N1_im = N1.imag
+			numpy.multiply(n_a, n_a, out=N1_re)
+			N1_re *= -l111 / 2
+			numpy.multiply(n_b, -l12 / 2, out=temp)
+			N1_re += temp
+			numpy.multiply(n_a, -g11_by_hbar, out=N1_im)
+			numpy.multiply(n_b, -g12_by_hbar, out=temp)
+			N1_im += temp
+
+			# N2 = n_b * (-l22 / 2) + n_a * (-l12 / 2) -
+			#	1j * (V + n_b * g22_by_hbar + n_a * g12_by_hbar)
+			N2_re = N2.real
+			N2_im = N2.imag
+			numpy.multiply(n_b, -l22 / 2, out=N2_re)
+			numpy.multiply(n_a, -l12 / 2, out=temp)
+			N2_re += temp
+			numpy.multiply(n_b, -g22_by_hbar, out=N2_im)
+			numpy.multiply(n_a, -g12_by_hbar, out=temp)
+			N2_im += temp
+
+			N1_im_view = ensembleView(N1_im, V.shape)
+			N1_im_view -= V
+			N2_im_view = ensembleView(N2_im, V.shape)
+			N2_im_view -= V
 
 			if self._rabi_freq == 0.0:
 
-				da = numpy.exp(N1 * (dt / 2))
-				db = numpy.exp(N2 * (dt / 2))
+				numpy.multiply(N1, dt / 2, out=da)
+				numpy.exp(da, out=da)
+				numpy.multiply(N2, dt / 2, out=db)
+				numpy.exp(db, out=db)
 
-				a.data = a0 * da
-				b.data = b0 * db
+				numpy.multiply(a0, da, out=a)
+				numpy.multiply(b0, db, out=b)
 
 			else:
 
@@ -442,76 +668,133 @@ class SplitStepEvolution(Evolution):
 				f = self._detuning * t + self._phi
 
 				# calculating exp([[N1, -ik exp(-if)/2], [-ik exp(if)/2, N2]])
-				rt = numpy.sqrt(-k ** 2 + (N1 - N2) ** 2 + 0j)
-
-				l1 = 0.5 * (-rt + N1 + N2) # eigenvalues 1
-				l2 = 0.5 * (rt + N1 + N2) # eigenvalues 2
-
-				#ev = numpy.array([
-				#	[1, -(1j * numpy.exp(1j * f) * (rt + N1 - N2)) / k],
-				#	[1, (1j * numpy.exp(1j * f) * (rt - N1 + N2)) / k]
-				#])
+				# rt = sqrt(-k ** 2 + (N1 - N2) ** 2)
+				numpy.subtract(N1, N2, out=ctemp)
+				numpy.multiply(ctemp, ctemp, out=rt)
+				rt -= k ** 2
+				numpy.sqrt(rt, out=rt)
+
+				# eigenvalues
+				numpy.add(N1, N2, out=l2)
+				numpy.subtract(l2, rt, out=l1)
+				l1 *= 0.5
+				l2 += rt
+				l2 *= 0.5
 
 				# elements of eigenvector matrix ([1, 1], [ev10, ev11])
-				ev10 = -(1j * numpy.exp(1j * f) * (rt + N1 - N2)) / k
-				ev11 = (1j * numpy.exp(1j * f) * (rt - N1 + N2)) / k
+				# ev10 = -(1j * exp(1j * f) * (rt + N1 - N2)) / k
+				# ev11 = (1j * exp(1j * f) * (rt - N1 + N2)) / k
+				ev_coeff = -1j * numpy.exp(1j * f) / k
+				numpy.add(rt, ctemp, out=ev10)
+				ev10 *= ev_coeff
+				numpy.subtract(ctemp, rt, out=ev11)
+				ev11 *= ev_coeff
 
 				# elements of inverse eigenvector matrix
-				# ([-ev11, 1], [ev10, -1]) / ev_inf_coeff
-				ev_inv_coeff = ev10 - ev11
-
-				l1_exp = numpy.exp(l1 * dt / 2)
-				l2_exp = numpy.exp(l2 * dt / 2)
-
-				m[0,0,:] = ((l2_exp * ev10 - l1_exp * ev11) / ev_inv_coeff).flatten()
-				m[0,1,:] = ((l1_exp - l2_exp) / ev_inv_coeff).flatten()
-				m[1,0,:] = ((ev10 * ev11 * (l2_exp - l1_exp)) / ev_inv_coeff).flatten()
-				m[1,1,:] = ((l1_exp * ev10 - l2_exp * ev11) / ev_inv_coeff).flatten()
-
-				a.data = m[0,0,:].reshape(a0.shape) * a0 + m[0,1,:].reshape(a0.shape) * b0
-				b.data = m[1,0,:].reshape(a0.shape) * a0 + m[1,1,:].reshape(a0.shape) * b0
-
+				# ([-ev11, 1], [ev10, -1]) / (ev10 - ev11)
+				numpy.subtract(ev10, ev11, out=ev_inv_coeff)
+				numpy.reciprocal(ev_inv_coeff, out=ev_inv_coeff)
+
+				l1 *= dt / 2
+				numpy.exp(l1, out=l1)
+				l2 *= dt / 2
+				numpy.exp(l2, out=l2)
+
+				numpy.multiply(l2, ev10, out=m[0, 0])
+				numpy.multiply(l1, ev11, out=ctemp)
+				m[0, 0] -= ctemp
+				m[0, 0] *= ev_inv_coeff
+
+				numpy.subtract(l1, l2, out=m[0, 1])
+				m[0, 1] *= ev_inv_coeff
+
+				numpy.multiply(ev10, ev11, out=m[1, 0])
+				numpy.subtract(l2, l1, out=ctemp)
+				m[1, 0] *= ctemp
+				m[1, 0] *= ev_inv_coeff
+
+				numpy.multiply(l1, ev10, out=m[1, 1])
+				numpy.multiply(l2, ev11, out=ctemp)
+				m[1, 1] -= ctemp
+				m[1, 1] *= ev_inv_coeff
+
+				numpy.multiply(m[0, 0], a0, out=a)
+				numpy.multiply(m[0, 1], b0, out=ctemp)
+				a += ctemp
+				numpy.multiply(m[1, 0], a0, out=b)
+				numpy.multiply(m[1, 1], b0, out=ctemp)
+				b += ctemp
+
+		# propagate to endpoint using log derivative
 		if self._rabi_freq == 0.0:
-			a.data *= da
-			b.data *= db
+			a *= da
+			b *= db
 		else:
-			a_copy = a.data.copy()
-			a.data = m[0,0,:].reshape(a0.shape) * a.data + m[0,1,:].reshape(a0.shape) * b.data
-			b.data = m[1,0,:].reshape(a0.shape) * a_copy + m[1,1,:].reshape(a0.shape) * b.data
-
-	def _noiseFunc(self, a_data, b_data):
+			# a0 is not needed anymore and can hold the copy of a
+			a0[...] = a
+			a *= m[0, 0]
+			numpy.multiply(m[0, 1], b, out=ctemp)
+			a += ctemp
+			b *= m[1, 1]
+			numpy.multiply(m[1, 0], a0, out=ctemp)
+			b += ctemp
+
+	def _getNoiseCoeffs(self):
+		"""
+		Returns coefficients of the noise terms:
+		da = c111 * a ** 2 * dW0 + c12 * b * dW1,
+		db = c12 * a * dW1 + c22 * b * dW2
+		"""
 		coeff = math.sqrt(1.0 / self._constants.dV)
 		k111 = self._constants.l111 / 6.0
 		k12 = self._constants.l12 / 2.0
 		k22 = self._constants.l22 / 4.0
 
-		gamma111_1 = a_data ** 2 * (math.sqrt(k111) * 3.0 * coeff)
-		gamma12_1 = b_data * (math.sqrt(k12) * coeff)
-		gamma12_2 = a_data * (math.sqrt(k12) * coeff)
-		gamma22_2 = b_data * (math.sqrt(k22) * 2.0 * coeff)
-
-		zeros = numpy.zeros(a_data.shape, self._constants.scalar.dtype)
-
-		return gamma111_1, gamma12_1, zeros, zeros, gamma12_2, gamma22_2
+		return (math.sqrt(k111) * 3.0 * coeff, math.sqrt(k12) * coeff,
+			math.sqrt(k22) * 2.0 * coeff)
 
 	def _cpu__propagateNoise(self, cloud, dt):
-		shape = self._constants.ens_shape
-		r_shape = tuple([6] + list(shape))
-
-		randoms = self._random.random_normal(size=r_shape)
-
-		G00, G01, G02, G03, G04, G05 = self._noiseFunc(cloud.a.data, cloud.b.data)
-		G10, G11, G12, G13, G14, G15 = self._noiseFunc(
-			cloud.a.data + math.sqrt(dt / 2.0) * (
-				G00 * randoms[0] + G01 * randoms[1] + G02 * randoms[2]),
-			cloud.b.data + math.sqrt(dt / 2.0) * (
-				G03 * randoms[0] + G04 * randoms[1] + G05 * randoms[2])
-		)
-
-		cloud.a.data += math.sqrt(dt) * (G10 * randoms[3] +
-			G11 * randoms[4] + G12 * randoms[5])
-		cloud.b.data += math.sqrt(dt) * (G13 * randoms[3] +
-			G14 * randoms[4] + G15 * randoms[5])
+		randoms = self._random.random_normal(size=(6,) + cloud.a.data.shape)
+		self._propagateNoiseSlab(self._workspaces[0], cloud.a.data, cloud.b.data, randoms, dt)
+
+	def _noiseTerms(self, a, b, r0, r1, r2, coeff, da, db, temp):
+		"""Writes noise increments for given state and randoms to da and db"""
+		c111, c12, c22 = self._getNoiseCoeffs()
+
+		numpy.square(a, out=da)
+		da *= c111
+		da *= r0
+		numpy.multiply(b, c12, out=temp)
+		temp *= r1
+		da += temp
+		da *= coeff
+
+		numpy.multiply(a, c12, out=db)
+		db *= r1
+		numpy.multiply(b, c22, out=temp)
+		temp *= r2
+		db += temp
+		db *= coeff
+
+	def _propagateNoiseSlab(self, ws, a, b, randoms, dt):
+		# midpoint method; all temporaries live in the workspace
+		shape = a.shape
+		dtype = a.dtype
+		a_mid = ws.get('noise_a_mid', shape, dtype)
+		b_mid = ws.get('noise_b_mid', shape, dtype)
+		da = ws.get('noise_da', shape, dtype)
+		db = ws.get('noise_db', shape, dtype)
+		temp = ws.get('noise_temp', shape, dtype)
+
+		self._noiseTerms(a, b, randoms[0], randoms[1], randoms[2],
+			math.sqrt(dt / 2.0), da, db, temp)
+		numpy.add(a, da, out=a_mid)
+		numpy.add(b, db, out=b_mid)
+
+		self._noiseTerms(a_mid, b_mid, randoms[3], randoms[4], randoms[5],
+			math.sqrt(dt), da, db, temp)
+		a += da
+		b += db
 
 	def _gpu__propagateNoise(self, cloud, dt):
 		randoms = self._random.random_normal(size=cloud.a.size * 6)
@@ -521,7 +804,7 @@ class SplitStepEvolution(Evolution):
 
 	def _finishStep(self, cloud):
 		if self._midstep:
-			self._kpropagate(cloud, self._dt)
+			self._kpropagate(cloud, self._last_substep)
 			self._midstep = False
 
 	def _toCanonicalSpace(self, cloud):
@@ -531,29 +814,204 @@ class SplitStepEvolution(Evolution):
 	def _toEvolutionSpace(self, cloud):
 		self._toKSpace(cloud)
 
-	def propagate(self, cloud, t, remaining_time):
-
-		# replace two dt/2 k-space propagation by one dt propagation,
-		# if there were no rendering between them
-		if self._midstep:
-			self._kpropagate(cloud, self._dt * 2)
-		else:
-			self._kpropagate(cloud, self._dt)
+	def _toModeSpace(self, cloud):
+		# the state is already in k-space, so only the postponed
+		# k-space propagation is necessary (no FFTs)
+		self._finishStep(cloud)
 
-		if cloud.type == WIGNER and noise:
-			self._projector(cloud)
+	def _fromModeSpace(self, cloud):
+		pass
 
+	def _gpu__step(self, cloud, dt_k, dt, t, noise_dt):
+		noise = noise_dt is not None
+		self._kpropagate(cloud, dt_k, projector=noise)
 		self._toXSpace(cloud)
-		self._xpropagate(cloud, self._dt, t)
+		self._xpropagate(cloud, dt, t)
 
-		if cloud.type == WIGNER and noise:
-			self._propagateNoise(cloud, self._dt)
+		if noise:
+			self._propagateNoise(cloud, noise_dt)
 
-		self._midstep = True
 		self._toKSpace(cloud)
 
+	def _cpu__step(self, cloud, dt_k, dt, t, noise_dt):
+		self._stepData(cloud.a.data, cloud.b.data, cloud.a.comp, cloud.b.comp,
+			dt_k, dt, t, noise_dt)
+
+	def _stepData(self, a_data, b_data, comp1, comp2, dt_k, dt, t, noise_dt):
+		"""
+		Propagates data on CPU: k-space propagation for dt_k / 2,
+		x-space propagation for dt and, if noise_dt is not None,
+		noise propagation for noise_dt (projector is applied in this case too).
+		"""
+		cell_shape = self._kvectors.shape
+		a = ensembleView(a_data, cell_shape)
+		b = ensembleView(b_data, cell_shape)
+		noise = noise_dt is not None
+
+		# the block for the next noisy step is generated in background
+		# while this one is propagated; every ensemble has its own random stream,
+		# so the result does not depend on the number of slabs
+		if noise:
+			randoms = numpy.rollaxis(
+				self._random.next_normal((a.shape[0], 6) + cell_shape, ensembles=(0, a.shape[0])), 1)
+
+		# the coefficient cache is not thread-safe, so it is only used from this thread
+		kcoeff = self._getKCoeff(dt_k, noise)
+
+		def process(slab, start, stop):
+			a_slab = a[start:stop]
+			b_slab = b[start:stop]
+			batch = stop - start
+
+			self._kpropagateSlab(a_slab, b_slab, kcoeff)
+			self._plan.execute(a_slab, batch=batch, inverse=True)
+			self._plan.execute(b_slab, batch=batch, inverse=True)
+
+			self._xpropagateSlab(self._workspaces[slab], a_slab, b_slab, comp1, comp2, dt, t)
+
+			if noise:
+				self._propagateNoiseSlab(self._workspaces[slab], a_slab, b_slab,
+					randoms[:, start:stop], noise_dt)
+
+			self._plan.execute(a_slab, batch=batch)
+			self._plan.execute(b_slab, batch=batch)
+
+		self._env.runSlabs(process, a.shape[0])
+
+	def propagate(self, cloud, t, remaining_time):
+
+		noise = cloud.type == WIGNER and self._noise
+
+		if self._eps is not None:
+			return self._propagateAdaptive(cloud, t, remaining_time, noise)
+
+		# For higher orders the step consists of several Strang steps.
+		# Noise and projector are applied once per step, in the first of them
+		# (the middle step of the fourth-order scheme goes backwards in time).
+		for i, w in enumerate(self._weights):
+			dt_sub = w * self._dt
+
+			# replace two dt/2 k-space propagation by one dt propagation,
+			# if there were no rendering between them;
+			# projector is applied together with k-space propagation
+			dt_k = self._last_substep + dt_sub if self._midstep else dt_sub
+
+			# x-space propagation takes place in the middle of the Strang step
+			self._step(cloud, dt_k, dt_sub, t + dt_sub / 2, self._dt if noise and i == 0 else None)
+			self._midstep = True
+			self._last_substep = dt_sub
+			t += dt_sub
+
+		self._dt_used = self._dt
 		return self._dt
 
+	def _fullStepData(self, a, b, comp1, comp2, dt, t, noise):
+		"""Makes a complete step on CPU (without postponing the last k-space propagation)"""
+		dt_last = None
+		for i, w in enumerate(self._weights):
+			dt_sub = w * dt
+			dt_k = dt_sub if dt_last is None else dt_last + dt_sub
+			t_x = t + dt_sub / 2
+			if noise and i == 0:
+				self._stepData(a, b, comp1, comp2, dt_k, dt_sub, t_x, dt)
+			else:
+				self._stepData(a, b, comp1, comp2, dt_k, dt_sub, t_x, None)
+			dt_last = dt_sub
+			t += dt_sub
+
+		self._kpropagateSlab(a, b, self._getKCoeff(dt_last, False))
+
+	def _cpu__propagateAdaptive(self, cloud, t, remaining_time, noise):
+		"""
+		Makes one step with adaptive time step.
+		The step is compared with two steps of half the size;
+		the latter result is used if the difference is small enough.
+		In order to make the comparison possible, steps are finished completely
+		(i.e. there is no midstep optimization in this mode).
+		Stochastic error cannot be controlled this way (it is only of order dt),
+		so for Wigner clouds the estimation is done without noise,
+		and the accepted step is then repeated with noise.
+		"""
+		safety = 0.9
+		order = self._order
+
+		# number of retries after which a non-finite error is considered a divergence
+		max_rejections = 30
+
+		ws = self._workspaces[0]
+		a = cloud.a.data
+		b = cloud.b.data
+		comp1 = cloud.a.comp
+		comp2 = cloud.b.comp
+
+		a0 = ws.get('adaptive_a0', a.shape, a.dtype)
+		b0 = ws.get('adaptive_b0', b.shape, b.dtype)
+		a_full = ws.get('adaptive_a_full', a.shape, a.dtype)
+		b_full = ws.get('adaptive_b_full', b.shape, b.dtype)
+		a0[...] = a
+		b0[...] = b
+
+		dt = self._dt
+		if remaining_time > 0:
+			dt = min(dt, remaining_time)
+
+		rejections = 0
+		while True:
+			a_full[...] = a0
+			b_full[...] = b0
+			self._fullStepData(a_full, b_full, comp1, comp2, dt, t, False)
+
+			a[...] = a0
+			b[...] = b0
+			self._fullStepData(a, b, comp1, comp2, dt / 2, t, False)
+			self._fullStepData(a, b, comp1, comp2, dt / 2, t + dt / 2, False)
+
+			yscal = max(numpy.abs(a).max(), numpy.abs(b).max()) + self._tiny
+			a_full -= a
+			b_full -= b
+			errmax = max(numpy.abs(a_full).max(), numpy.abs(b_full).max()) / yscal / self._eps
+
+			if not numpy.isfinite(errmax):
+				# the state has diverged, or the step is far too large;
+				# the step size cannot be estimated from the error in this case
+				rejections += 1
+				if dt <= self._dt_min or rejections >= max_rejections:
+					raise RuntimeError("Adaptive step failed at t = " + str(t) +
+						": error estimate is not finite")
+				dt = max(0.2 * dt, self._dt_min)
+				continue
+
+			if errmax < 1.0 or dt <= self._dt_min:
+				break
+
+			# reducing step size and retrying step
+			dt = max(safety * dt * errmax ** (-1.0 / (order + 1)), 0.2 * dt, self._dt_min)
+
+		if noise:
+			a[...] = a0
+			b[...] = b0
+			self._fullStepData(a, b, comp1, comp2, dt, t, True)
+
+		self._dt_used = dt
+
+		if errmax > 0:
+			new_dt = safety * dt * errmax ** (-1.0 / (order + 1))
+		else:
+			new_dt = 5.0 * dt
+		new_dt = min(new_dt, 5.0 * dt)
+		if self._dt_max is not None:
+			new_dt = min(new_dt, self._dt_max)
+		self._dt = max(new_dt, self._dt_min)
+
+		return dt
+
+	def _collectMetrics(self, t):
+		self._dts.append(self._dt_used)
+		self._dt_times.append(t)
+
+	def getTimeSteps(self):
+		return numpy.array(self._dt_times), numpy.array(self._dts)
+
 	def run(self, *args, **kwds):
 		if 'starting_phase' in kwds:
 			starting_phase = kwds.pop('starting_phase')
@@ -561,11 +1019,20 @@ class SplitStepEvolution(Evolution):
 		else:
 			self._phi = 0.0
 
-		Evolution.run(self, *args, **kwds)
+		return Evolution.run(self, *args, **kwds)
+
+	def getAllocations(self):
+		"""
+		Returns the number of buffers allocated by CPU propagation so far
+		(including x-space, noise and adaptive step temporaries)
+		"""
+		return sum(ws.allocations for ws in self._workspaces)
 
 
 class RK4Evolution(Evolution):
 
+	_checkpoint_attrs = ('_phi',)
+
 	def __init__(self, env, constants, rabi_freq=0, detuning=0, dt=None):
 		PairedCalculation.__init__(self, env)
 		self._env = env
@@ -690,9 +1157,6 @@ class RK4Evolution(Evolution):
 
 	def _cpu__propagationFunc(self, a_data, b_data, a_kdata, b_kdata, a_res, b_res, t, dt, phi):
 
-		batch = a_data.size / self._constants.cells
-		nvz = self._constants.nvz
-
 		# FIXME: remove hardcoding (g must depend on cloud.a.comp and cloud.b.comp)
 		g_by_hbar = self._constants.g_by_hbar
 		g11_by_hbar = g_by_hbar[(COMP_1_minus1, COMP_1_minus1)]
@@ -706,13 +1170,12 @@ class RK4Evolution(Evolution):
 		n_a = numpy.abs(a_data) ** 2
 		n_b = numpy.abs(b_data) ** 2
 
-		for e in xrange(batch):
-			start = e * nvz
-			stop = (e + 1) * nvz
-			a_res[start:stop,:,:] = -1j * (a_kdata[start:stop,:,:] * self._kvectors +
-				a_data[start:stop,:,:] * self._potentials)
-			b_res[start:stop,:,:] = -1j * (b_kdata[start:stop,:,:] * self._kvectors +
-				b_data[start:stop,:,:] * self._potentials)
+		k = self._kvectors
+		p = self._potentials
+		view = lambda x: ensembleView(x, k.shape)
+
+		view(a_res)[...] = -1j * (view(a_kdata) * k + view(a_data) * p)
+		view(b_res)[...] = -1j * (view(b_kdata) * k + view(b_data) * p)
 
 		a_res += (n_a * n_a * (-l111 / 2) + n_b * (-l12 / 2) -
 			1j * (n_a * g11_by_hbar + n_b * g12_by_hbar)) * a_data - \
@@ -793,7 +1256,7 @@ class RK4Evolution(Evolution):
 		self._a_res = self._env.allocate(shape, dtype=dtype)
 		self._b_res = self._env.allocate(shape, dtype=dtype)
 
-		Evolution.run(self, *args, **kwds)
+		return Evolution.run(self, *args, **kwds)
 
 
 
@@ -811,13 +1274,53 @@ class RK4Evolution(Evolution):
 
 
 
-class RK5Evolution(Evolution):
+class AdaptiveRKEvolution(Evolution):
+	"""
+	Base class for evolutions, using Dormand-Prince 5(4) method with adaptive time step.
+	Stage derivatives are kept in preallocated buffers; the derivative at the end
+	of the accepted step is reused as the first one for the next step (FSAL).
+	Subclasses define the right-hand side of the equation.
+	"""
 
-	def __init__(self, env, constants, dt=1e-6, eps=1e-9, tiny=1e-3, detuning=0, rabi_freq=0):
+	# Dormand-Prince tableau
+	_c = (0.0, 1.0 / 5, 3.0 / 10, 4.0 / 5, 8.0 / 9, 1.0, 1.0)
+	_a = (
+		(),
+		(1.0 / 5,),
+		(3.0 / 40, 9.0 / 40),
+		(44.0 / 45, -56.0 / 15, 32.0 / 9),
+		(19372.0 / 6561, -25360.0 / 2187, 64448.0 / 6561, -212.0 / 729),
+		(9017.0 / 3168, -355.0 / 33, 46732.0 / 5247, 49.0 / 176, -5103.0 / 18656),
+		(35.0 / 384, 0.0, 500.0 / 1113, 125.0 / 192, -2187.0 / 6784, 11.0 / 84)
+	)
+	# difference between 5th and 4th order solutions
+	_e = (71.0 / 57600, 0.0, -71.0 / 16695, 71.0 / 1920, -17253.0 / 339200,
+		22.0 / 525, -1.0 / 40)
+
+	# coefficients of 4th order continuous extension: the weight of i-th stage
+	# at the point theta of the step is sum(_p[i][j] * theta ** (j + 1))
+	_p = (
+		(1.0, -8048581381.0 / 2820520608, 8663915743.0 / 2820520608,
+			-12715105075.0 / 11282082432),
+		(0.0, 0.0, 0.0, 0.0),
+		(0.0, 131558114200.0 / 32700410799, -68118460800.0 / 10900136933,
+			87487479700.0 / 32700410799),
+		(0.0, -1754552775.0 / 470086768, 14199869525.0 / 1410260304,
+			-10690763975.0 / 1880347072),
+		(0.0, 127303824393.0 / 49829197408, -318862633887.0 / 49829197408,
+			701980252875.0 / 199316789632),
+		(0.0, -282668133.0 / 205662961, 2019193451.0 / 616988883,
+			-1453857185.0 / 822651844),
+		(0.0, 40617522.0 / 29380423, -110615467.0 / 29380423,
+			69997945.0 / 29380423)
+	)
+
+	_checkpoint_attrs = ('_dt', '_dt_used', '_phi', '_dt_times', '_dts', '_fsal')
+
+	def __init__(self, env, constants, dt, eps, tiny, detuning, rabi_freq):
 		Evolution.__init__(self, env)
 		self._constants = constants
 
-		# FIXME: implement adaptive time step propagation
 		self._dt = dt
 		self._eps = eps
 		self._tiny = tiny
@@ -830,21 +1333,39 @@ class RK5Evolution(Evolution):
 		self._potentials = getPotentials(self._env, self._constants)
 		self._kvectors = getKVectors(self._env, self._constants)
 
+		self._dt_times = []
+		self._dts = []
+
+		self._workspace = Workspace(env)
+
+		# indicates that the derivative at the beginning of the next step
+		# is already calculated (and stored in the last stage buffers)
+		self._fsal = False
+
+		# indicates that the state at the beginning of the step
+		# has to be saved for interpolation
+		self._dense_output = False
+
 		self._prepare()
 
 	def _cpu__prepare(self):
 		pass
 
-	def _propagationFunc(self, state1, state2, t):
+	def _propagationFunc(self, state1, state2, t, dt):
 		res1 = numpy.empty_like(state1)
 		res2 = numpy.empty_like(state2)
-		self._propagationFuncInplace(state1, state2, res1, res2, t)
+		self._propagationFuncInplace(state1, state2, res1, res2, t, dt)
 		return res1, res2
 
-	def _propagationFuncInplace(self, state1, state2, res1, res2, t):
+	def _propagationFuncInplace(self, state1, state2, res1, res2, t, dt):
+		"""
+		Calculates derivatives at time t;
+		dt is the time passed since the beginning of the current step.
+		"""
+		raise NotImplementedError()
 
-		batch = 1 # FIXME: hardcoding
-		nvz = self._constants.nvz
+	def _addNonlinearTerms(self, x1, x2, res1, res2, t):
+		"""Adds nonlinear, loss and coupling terms for given x-space state to results"""
 
 		# FIXME: remove hardcoding (g must depend on cloud.a.comp and cloud.b.comp)
 		g_by_hbar = self._constants.g_by_hbar
@@ -856,413 +1377,483 @@ class RK5Evolution(Evolution):
 		l12 = self._constants.l12
 		l22 = self._constants.l22
 
-		n_a = numpy.abs(state1) ** 2
-		n_b = numpy.abs(state2) ** 2
-
-		self._plan.execute(state1, self._a_kdata, batch=batch, inverse=True)
-		self._plan.execute(state1, self._b_kdata, batch=batch, inverse=True)
-
-		for e in xrange(batch):
-			start = e * nvz
-			stop = (e + 1) * nvz
-			res1[start:stop,:,:] = -1j * (self._a_kdata[start:stop,:,:] * self._kvectors +
-				state1[start:stop,:,:] * self._potentials)
-			res2[start:stop,:,:] = -1j * (self._b_kdata[start:stop,:,:] * self._kvectors +
-				state2[start:stop,:,:] * self._potentials)
+		ws = self._workspace
+		shape = x1.shape
+		sdtype = self._constants.scalar.dtype
+		n_a = ws.get('n_a', shape, sdtype)
+		n_b = ws.get('n_b', shape, sdtype)
+		temp = ws.get('temp', shape, sdtype)
+		N = ws.get('N', shape, x1.dtype)
+		ctemp = ws.get('ctemp', shape, x1.dtype)
+
+		numpy.abs(x1, out=n_a)
+		numpy.square(n_a, out=n_a)
+		numpy.abs(x2, out=n_b)
+		numpy.square(n_b, out=n_b)
+
+		# N = n_a ** 2 * (-l111 / 2) + n_b * (-l12 / 2) -
+		#	1j * (n_a * g11_by_hbar + n_b * g12_by_hbar)
+		N_re = N.real
+		N_im = N.imag
+		numpy.multiply(n_a, n_a, out=N_re)
+		N_re *= -l111 / 2
+		numpy.multiply(n_b, -l12 / 2, out=temp)
+		N_re += temp
+		numpy.multiply(n_a, -g11_by_hbar, out=N_im)
+		numpy.multiply(n_b, -g12_by_hbar, out=temp)
+		N_im += temp
+		numpy.multiply(N, x1, out=ctemp)
+		res1 += ctemp
+		if self._rabi_freq != 0:
+			numpy.multiply(x2, -0.5j * self._rabi_freq *
+				numpy.exp(1j * (- t * self._detuning - self._phi)), out=ctemp)
+			res1 += ctemp
+
+		# N = n_b * (-l22 / 2) + n_a * (-l12 / 2) -
+		#	1j * (n_b * g22_by_hbar + n_a * g12_by_hbar)
+		numpy.multiply(n_b, -l22 / 2, out=N_re)
+		numpy.multiply(n_a, -l12 / 2, out=temp)
+		N_re += temp
+		numpy.multiply(n_b, -g22_by_hbar, out=N_im)
+		numpy.multiply(n_a, -g12_by_hbar, out=temp)
+		N_im += temp
+		numpy.multiply(N, x2, out=ctemp)
+		res2 += ctemp
+		if self._rabi_freq != 0:
+			numpy.multiply(x1, -0.5j * self._rabi_freq *
+				numpy.exp(1j * (t * self._detuning + self._phi)), out=ctemp)
+			res2 += ctemp
+
+	def _transformDerivatives(self, res1, res2, dt):
+		"""
+		Transforms (in place) derivatives calculated at the end of the step
+		of length dt to the derivatives at the beginning of the next step.
+		"""
+		pass
 
-		res1 += (n_a * n_a * (-l111 / 2) + n_b * (-l12 / 2) -
-			1j * (n_a * g11_by_hbar + n_b * g12_by_hbar)) * state1 - \
-			0.5j * self._rabi_freq * \
-				numpy.exp(1j * (- t * self._detuning - self._phi)) * state2
+	def _transformResult(self, state1, state2, dt):
+		"""Transforms (in place) the result of the step of length dt to the actual state"""
+		pass
 
-		res2 += (n_b * (-l22 / 2) + n_a * (-l12 / 2) -
-			1j * (n_b * g22_by_hbar + n_a * g12_by_hbar)) * state2 - \
-			0.5j * self._rabi_freq * \
-				numpy.exp(1j * (t * self._detuning + self._phi)) * state1
+	def _getStageBuffers(self, shape, dtype):
+		ws = self._workspace
+		return [(ws.get('k1_' + str(i), shape, dtype), ws.get('k2_' + str(i), shape, dtype))
+			for i in xrange(7)]
 
 	def _cpu__propagate_rk5(self, state1, state2, dt, t):
+		"""
+		Makes a trial step with the first stage derivatives already calculated.
+		The result is left in 'y1' and 'y2' buffers, the derivatives at the end
+		of the step are left in the last stage buffers.
+		Returns the maximum of the error, scaled by 'yscal1' and 'yscal2' buffers.
+		"""
+		ws = self._workspace
+		shape = state1.shape
+		dtype = state1.dtype
+
+		ks = self._getStageBuffers(shape, dtype)
+		ys = (ws.get('y1', shape, dtype), ws.get('y2', shape, dtype))
+		states = (state1, state2)
+		ctemp = ws.get('stage_temp', shape, dtype)
+
+		for i in xrange(1, 7):
+			for comp in (0, 1):
+				y = ys[comp]
+				y[...] = states[comp]
+				for j, coeff in enumerate(self._a[i]):
+					if coeff != 0:
+						numpy.multiply(ks[j][comp], coeff * dt, out=ctemp)
+						y += ctemp
+
+			self._propagationFuncInplace(ys[0], ys[1], ks[i][0], ks[i][1],
+				t + self._c[i] * dt, self._c[i] * dt)
+
+		# error of the embedded 4th order solution
+		delta = ws.get('delta', shape, dtype)
+		err = ws.get('err', shape, self._constants.scalar.dtype)
+		errmax = 0.0
+		for comp in (0, 1):
+			delta[...] = 0
+			for j, coeff in enumerate(self._e):
+				if coeff != 0:
+					numpy.multiply(ks[j][comp], coeff * dt, out=ctemp)
+					delta += ctemp
+
+			numpy.abs(delta, out=err)
+			err /= ws.get('yscal' + str(comp + 1), shape, err.dtype)
+			# numpy.maximum() propagates NaNs, unlike the builtin max()
+			errmax = numpy.maximum(errmax, err.max())
+
+		return errmax / self._eps
 
-		a = numpy.array([0, 0.2, 0.3, 0.6, 1, 0.875])
-		b = numpy.array([
-			[0, 0, 0, 0, 0],
-			[1.0 / 5, 0, 0, 0, 0],
-			[3.0 / 40, 9.0 / 40, 0, 0, 0],
-			[3.0 / 10, -9.0 / 10, 6.0 / 5, 0, 0],
-			[-11.0 / 54, 5.0 / 2, -70.0 / 27, 35.0 / 27, 0],
-			[1631.0 / 55296, 175.0 / 512, 575.0 / 13824, 44275.0 / 110592, 253.0 / 4096]
-		])
-		c = numpy.array([37.0 / 378, 0, 250.0 / 621, 125.0 / 594, 0, 512.0 / 1771])
-		cs = numpy.array([2825.0 / 27648, 0, 18575.0 / 48384.0, 13525.0 / 55296, 277.0 / 14336, 0.25])
-
-		k1s1, k1s2 = self._propagationFunc(state1, state2, t)
-		k1s1 *= dt
-		k1s2 *= dt
-
-		k2s1, k2s2 = self._propagationFunc(
-			state1 + b[1,0] * k1s1,
-			state2 + b[1,0] * k1s2, t + a[1] * dt)
-		k2s1 *= dt
-		k2s2 *= dt
-
-		k3s1, k3s2 = self._propagationFunc(
-			state1 + b[2,0] * k1s1 + b[2,1] * k2s1,
-			state2 + b[2,0] * k1s2 + b[2,1] * k2s2, t + a[2] * dt)
-		k3s1 *= dt
-		k3s2 *= dt
-
-		k4s1, k4s2 = self._propagationFunc(
-			state1 + b[3,0] * k1s1 + b[3,1] * k2s1 + b[3,2] * k3s1,
-			state2 + b[3,0] * k1s2 + b[3,1] * k2s2 + b[3,2] * k3s2, t + a[3] * dt)
-		k4s1 *= dt
-		k4s2 *= dt
-
-		k5s1, k5s2 = self._propagationFunc(
-			state1 + b[4,0] * k1s1 + b[4,1] * k2s1 + b[4,2] * k3s1 + b[4,3] * k4s1,
-			state2 + b[4,0] * k1s2 + b[4,1] * k2s2 + b[4,2] * k3s2 + b[4,3] * k4s2, t + a[4] * dt)
-		k5s1 *= dt
-		k5s2 *= dt
-
-		k6s1, k6s2 = self._propagationFunc(
-			state1 + b[5,0] * k1s1 + b[5,1] * k2s1 + b[5,2] * k3s1 + b[5,3] * k4s1 + b[5,4] * k5s1,
-			state2 + b[5,0] * k1s2 + b[5,1] * k2s2 + b[5,2] * k3s2 + b[5,3] * k4s2 + b[5,4] * k5s2, t + a[5] * dt)
-		k6s1 *= dt
-		k6s2 *= dt
-
-		y_s1 = state1 + c[0] * k1s1 + c[1] * k2s1 + c[2] * k3s1 + c[3] * k4s1 + c[4] * k5s1 + c[5] * k6s1
-		y_s2 = state2 + c[0] * k1s2 + c[1] * k2s2 + c[2] * k3s2 + c[3] * k4s2 + c[4] * k5s2 + c[5] * k6s2
-
-		ys_s1 = state1 + cs[0] * k1s1 + cs[1] * k2s1 + cs[2] * k3s1 + cs[3] * k4s1 + cs[4] * k5s1 + cs[5] * k6s1
-		ys_s2 = state2 + cs[0] * k1s2 + cs[1] * k2s2 + cs[2] * k3s2 + cs[3] * k4s2 + cs[4] * k5s2 + cs[5] * k6s2
-
-		delta_s1 = y_s1 - ys_s1
-		delta_s2 = y_s2 - ys_s2
-
-		return y_s1, y_s2, numpy.concatenate([delta_s1, delta_s2])
-
-	def _cpu__propagate_rk5_dynamic(self, state1, state2, t):
+	def _cpu__propagate_rk5_dynamic(self, state1, state2, t, remaining_time):
 
 		safety = 0.9
-		eps = self._eps # 1e-9
-		tiny = self._tiny # 1e-3
+		ws = self._workspace
+		shape = state1.data.shape
+		dtype = state1.data.dtype
+		sdtype = self._constants.scalar.dtype
+
+		ks = self._getStageBuffers(shape, dtype)
+		k1 = ks[0]
+		if self._fsal:
+			# the last stage of the previous step was calculated for its result;
+			# it is moved here and not at the end of the previous step,
+			# so that all stages are available for interpolation
+			k7 = ks[6]
+			k1[0][...] = k7[0]
+			k1[1][...] = k7[1]
+			self._transformDerivatives(k1[0], k1[1], self._dt_used)
+		else:
+			self._propagationFuncInplace(state1.data, state2.data, k1[0], k1[1], t, 0)
 
 		dt = self._dt
-
-		ds1, ds2 = self._propagationFunc(state1.data, state2.data, t)
-		yscal = numpy.concatenate([
-			numpy.abs(state1.data) + dt * numpy.abs(ds1),
-			numpy.abs(state2.data) + dt * numpy.abs(ds2)
-		]) + tiny
-
+		if remaining_time > 0:
+			dt = min(dt, remaining_time)
+
+		# yscal = abs(state) + dt * abs(derivative) + tiny
+		for comp, state in enumerate((state1.data, state2.data)):
+			yscal = ws.get('yscal' + str(comp + 1), shape, sdtype)
+			err = ws.get('err', shape, sdtype)
+			numpy.abs(k1[comp], out=err)
+			err *= dt
+			numpy.abs(state, out=yscal)
+			yscal += err
+			yscal += self._tiny
+
+		# number of retries after which a non-finite error is considered a divergence
+		max_rejections = 30
+
+		rejections = 0
 		while True:
-			#print "Trying with step " + str(dt)
-			s1, s2, delta_1 = self._propagate_rk5(state1.data, state2.data, dt, t)
-			errmax = numpy.abs(delta_1 / yscal).max() / eps
-			#print "Error: " + str(errmax)
+			errmax = self._propagate_rk5(state1.data, state2.data, dt, t)
+
+			if not numpy.isfinite(errmax):
+				# the state has diverged, or the step is far too large;
+				# the step size cannot be estimated from the error in this case
+				rejections += 1
+				if rejections >= max_rejections:
+					raise RuntimeError("Adaptive step failed at t = " + str(t) +
+						": error estimate is not finite")
+				dt *= 0.1
+				continue
+
 			if errmax < 1.0:
-				#print "Seems ok"
 				break
 
-			# reducing step size and retying step
+			# reducing step size and retrying step
 			dt_temp = safety * dt * (errmax ** (-0.25))
 			dt = max(dt_temp, 0.1 * dt)
 
-		dt_used = dt
+		self._dt_used = dt
 
 		if errmax > (5.0 / safety) ** (-1.0 / 0.2):
 			self._dt = safety * dt * (errmax ** (-0.2))
 		else:
 			self._dt = 5.0 * dt
 
-		state1.data.flat[:] = s1.flat
-		state2.data.flat[:] = s2.flat
-
-		return dt_used
-
-	def propagate(self, cloud, t, remaining_time):
-		return self._propagate_rk5_dynamic(cloud.a, cloud.b, t)
-
-	def run(self, *args, **kwds):
-		if 'starting_phase' in kwds:
-			starting_phase = kwds.pop('starting_phase')
-			self._phi = starting_phase
-		else:
-			self._phi = 0.0
-
-		shape = args[0].a.shape
-		dtype = args[0].a.dtype
-
-		self._a_kdata = self._env.allocate(shape, dtype=dtype)
-		self._b_kdata = self._env.allocate(shape, dtype=dtype)
-
-		Evolution.run(self, *args, **kwds)
+		if self._dense_output:
+			ws.get('y_start1', shape, dtype)[...] = state1.data
+			ws.get('y_start2', shape, dtype)[...] = state2.data
+
+		state1.data[...] = ws.get('y1', shape, dtype)
+		state2.data[...] = ws.get('y2', shape, dtype)
+		self._transformResult(state1.data, state2.data, dt)
+		self._fsal = True
+
+		return dt
+
+	def _cpu__interpolate(self, theta, res1, res2):
+		"""Calculates the state at the point theta (from 0 to 1) of the last step"""
+		ws = self._workspace
+		shape = res1.shape
+		dtype = res1.dtype
+		ks = self._getStageBuffers(shape, dtype)
+		ctemp = ws.get('stage_temp', shape, dtype)
+		dt = self._dt_used
+
+		for comp, res in enumerate((res1, res2)):
+			res[...] = ws.get('y_start' + str(comp + 1), shape, dtype)
+			for k, p in zip(ks, self._p):
+				coeff = sum(pj * theta ** (j + 1) for j, pj in enumerate(p))
+				if coeff != 0:
+					numpy.multiply(k[comp], coeff * dt, out=ctemp)
+					res += ctemp
+
+		self._transformResult(res1, res2, theta * dt)
+
+	def _interpolateCloud(self, cloud, t_start, t_end, t):
+		self._interpolate((t - t_start) / (t_end - t_start), cloud.a.data, cloud.b.data)
+		cloud.time = t
+
+	def _locateEvent(self, event, cloud, t_start, t_end, v_start, v_end):
+		"""
+		Finds the root of the event function inside the last step,
+		using Illinois method on the interpolated state (which is left in cloud).
+		"""
+		a, fa = t_start, v_start
+		b, fb = t_end, v_end
+		tolerance = (t_end - t_start) * 1e-10
 
+		for i in xrange(100):
+			c = (a * fb - b * fa) / (fb - fa)
+			self._interpolateCloud(cloud, t_start, t_end, c)
+			fc = event(c, cloud)
 
+			if fc == 0 or abs(c - b) < tolerance:
+				return c
 
+			if fc * fb < 0:
+				a, fa = b, fb
+			else:
+				fa /= 2
+			b, fb = c, fc
 
+		return c
 
+	def propagate(self, cloud, t, remaining_time):
+		return self._propagate_rk5_dynamic(cloud.a, cloud.b, t, remaining_time)
 
+	def _collectMetrics(self, t):
+		self._dts.append(self._dt_used)
+		self._dt_times.append(t)
 
+	def getTimeSteps(self):
+		return numpy.array(self._dt_times), numpy.array(self._dts)
 
+	def getAllocations(self):
+		"""Returns the number of buffers allocated by propagation so far"""
+		return self._workspace.allocations
+
+	def _getCheckpointState(self):
+		state = Evolution._getCheckpointState(self)
+		if self._fsal:
+			# derivatives at the beginning of the next step
+			k7 = self._getStageBuffers(self._a_kdata.shape, self._a_kdata.dtype)[6]
+			state['k7'] = [self._env.fromDevice(k) for k in k7]
+		return state
+
+	def _setCheckpointState(self, state):
+		state = dict(state)
+		k7_data = state.pop('k7', None)
+		Evolution._setCheckpointState(self, state)
+		if k7_data is not None:
+			k7 = self._getStageBuffers(self._a_kdata.shape, self._a_kdata.dtype)[6]
+			for k, data in zip(k7, k7_data):
+				self._env.copyBuffer(self._env.toDevice(data), dest=k)
+
+	def run(self, cloud, time, callbacks=None, callback_dt=0, events=None, starting_phase=0.0,
+			checkpoint=None, in_evolution_space=False):
+		"""
+		The evolution is performed in x-space, so in_evolution_space has no effect.
+		If callback_dt is not 0, callbacks are called at exact multiples of callback_dt,
+		using interpolation inside the steps, so they do not limit the step size.
+		events: list of functions event(t, cloud) returning a number;
+		the evolution stops at the first point where one of them changes sign
+		(the point is located by root finding on the interpolated state).
+		Returns the time at which the evolution stopped.
+		"""
+		self._phi = starting_phase
+		self._dt_used = 0
+		self._fsal = False
+
+		shape = cloud.a.shape
+		dtype = cloud.a.dtype
+		self._batch = cloud.a.size / self._constants.cells
+		self._a_kdata = self._workspace.get('a_kdata', shape, dtype)
+		self._b_kdata = self._workspace.get('b_kdata', shape, dtype)
+
+		events = [] if events is None else events
+		self._dense_output = bool(events) or (callbacks is not None and callback_dt > 0)
+		if self._dense_output:
+			interpolated = cloud.copy(prepare=False)
+
+		loop = self._popResumedLoop()
+		if loop is None:
+			starting_time = cloud.time
+			callbacks_done = 1
+		else:
+			starting_time = loop['starting_time']
+			callbacks_done = loop['callbacks_done']
+		ending_time = starting_time + time
 
+		failed = True
+		try:
+			if loop is None:
+				self._runCallbacks(cloud, callbacks)
+			values = [event(cloud.time, cloud) for event in events]
+
+			while cloud.time < ending_time:
+				t_start = cloud.time
+				remaining_time = ending_time - t_start
+				dt_used = self.propagate(cloud, t_start - starting_time, remaining_time)
+				self._collectMetrics(t_start)
+				t_end = ending_time if dt_used >= remaining_time else t_start + dt_used
+
+				stop_time = None
+				new_values = [event(t_end, cloud) for event in events]
+				for event, v_start, v_end in zip(events, values, new_values):
+					if v_start != 0 and v_start * v_end <= 0:
+						t = self._locateEvent(event, interpolated,
+							t_start, t_end, v_start, v_end)
+						stop_time = t if stop_time is None else min(stop_time, t)
+				values = new_values
+
+				if callbacks is not None and callback_dt > 0:
+					last_time = t_end if stop_time is None else stop_time
+					callback_time = starting_time + callbacks_done * callback_dt
+					while callback_time <= last_time + callback_dt * 1e-10:
+						self._interpolateCloud(interpolated, t_start, t_end, callback_time)
+						try:
+							self._runCallbacks(interpolated, callbacks)
+						except TerminateEvolution:
+							stop_time = callback_time
+							break
+						callbacks_done += 1
+						callback_time = starting_time + callbacks_done * callback_dt
+
+				if stop_time is not None:
+					self._interpolateCloud(interpolated, t_start, t_end, stop_time)
+					cloud.a.data[...] = interpolated.a.data
+					cloud.b.data[...] = interpolated.b.data
+					cloud.time = stop_time
+					break
 
+				cloud.time = t_end
+				if callbacks is not None and callback_dt == 0:
+					self._runCallbacks(cloud, callbacks)
+					# callbacks may have changed the state
+					self._fsal = False
 
+				if checkpoint is not None:
+					checkpoint.update(self, cloud, callbacks, dict(time=time,
+						callback_dt=callback_dt, starting_time=starting_time,
+						callbacks_done=callbacks_done))
 
+			# as in Evolution.run(), the final state is passed to callbacks
+			# if the evolution is shorter than the callback interval
+			if callback_dt > time and cloud.time >= ending_time:
+				self._runCallbacks(cloud, callbacks)
 
+			failed = False
 
+		except TerminateEvolution:
+			failed = False
 
+		finally:
+			self._finishRun(callbacks, checkpoint, failed)
 
+		self._dense_output = False
+		return cloud.time
 
 
-class RK5IPEvolution(Evolution):
+class RK5Evolution(AdaptiveRKEvolution):
 
-	def __init__(self, env, constants, dt=1e-6, eps=1e-6, tiny=1e-3, detuning=0, rabi_freq=0):
-		Evolution.__init__(self, env)
-		self._constants = constants
+	def __init__(self, env, constants, dt=1e-6, eps=1e-9, tiny=1e-3, detuning=0, rabi_freq=0):
+		AdaptiveRKEvolution.__init__(self, env, constants, dt, eps, tiny, detuning, rabi_freq)
 
-		# FIXME: implement adaptive time step propagation
-		self._dt = dt
-		self._eps = eps
-		self._tiny = tiny
+	def _propagationFuncInplace(self, state1, state2, res1, res2, t, dt):
 
-		self._detuning = 2 * math.pi * detuning
-		self._rabi_freq = 2 * math.pi * rabi_freq
+		# kinetic term
+		k = self._kvectors
+		for state, kdata, res in ((state1, self._a_kdata, res1), (state2, self._b_kdata, res2)):
+			self._plan.execute(state, kdata, batch=self._batch, inverse=True)
+			view = ensembleView(kdata, k.shape)
+			view *= k
+			self._plan.execute(kdata, res, batch=self._batch)
 
-		self._plan = createFFTPlan(env, constants.shape, constants.complex.dtype)
+		# potential term
+		p = self._potentials
+		ctemp = self._workspace.get('ctemp', state1.shape, state1.dtype)
+		for state, res in ((state1, res1), (state2, res2)):
+			numpy.multiply(ensembleView(state, p.shape), p, out=ensembleView(ctemp, p.shape))
+			res += ctemp
+			res *= -1j
 
-		self._potentials = getPotentials(self._env, self._constants)
-		self._kvectors = getKVectors(self._env, self._constants)
+		self._addNonlinearTerms(state1, state2, res1, res2, t)
 
-		self._dt_times = []
-		self._dts = []
 
-		self._prepare()
+class RK5IPEvolution(AdaptiveRKEvolution):
 
-	def _cpu__prepare(self):
-		pass
+	def __init__(self, env, constants, dt=1e-6, eps=1e-6, tiny=1e-3, detuning=0, rabi_freq=0):
+		AdaptiveRKEvolution.__init__(self, env, constants, dt, eps, tiny, detuning, rabi_freq)
 
-	def _propagationFunc(self, state1, state2, t, dt):
-		res1 = numpy.empty_like(state1)
-		res2 = numpy.empty_like(state2)
-		self._propagationFuncInplace(state1, state2, res1, res2, t, dt)
-		return res1, res2
+		# k-space coefficients for interaction picture transformations, cached by dt
+		self._ip_coeffs = {}
 
 	def _propagationFuncInplace(self, state1, state2, res1, res2, t, dt):
 
-		batch = 1 # FIXME: hardcoding
-		nvz = self._constants.nvz
-
-		# FIXME: remove hardcoding (g must depend on cloud.a.comp and cloud.b.comp)
-		g_by_hbar = self._constants.g_by_hbar
-		g11_by_hbar = g_by_hbar[(COMP_1_minus1, COMP_1_minus1)]
-		g12_by_hbar = g_by_hbar[(COMP_1_minus1, COMP_2_1)]
-		g22_by_hbar = g_by_hbar[(COMP_2_1, COMP_2_1)]
-
-		l111 = self._constants.l111
-		l12 = self._constants.l12
-		l22 = self._constants.l22
-
 		x1 = self._a_kdata
 		x2 = self._b_kdata
 
 		self._fromIP(state1, state2, x1, x2, dt)
 
-		n_a = numpy.abs(x1) ** 2
-		n_b = numpy.abs(x2) ** 2
-
-		for e in xrange(batch):
-			start = e * nvz
-			stop = (e + 1) * nvz
-			res1[start:stop,:,:] = -1j * (x1[start:stop,:,:] * self._potentials)
-			res2[start:stop,:,:] = -1j * (x2[start:stop,:,:] * self._potentials)
-
-		res1 += (n_a * n_a * (-l111 / 2) + n_b * (-l12 / 2) -
-			1j * (n_a * g11_by_hbar + n_b * g12_by_hbar)) * x1 - \
-			0.5j * self._rabi_freq * \
-				numpy.exp(1j * (- t * self._detuning - self._phi)) * x2
+		p = self._potentials
+		for x, res in ((x1, res1), (x2, res2)):
+			view = ensembleView(res, p.shape)
+			numpy.multiply(ensembleView(x, p.shape), p, out=view)
+			res *= -1j
 
-		res2 += (n_b * (-l22 / 2) + n_a * (-l12 / 2) -
-			1j * (n_b * g22_by_hbar + n_a * g12_by_hbar)) * x2 - \
-			0.5j * self._rabi_freq * \
-				numpy.exp(1j * (t * self._detuning + self._phi)) * x1
+		self._addNonlinearTerms(x1, x2, res1, res2, t)
 
 		self._toIP(res1, res2, res1, res2, dt)
 
-	def _cpu__propagate_rk5(self, state1, state2, dt, t):
-
-		a = numpy.array([0, 0.2, 0.3, 0.6, 1, 0.875])
-		b = numpy.array([
-			[0, 0, 0, 0, 0],
-			[1.0 / 5, 0, 0, 0, 0],
-			[3.0 / 40, 9.0 / 40, 0, 0, 0],
-			[3.0 / 10, -9.0 / 10, 6.0 / 5, 0, 0],
-			[-11.0 / 54, 5.0 / 2, -70.0 / 27, 35.0 / 27, 0],
-			[1631.0 / 55296, 175.0 / 512, 575.0 / 13824, 44275.0 / 110592, 253.0 / 4096]
-		])
-		c = numpy.array([37.0 / 378, 0, 250.0 / 621, 125.0 / 594, 0, 512.0 / 1771])
-		cs = numpy.array([2825.0 / 27648, 0, 18575.0 / 48384.0, 13525.0 / 55296, 277.0 / 14336, 0.25])
-
-		k1s1, k1s2 = self._propagationFunc(state1, state2, t, 0)
-		k1s1 *= dt
-		k1s2 *= dt
-
-		k2s1, k2s2 = self._propagationFunc(
-			state1 + b[1,0] * k1s1,
-			state2 + b[1,0] * k1s2, t + a[1] * dt, a[1] * dt)
-		k2s1 *= dt
-		k2s2 *= dt
-
-		k3s1, k3s2 = self._propagationFunc(
-			state1 + b[2,0] * k1s1 + b[2,1] * k2s1,
-			state2 + b[2,0] * k1s2 + b[2,1] * k2s2, t + a[2] * dt, a[2] * dt)
-		k3s1 *= dt
-		k3s2 *= dt
-
-		k4s1, k4s2 = self._propagationFunc(
-			state1 + b[3,0] * k1s1 + b[3,1] * k2s1 + b[3,2] * k3s1,
-			state2 + b[3,0] * k1s2 + b[3,1] * k2s2 + b[3,2] * k3s2, t + a[3] * dt, a[3] * dt)
-		k4s1 *= dt
-		k4s2 *= dt
-
-		k5s1, k5s2 = self._propagationFunc(
-			state1 + b[4,0] * k1s1 + b[4,1] * k2s1 + b[4,2] * k3s1 + b[4,3] * k4s1,
-			state2 + b[4,0] * k1s2 + b[4,1] * k2s2 + b[4,2] * k3s2 + b[4,3] * k4s2, t + a[4] * dt, a[4] * dt)
-		k5s1 *= dt
-		k5s2 *= dt
-
-		k6s1, k6s2 = self._propagationFunc(
-			state1 + b[5,0] * k1s1 + b[5,1] * k2s1 + b[5,2] * k3s1 + b[5,3] * k4s1 + b[5,4] * k5s1,
-			state2 + b[5,0] * k1s2 + b[5,1] * k2s2 + b[5,2] * k3s2 + b[5,3] * k4s2 + b[5,4] * k5s2, t + a[5] * dt, a[5] * dt)
-		k6s1 *= dt
-		k6s2 *= dt
-
-		y_s1 = state1 + c[0] * k1s1 + c[1] * k2s1 + c[2] * k3s1 + c[3] * k4s1 + c[4] * k5s1 + c[5] * k6s1
-		y_s2 = state2 + c[0] * k1s2 + c[1] * k2s2 + c[2] * k3s2 + c[3] * k4s2 + c[4] * k5s2 + c[5] * k6s2
-
-		ys_s1 = state1 + cs[0] * k1s1 + cs[1] * k2s1 + cs[2] * k3s1 + cs[3] * k4s1 + cs[4] * k5s1 + cs[5] * k6s1
-		ys_s2 = state2 + cs[0] * k1s2 + cs[1] * k2s2 + cs[2] * k3s2 + cs[3] * k4s2 + cs[4] * k5s2 + cs[5] * k6s2
-
-		delta_s1 = y_s1 - ys_s1
-		delta_s2 = y_s2 - ys_s2
-
-		return y_s1, y_s2, numpy.concatenate([delta_s1, delta_s2])
-
-	def _cpu__propagate_rk5_dynamic(self, state1, state2, t, remaining_time):
-
-		safety = 0.9
-		eps = self._eps # 1e-9
-		tiny = self._tiny # 1e-3
-
-		dt = self._dt
-
-		ds1, ds2 = self._propagationFunc(state1.data, state2.data, t, 0)
-		yscal = numpy.concatenate([
-			numpy.abs(state1.data) + dt * numpy.abs(ds1),
-			numpy.abs(state2.data) + dt * numpy.abs(ds2)
-		]) + tiny
+	def _transformDerivatives(self, res1, res2, dt):
+		# derivatives in the interaction picture of the finished step
+		# are transformed to the one of the next step
+		self._fromIP(res1, res2, res1, res2, dt)
 
-		while True:
-			#print "Trying with step " + str(dt)
-			s1, s2, delta_1 = self._propagate_rk5(state1.data, state2.data, dt, t)
-			errmax = numpy.abs(delta_1 / yscal).max() / eps
-			#print "Error: " + str(errmax)
-			if errmax < 1.0:
-				if dt > remaining_time:
-					# Step is fine in terms of error, but bigger then necessary
-					dt = remaining_time
-					continue
-				else:
-					#print "Seems ok"
-					break
+	def _transformResult(self, state1, state2, dt):
+		self._fromIP(state1, state2, state1, state2, dt)
 
-			# reducing step size and retying step
-			dt_temp = safety * dt * (errmax ** (-0.25))
-			dt = max(dt_temp, 0.1 * dt)
-
-		self._dt_used = dt
-
-		if errmax > (5.0 / safety) ** (-1.0 / 0.2):
-			self._dt = safety * dt * (errmax ** (-0.2))
-		else:
-			self._dt = 5.0 * dt
-
-		state1.data.flat[:] = s1.flat
-		state2.data.flat[:] = s2.flat
-
-		self._fromIP(state1.data, state2.data, state1.data, state2.data, self._dt_used)
-
-		#print numpy.sum(numpy.abs(state1.data) ** 2) * self._constants.dV, \
-		#	numpy.sum(numpy.abs(state2.data) ** 2) * self._constants.dV
+	def _getIPCoeffs(self, dt):
+		"""
+		Returns k-space coefficients for transformation to and from
+		the interaction picture for given time step.
+		"""
+		if dt not in self._ip_coeffs:
+			# do not let the cache grow indefinitely, since time step is adaptive
+			if len(self._ip_coeffs) >= 16:
+				self._ip_coeffs.clear()
 
-		#raw_input()
+			dtype = self._constants.complex.dtype
+			from_coeff = numpy.exp(self._kvectors * (-1j * dt))
+			self._ip_coeffs[dt] = (from_coeff.conj().astype(dtype), from_coeff.astype(dtype))
 
-		return self._dt_used
+		return self._ip_coeffs[dt]
 
 	def _toIP(self, s1, s2, res1, res2, dt):
 		if dt == 0.0:
-			res1.flat[:] = s1.flat[:]
-			res2.flat[:] = s2.flat[:]
+			if res1 is not s1:
+				res1[...] = s1
+				res2[...] = s2
 			return
 
 		self._plan.execute(s1, res1, inverse=True, batch=self._batch)
 		self._plan.execute(s2, res2, inverse=True, batch=self._batch)
 
-		kcoeff = numpy.exp(self._kvectors * (1j * dt))
-		nvz = self._constants.nvz
-
-		for e in xrange(self._batch):
-			start = e * nvz
-			stop = (e + 1) * nvz
-			res1[start:stop,:,:] *= kcoeff
-			res2[start:stop,:,:] *= kcoeff
+		kcoeff = self._getIPCoeffs(dt)[0]
+		for res in (res1, res2):
+			view = ensembleView(res, kcoeff.shape)
+			view *= kcoeff
 
 		self._plan.execute(res1, batch=self._batch)
 		self._plan.execute(res2, batch=self._batch)
 
 	def _fromIP(self, s1, s2, res1, res2, dt):
 		if dt == 0.0:
-			res1.flat[:] = s1.flat[:]
-			res2.flat[:] = s2.flat[:]
+			if res1 is not s1:
+				res1[...] = s1
+				res2[...] = s2
 			return
 
 		self._plan.execute(s1, res1, inverse=True, batch=self._batch)
 		self._plan.execute(s2, res2, inverse=True, batch=self._batch)
 
-		kcoeff = numpy.exp(self._kvectors * (-1j * dt))
-		nvz = self._constants.nvz
-
-		for e in xrange(self._batch):
-			start = e * nvz
-			stop = (e + 1) * nvz
-			res1[start:stop,:,:] *= kcoeff
-			res2[start:stop,:,:] *= kcoeff
+		kcoeff = self._getIPCoeffs(dt)[1]
+		for res in (res1, res2):
+			view = ensembleView(res, kcoeff.shape)
+			view *= kcoeff
 
 		self._plan.execute(res1, batch=self._batch)
 		self._plan.execute(res2, batch=self._batch)
-
-	def propagate(self, cloud, t, remaining_time):
-		return self._propagate_rk5_dynamic(cloud.a, cloud.b, t, remaining_time)
-
-	def _collectMetrics(self, t):
-		self._dts.append(self._dt_used)
-		self._dt_times.append(t)
-
-	def getTimeSteps(self):
-		return numpy.array(self._dt_times), numpy.array(self._dts)
-
-	def run(self, *args, **kwds):
-		if 'starting_phase' in kwds:
-			starting_phase = kwds.pop('starting_phase')
-			self._phi = starting_phase
-		else:
-			self._phi = 0.0
-
-		self._dt_used = 0
-		shape = args[0].a.shape
-		dtype = args[0].a.dtype
-
-		self._batch = args[0].a.size / self._constants.cells
-
-		self._a_kdata = self._env.allocate(shape, dtype=dtype)
-		self._b_kdata = self._env.allocate(shape, dtype=dtype)
-
-		Evolution.run(self, *args, **kwds)
@@ -8,7 +8,7 @@ import numpy
 from .helpers import *
 from .wavefunction import Wavefunction, TwoComponentCloud
 from .meters import ParticleStatistics
-from .constants import getPotentials, UniformGrid, HarmonicGrid
+from .constants import getPotentials, getPlaneWaveEnergy, getPlan, UniformGrid, HarmonicGrid
 
 
 class TFGroundState(PairedCalculation):
@@ -21,11 +21,11 @@ class TFGroundState(PairedCalculation):
 		PairedCalculation.__init__(self, env)
 		self._constants = constants.copy()
 		self._grid = grid.copy()
-		self._potentials = getPotentials(env, constants, grid)
+		self._potentials = getPotentials(env, self._constants, self._grid)
 		self._stats = ParticleStatistics(env, constants, grid)
 
 		if isinstance(grid, HarmonicGrid):
-			self._plan = createFHTPlan(env, constants, grid, 1)
+			self._plan = getPlan(env, self._constants, self._grid)
 
 		self._prepare()
 
@@ -109,27 +109,80 @@ class TFGroundState(PairedCalculation):
 		return res
 
 
+def _getInterpolationMatrix(x_from, x_to):
+	"""
+	Returns matrix of spectral (trigonometric) interpolation
+	from the uniform 1D grid x_from to the grid x_to.
+	"""
+	n = x_from.size
+	dx = x_from[1] - x_from[0]
+	k = numpy.fft.fftfreq(n, dx) * 2.0 * numpy.pi
+
+	# Nyquist harmonic cannot be interpolated unambiguously
+	if n % 2 == 0:
+		k = numpy.delete(k, n / 2)
+
+	e_from = numpy.exp(1j * numpy.outer(x_from - x_from[0], k))
+	e_to = numpy.exp(1j * numpy.outer(x_to - x_from[0], k))
+	return numpy.dot(e_to, e_from.conj().T) / n
+
+def _interpolate(data, grid_from, grid_to):
+	"""Spectrally interpolates x-space data (without ensemble dimension) to another grid"""
+	if grid_from.dim == 1:
+		axes = [(grid_from.z, grid_to.z)]
+	else:
+		axes = [(grid_from.z, grid_to.z), (grid_from.y, grid_to.y), (grid_from.x, grid_to.x)]
+
+	for i, (x_from, x_to) in enumerate(axes):
+		m = _getInterpolationMatrix(x_from, x_to)
+		data = numpy.rollaxis(numpy.tensordot(m, data, axes=([1], [i])), 0, i + 1)
+
+	return data
+
+
 class GPEGroundState(PairedCalculation):
 	"""
-	Calculates GPE ground state using split-step propagation in imaginary time.
+	Calculates GPE ground state using split-step propagation in imaginary time
+	or direct minimization of energy.
 	"""
 
-	def __init__(self, env, constants):
+	def __init__(self, env, constants, grid, dt=2e-5, cache=True, multigrid=0,
+			method='imaginary_time'):
+		"""
+		dt: imaginary time step
+		method: 'imaginary_time' for split-step propagation in imaginary time
+		(precision is the relative change of energy during one step),
+		or 'cg' for minimization of energy using preconditioned nonlinear
+		conjugate gradients (precision is the relative norm of the residual H psi - mu psi)
+		cache: if True, converged states are saved on disk and reused
+		when the state with the same parameters is requested again
+		multigrid: number of coarser levels; the state is first found on the grid
+		twice smaller along every axis (recursively), interpolated to this grid
+		and used as the initial approximation
+		"""
 		PairedCalculation.__init__(self, env)
 		self._env = env
-		self._constants = constants
+		self._constants = constants.copy()
+		self._grid = grid.copy()
+		self._dt = dt
+		self._multigrid = multigrid
+		assert method in ('imaginary_time', 'cg')
+		self._method = method
+		self._cache = DiskCache('ground_states') if cache else None
 
-		self._tf_gs = TFGroundState(env, constants)
-		self._plan = createFFTPlan(env, constants.shape, constants.complex.dtype)
-		self._statistics = ParticleStatistics(env, constants)
+		self._tf_gs = TFGroundState(env, constants, grid)
 
-		self._potentials = getPotentials(env, constants)
-		self._kvectors = getKVectors(env, constants)
+		self._potentials = getPotentials(env, self._constants, self._grid)
+		self._energy = getPlaneWaveEnergy(env, self._constants, self._grid)
+
+		# host copies for calculation of invariants
+		self._h_potentials = getPotentials(None, self._constants, self._grid)
+		self._h_energy = getPlaneWaveEnergy(None, self._constants, self._grid)
 
 		self._prepare()
 
 	def _cpu__prepare(self):
-		self._k_coeff = numpy.exp(self._kvectors * (-self._constants.dt_steady / 2))
+		self._k_coeff = numpy.exp(self._energy * (-self._dt / 2))
 
 	def _gpu__prepare(self):
 		kernel_template = """
@@ -149,14 +202,13 @@ class GPEGroundState(PairedCalculation):
 
 			// Propagates state vector in k-space for steady state calculation (i.e., in imaginary time)
 			EXPORTED_FUNC void propagateKSpace(GLOBAL_MEM COMPLEX *data,
-				GLOBAL_MEM SCALAR *kvectors)
+				GLOBAL_MEM SCALAR *energy)
 			{
 				DEFINE_INDEXES;
 
-				SCALAR kvector = kvectors[cell_index];
+				SCALAR e = energy[cell_index];
 
-				SCALAR prop_coeff = exp(kvector *
-					(SCALAR)${-c.dt_steady / 2.0});
+				SCALAR prop_coeff = exp(e * (SCALAR)${-dt / 2.0});
 				COMPLEX temp = data[index];
 				data[index] = complex_mul_scalar(temp, prop_coeff);
 			}
@@ -165,14 +217,13 @@ class GPEGroundState(PairedCalculation):
 			// Version for processing two components at once
 			EXPORTED_FUNC void propagateKSpace2(
 				GLOBAL_MEM COMPLEX *data1, GLOBAL_MEM COMPLEX *data2,
-				GLOBAL_MEM SCALAR *kvectors)
+				GLOBAL_MEM SCALAR *energy)
 			{
 				DEFINE_INDEXES;
 
-				SCALAR kvector = kvectors[cell_index];
+				SCALAR e = energy[cell_index];
 
-				SCALAR prop_coeff = exp(kvector *
-					(SCALAR)${-c.dt_steady / 2.0});
+				SCALAR prop_coeff = exp(e * (SCALAR)${-dt / 2.0});
 
 				data1[index] = complex_mul_scalar(data1[index], prop_coeff);
 				data2[index] = complex_mul_scalar(data2[index], prop_coeff);
@@ -195,7 +246,7 @@ class GPEGroundState(PairedCalculation):
 				//iterate to midpoint solution
 				%for iter in range(c.itmax):
 					//calculate midpoint log derivative and exponentiate
-					da = exp((SCALAR)${c.dt_steady / 2.0} *
+					da = exp((SCALAR)${dt / 2.0} *
 						(-V - g_by_hbar * squared_abs(a)));
 
 					//propagate to midpoint using log derivative
@@ -230,9 +281,9 @@ class GPEGroundState(PairedCalculation):
 					a_density = squared_abs(a_res);
 					b_density = squared_abs(b_res);
 
-					da = exp((SCALAR)${c.dt_steady / 2.0} *
+					da = exp((SCALAR)${dt / 2.0} *
 						(-V - g11_by_hbar * a_density - g12_by_hbar * b_density));
-					db = exp((SCALAR)${c.dt_steady / 2.0} *
+					db = exp((SCALAR)${dt / 2.0} *
 						(-V - g12_by_hbar * a_density - g22_by_hbar * b_density));
 
 					//propagate to midpoint using log derivative
@@ -246,7 +297,8 @@ class GPEGroundState(PairedCalculation):
 			}
 		"""
 
-		self._program = self._env.compileProgram(kernel_template, self._constants)
+		self._program = self._env.compileProgram(kernel_template, self._constants, self._grid,
+			dt=self._dt)
 
 		self._propagateKSpace = self._program.propagateKSpace
 		self._propagateKSpace2 = self._program.propagateKSpace2
@@ -263,22 +315,25 @@ class GPEGroundState(PairedCalculation):
 
 	def _gpu__kpropagate(self, state1, state2):
 		if state2 is None:
-			self._propagateKSpace(state1.size, state1.data, self._kvectors)
+			self._propagateKSpace(state1.size, state1.data, self._energy)
 		else:
-			self._propagateKSpace2(state1.size, state1.data, state2.data, self._kvectors)
+			self._propagateKSpace2(state1.size, state1.data, state2.data, self._energy)
+
+	def _getGByHbar(self, comp1, comp2):
+		return self._constants.g[comp1, comp2] / self._constants.hbar
 
 	def _cpu__xpropagate(self, state1, state2):
 		p = self._potentials
-		dt = -self._constants.dt_steady / 2
+		dt = -self._dt / 2
 
 		if state2 is None:
 			a0 = state1.data.copy()
-			g_by_hbar = self._constants.g_by_hbar[(state1.comp, state1.comp)]
+			g_by_hbar = self._getGByHbar(state1.comp, state1.comp)
 
 			for iter in xrange(self._constants.itmax):
 				n = numpy.abs(state1.data) ** 2
 				da = numpy.exp((p + n * g_by_hbar) * dt)
-				state1.data = a0 * da
+				state1.data[:] = a0 * da
 			state1.data *= da
 		else:
 			a0 = state1.data.copy()
@@ -286,10 +341,9 @@ class GPEGroundState(PairedCalculation):
 
 			comp1 = state1.comp
 			comp2 = state2.comp
-			g_by_hbar = self._constants.g_by_hbar
-			g11_by_hbar = g_by_hbar[(comp1, comp1)]
-			g12_by_hbar = g_by_hbar[(comp1, comp2)]
-			g22_by_hbar = g_by_hbar[(comp2, comp2)]
+			g11_by_hbar = self._getGByHbar(comp1, comp1)
+			g12_by_hbar = self._getGByHbar(comp1, comp2)
+			g22_by_hbar = self._getGByHbar(comp2, comp2)
 
 			for iter in xrange(self._constants.itmax):
 				na = numpy.abs(state1.data) ** 2
@@ -301,8 +355,8 @@ class GPEGroundState(PairedCalculation):
 				da = numpy.exp(pa * dt)
 				db = numpy.exp(pb * dt)
 
-				state1.data = a0 * da
-				state2.data = b0 * db
+				state1.data[:] = a0 * da
+				state2.data[:] = b0 * db
 
 			state1.data *= da
 			state2.data *= db
@@ -310,16 +364,15 @@ class GPEGroundState(PairedCalculation):
 	def _gpu__xpropagate(self, state1, state2):
 		cast = self._constants.scalar.cast
 		if state2 is None:
-			g_by_hbar = self._constants.g_by_hbar[(state1.comp, state1.comp)]
+			g_by_hbar = self._getGByHbar(state1.comp, state1.comp)
 			self._propagateXSpace(state1.size, state1.data, self._potentials,
 				cast(g_by_hbar))
 		else:
 			comp1 = state1.comp
 			comp2 = state2.comp
-			g_by_hbar = self._constants.g_by_hbar
-			g11_by_hbar = g_by_hbar[(comp1, comp1)]
-			g12_by_hbar = g_by_hbar[(comp1, comp2)]
-			g22_by_hbar = g_by_hbar[(comp2, comp2)]
+			g11_by_hbar = self._getGByHbar(comp1, comp1)
+			g12_by_hbar = self._getGByHbar(comp1, comp2)
+			g22_by_hbar = self._getGByHbar(comp2, comp2)
 
 			self._propagateXSpace2(state1.size, state1.data, state2.data,
 				self._potentials, cast(g11_by_hbar), cast(g22_by_hbar), cast(g12_by_hbar))
@@ -341,49 +394,181 @@ class GPEGroundState(PairedCalculation):
 			self._multiply2(state1.size, state1.data, state2.data, cast(c1), cast(c2))
 
 	def _toXSpace(self, state1, state2):
-		self._plan.execute(state1.data)
+		state1.toXSpace()
 		if state2 is not None:
-			self._plan.execute(state2.data)
+			state2.toXSpace()
 
-	def _toKSpace(self, state1, state2):
-		self._plan.execute(state1.data, inverse=True)
+	def _toMSpace(self, state1, state2):
+		state1.toMSpace()
 		if state2 is not None:
-			self._plan.execute(state2.data, inverse=True)
+			state2.toMSpace()
+
+	def _getN(self, state):
+		data = self._env.fromDevice(state.data)[0]
+		return (numpy.abs(data) ** 2 * self._grid.dV).sum()
+
+	def _getEnergy(self, states, N):
+		"""Returns energy per particle of x-space states"""
+		c = self._constants
+		grid = self._grid
 
-	def _create(self, two_component=False, comp=0, ratio=0.5,
+		datas = [self._env.fromDevice(state.data)[0] for state in states]
+		densities = [numpy.abs(data) ** 2 for data in datas]
+
+		# kinetic term is calculated in mode space (using Parseval's theorem)
+		E = 0
+		for data, density in zip(datas, densities):
+			kinetic = (numpy.abs(numpy.fft.fftn(data)) ** 2 * self._h_energy).sum() * \
+				grid.dV_uniform / grid.size
+			potential = (self._h_potentials * density * grid.dV).sum()
+			E += c.hbar * (kinetic + potential)
+
+		for i, state1 in enumerate(states):
+			for j, state2 in enumerate(states):
+				E += (c.g[state1.comp, state2.comp] / 2 *
+					densities[i] * densities[j] * grid.dV).sum()
+
+		return E / N
+
+	def _getCoarseGrid(self):
+		"""Returns the grid for the next multigrid level, or None"""
+		if self._multigrid == 0:
+			return None
+
+		# grids smaller than this do not resolve the cloud well enough
+		# to be a useful approximation
+		min_points = 8
+
+		shape = tuple(max(n / 2, min(n, min_points)) for n in self._grid.shape)
+		if shape == self._grid.shape:
+			return None
+
+		return UniformGrid(self._env, self._constants, shape, self._grid.box_size)
+
+	def _getCacheKey(self, N, two_component, comp, ratio, precision):
+		return getFingerprint('GPEGroundState', getPlainAttributes(self._constants),
+			self._constants.complex.dtype, self._grid.shape, self._grid.box_size,
+			self._dt, self._multigrid, self._method, N, two_component, comp,
+			ratio if two_component else None, precision)
+
+	def _createState(self, comp, data=None):
+		state = Wavefunction(self._env, self._constants, self._grid, comp=comp)
+		if data is not None:
+			data = data.reshape(state.shape).astype(self._constants.complex.dtype)
+			self._env.copyBuffer(self._env.toDevice(data), dest=state.data)
+		return state
+
+	def _create(self, N, two_component=False, comp=0, ratio=0.5,
 			precision=1e-6, verbose=True):
 
-		assert not two_component or comp == COMP_1_minus1
+		if self._cache is None:
+			return self._calculate(N, two_component=two_component, comp=comp, ratio=ratio,
+				precision=precision, verbose=verbose)
 
-		desired_N1 = self._constants.N * ratio
-		desired_N2 = self._constants.N * (1 - ratio)
+		key = self._getCacheKey(N, two_component, comp, ratio, precision)
+		arrays = self._cache.get(key)
 
-		if two_component:
+		if arrays is None:
+			state1, state2 = self._calculate(N, two_component=two_component, comp=comp,
+				ratio=ratio, precision=precision, verbose=verbose)
+
+			arrays = dict(a=self._env.fromDevice(state1.data))
+			if state2 is not None:
+				arrays['b'] = self._env.fromDevice(state2.data)
+			self._cache.put(key, arrays)
+
+			return state1, state2
+
+		state1 = self._createState(comp, data=arrays['a'])
+		state2 = self._createState(1, data=arrays['b']) if two_component else None
+
+		if verbose:
+			print "Ground state loaded from cache"
+
+		return state1, state2
+
+	def _calculate(self, N, two_component=False, comp=0, ratio=0.5,
+			precision=1e-6, verbose=True):
+
+		assert not two_component or comp == 0
+
+		coarse_grid = self._getCoarseGrid()
+
+		if coarse_grid is not None:
+			coarse_gs = GPEGroundState(self._env, self._constants, coarse_grid,
+				dt=self._dt, cache=False, multigrid=self._multigrid - 1, method=self._method)
+			coarse1, coarse2 = coarse_gs._calculate(N, two_component=two_component, comp=comp,
+				ratio=ratio, precision=precision, verbose=verbose)
+
+			interpolate = lambda state: _interpolate(
+				self._env.fromDevice(state.data)[0], coarse_grid, self._grid)
+
+			state1 = self._createState(comp, data=interpolate(coarse1))
+			state2 = self._createState(1, data=interpolate(coarse2)) if two_component else None
+
+		elif two_component:
 			# it would be nice to use two-component TF state here,
 			# but the formula is quite complex, and it is much easier
 			# just to start from uniform distribution
 			# (not two one-component TF-states, because in case of
 			# immiscible regime they are far from ground state)
-
-			state1 = State(self._env, self._constants, comp=comp)
-			state1.fillWithOnes()
-
-			state2 = State(self._env, self._constants, comp=COMP_2_1)
-			state2.fillWithOnes()
+			ones = numpy.ones(self._grid.shape)
+			state1 = self._createState(comp, data=ones)
+			state2 = self._createState(1, data=ones)
 		else:
 			# TF state is a good first approximation in case of one-component cloud
-			state1 = self._tf_gs.create(comp=comp, N=self._constants.N)
+			state1 = self._tf_gs.create(N, comp=comp)
 			state2 = None
 
-		stats = self._statistics
-		E = 0
-
 		if two_component:
-			new_E = stats.countEnergyTwoComponent(state1, state2)
+			desired_N = (N * ratio, N * (1 - ratio))
+			states = [state1, state2]
+		else:
+			desired_N = (N,)
+			states = [state1]
+
+		def renormalize():
+			coeffs = [numpy.sqrt(desired / self._getN(state))
+				for state, desired in zip(states, desired_N)]
+			self._renormalize(state1, state2, coeffs[0] if state2 is None else coeffs)
+
+		# initial approximation is not necessarily normalized
+		renormalize()
+
+		if self._method == 'cg':
+			iterations = self._minimize(states, desired_N, precision)
+			renormalize()
 		else:
-			new_E = stats.countEnergy(state1)
+			iterations = self._propagate(states, N, renormalize, precision)
+
+		if verbose:
+			datas = [self._env.fromDevice(state.data)[0] for state in states]
+			comps = [state.comp for state in states]
+			residual = self._getResidual(datas, comps)
+
+			print "Ground state calculation (" + \
+				("two components" if two_component else "one component") + \
+				", grid " + str(self._grid.shape) + "):" + \
+				" N = " + " + ".join(str(self._getN(state)) for state in states) + \
+				" E = " + str(self._getEnergy(states, N)) + \
+				" residual = " + str(residual) + \
+				" iterations = " + str(iterations)
+
+		return state1, state2
+
+	def _propagate(self, states, N, renormalize, precision):
+		"""
+		Propagates states in imaginary time until the relative change of energy
+		becomes less than precision. Returns the number of iterations.
+		"""
+		state1 = states[0]
+		state2 = states[1] if len(states) > 1 else None
+
+		E = 0
+		new_E = self._getEnergy(states, N)
+		iterations = 0
 
-		self._toKSpace(state1, state2)
+		self._toMSpace(state1, state2)
 
 		while abs(E - new_E) / new_E > precision:
 
@@ -391,53 +576,180 @@ class GPEGroundState(PairedCalculation):
 			self._kpropagate(state1, state2)
 			self._toXSpace(state1, state2)
 			self._xpropagate(state1, state2)
-			self._toKSpace(state1, state2)
+			self._toMSpace(state1, state2)
 			self._kpropagate(state1, state2)
 
 			# normalization
-
 			self._toXSpace(state1, state2)
-
-			# renormalize
-			if two_component:
-				N1 = stats.countParticles(state1)
-				N2 = stats.countParticles(state2)
-				c1 = math.sqrt(desired_N1 / N1)
-				c2 = math.sqrt(desired_N2 / N2)
-				self._renormalize(state1, state2, (c1, c2))
-			else:
-				N = stats.countParticles(state1)
-				self._renormalize(state1, state2, math.sqrt(self._constants.N / N))
+			renormalize()
 
 			E = new_E
-			if two_component:
-				new_E = stats.countEnergyTwoComponent(state1, state2, N=self._constants.N)
-			else:
-				new_E = stats.countEnergy(state1, N=self._constants.N)
+			new_E = self._getEnergy(states, N)
+			iterations += 1
 
-			self._toKSpace(state1, state2)
+			self._toMSpace(state1, state2)
 
 		self._toXSpace(state1, state2)
 
-		if verbose:
-			if two_component:
-				print "Ground state calculation (two components):" + \
-					" N = " + str(stats.countParticles(state1)) + \
-						" + " + str(stats.countParticles(state2)) + \
-					" E = " + str(stats.countEnergyTwoComponent(state1, state2)) + \
-					" mu = " + str(stats.countMuTwoComponent(state1, state2))
+		return iterations
+
+	# Energy minimization uses the same integration weights (grid.dV) as _getN(),
+	# so that the minimum is not shifted by the final renormalization.
+	# Hamiltonian is the gradient of the energy functional with respect to
+	# the corresponding inner product (hence the weights in the kinetic term).
+
+	def _inner(self, data1, data2):
+		return (data1.conj() * data2 * self._grid.dV).sum().real
+
+	def _applyKinetic(self, data, coeffs):
+		return numpy.fft.ifftn(numpy.fft.fftn(data) * coeffs)
+
+	def _applyHamiltonian(self, datas, comps):
+		"""Returns the result of GPE Hamiltonian (in hbar units) action on each component"""
+		grid = self._grid
+		densities = [numpy.abs(data) ** 2 for data in datas]
+		res = []
+		for data, comp in zip(datas, comps):
+			potential = self._h_potentials + sum(self._getGByHbar(comp, other) * density
+				for other, density in zip(comps, densities))
+			kinetic = self._applyKinetic(data, self._h_energy) * (grid.dV_uniform / grid.dV)
+			res.append(kinetic + potential * data)
+		return res
+
+	def _getFunctional(self, datas, comps):
+		"""Returns GPE energy functional (in hbar units) for host arrays"""
+		grid = self._grid
+		E = 0
+		densities = [numpy.abs(data) ** 2 for data in datas]
+		for data, comp, density in zip(datas, comps, densities):
+			E += (numpy.abs(numpy.fft.fftn(data)) ** 2 * self._h_energy).sum() * \
+				grid.dV_uniform / grid.size
+			E += (self._h_potentials * density * grid.dV).sum()
+			E += sum((self._getGByHbar(comp, other) / 2 * density * other_density * grid.dV).sum()
+				for other, other_density in zip(comps, densities))
+		return E
+
+	def _getResidual(self, datas, comps):
+		"""
+		Returns relative norm of the residual H psi - mu psi
+		(the largest one of all components).
+		"""
+		hdatas = self._applyHamiltonian(datas, comps)
+		residuals = []
+		for data, hdata in zip(datas, hdatas):
+			norm = self._inner(data, data)
+			mu = self._inner(data, hdata) / norm
+			r = hdata - mu * data
+			residuals.append(numpy.sqrt(self._inner(r, r) / norm) / abs(mu))
+		return max(residuals)
+
+	def _minimize(self, states, desired_N, precision):
+		"""
+		Minimizes energy functional on the manifold of states with given numbers of particles
+		using nonlinear conjugate gradients with kinetic energy preconditioner,
+		until the relative residual becomes less than precision.
+		Calculation is performed on the host. Returns the number of iterations.
+		"""
+		comps = [state.comp for state in states]
+		psis = [self._env.fromDevice(state.data)[0].astype(numpy.complex128)
+			for state in states]
+
+		def project(datas):
+			# projection to the tangent space of the normalization constraint
+			return [data - self._inner(psi, data) / n * psi
+				for psi, data, n in zip(psis, datas, desired_N)]
+
+		def retract(t, directions):
+			res = []
+			for psi, d, n in zip(psis, directions, desired_N):
+				data = psi + t * d
+				res.append(data * numpy.sqrt(n / self._inner(data, data)))
+			return res
+
+		E = self._getFunctional(psis, comps)
+		directions = None
+		t = None
+		iterations = 0
+
+		while True:
+			hpsis = self._applyHamiltonian(psis, comps)
+			mus = [self._inner(psi, hpsi) / n for psi, hpsi, n in zip(psis, hpsis, desired_N)]
+			residuals = [hpsi - mu * psi for psi, hpsi, mu in zip(psis, hpsis, mus)]
+
+			residual = max(numpy.sqrt(self._inner(r, r) / n) / abs(mu)
+				for r, n, mu in zip(residuals, desired_N, mus))
+			if residual < precision:
+				break
+
+			# preconditioned gradient
+			gradients = project([
+				self._applyKinetic(r, 1.0 / (abs(mu) + self._h_energy))
+				for r, mu in zip(residuals, mus)])
+			r_dot_g = sum(self._inner(r, g) for r, g in zip(residuals, gradients))
+
+			if directions is None:
+				directions = [-g for g in gradients]
 			else:
-				print "Ground state calculation (one component):" + \
-					" N = " + str(stats.countParticles(state1)) + \
-					" E = " + str(stats.countEnergy(state1)) + \
-					" mu = " + str(stats.countMu(state1))
+				# Polak-Ribiere coefficient with automatic restart
+				beta = max(0, sum(self._inner(r, g - old_g)
+					for r, g, old_g in zip(residuals, gradients, old_gradients)) / old_r_dot_g)
+				directions = project([-g + beta * d for g, d in zip(gradients, directions)])
+
+			slope = 2 * sum(self._inner(hpsi, d) for hpsi, d in zip(hpsis, directions))
+			if slope >= 0:
+				# not a descent direction, falling back to preconditioned steepest descent
+				directions = [-g for g in gradients]
+				slope = -2 * r_dot_g
+			if slope >= 0:
+				# preconditioner may break the descent for states far from the ground state
+				directions = [-r for r in residuals]
+				slope = -2 * sum(self._inner(r, r) for r in residuals)
+
+			old_gradients = gradients
+			old_r_dot_g = r_dot_g
+
+			# Line search: quadratic interpolation of the energy
+			# using its slope and the value at the trial step
+			if t is None:
+				t = 0.1 * numpy.sqrt(min(n / self._inner(d, d)
+					for n, d in zip(desired_N, directions)))
+
+			trial_E = self._getFunctional(retract(t, directions), comps)
+			curvature = trial_E - E - slope * t
+			new_t = -slope * t ** 2 / (2 * curvature) if curvature > 0 else 2 * t
+
+			new_psis = retract(new_t, directions)
+			new_E = self._getFunctional(new_psis, comps)
+
+			if new_E > trial_E:
+				new_t, new_psis, new_E = t, retract(t, directions), trial_E
+
+			for halving in xrange(50):
+				if new_E < E:
+					break
+				new_t /= 2
+				new_psis = retract(new_t, directions)
+				new_E = self._getFunctional(new_psis, comps)
+			else:
+				# energy cannot be decreased further within the numerical precision
+				break
 
-		return state1, state2
+			psis, E, t = new_psis, new_E, new_t
+			iterations += 1
+
+		dtype = self._constants.complex.dtype
+		for state, psi in zip(states, psis):
+			self._env.copyBuffer(self._env.toDevice(psi.reshape(state.shape).astype(dtype)),
+				dest=state.data)
+
+		return iterations
 
-	def createCloud(self, two_component=False, ratio=0.5, precision=1e-6):
-		state1, state2 = self._create(two_component=two_component, ratio=ratio, precision=precision)
-		return TwoComponentCloud(self._env, self._constants, a=state1, b=state2)
+	def createCloud(self, N, two_component=False, ratio=0.5, precision=1e-6):
+		state1, state2 = self._create(N, two_component=two_component, ratio=ratio,
+			precision=precision)
+		return TwoComponentCloud(self._env, self._constants, self._grid,
+			psi0=state1, psi1=state2)
 
-	def createState(self, comp=0, precision=1e-6):
-		state1, state2 = self._create(two_component=False, comp=comp, precision=precision)
+	def createState(self, N, comp=0, precision=1e-6):
+		state1, state2 = self._create(N, two_component=False, comp=comp, precision=precision)
 		return state1
@@ -2,9 +2,11 @@ from .fft import createFFTPlan
 from .fht import FHT1D, FHT3D, getHarmonicGrid
 from .transpose import createTranspose
 from .reduce import createReduce
-from .misc import PairedCalculation, log2, tile3D
+from .misc import PairedCalculation, log2, tile3D, broadcast3D, ensembleView, getCacheDir
 from .typenames import double_precision, single_precision
 from .random import createRandom
+from .workspace import Workspace
+from .cache import DiskCache, getFingerprint, getPlainAttributes, getShared, makeReadOnly
 
 def createFHTPlan(env, constants, grid, order):
 
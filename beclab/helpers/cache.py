@@ -0,0 +1,166 @@
+import os
+import hashlib
+import tempfile
+import weakref
+import numpy
+
+from .misc import getCacheDir
+
+
+def _describe(obj):
+	"""Returns a string, which uniquely describes the value of a (nested) object"""
+	if isinstance(obj, dict):
+		return '{' + ','.join(_describe(key) + ':' + _describe(obj[key])
+			for key in sorted(obj.keys())) + '}'
+	elif isinstance(obj, (list, tuple)):
+		return '(' + ','.join(_describe(x) for x in obj) + ')'
+	elif isinstance(obj, numpy.ndarray):
+		obj = numpy.ascontiguousarray(obj)
+		return 'array(' + obj.dtype.str + ',' + repr(obj.shape) + ',' + \
+			hashlib.sha1(obj.tostring()).hexdigest() + ')'
+	elif isinstance(obj, (numpy.generic, float)):
+		# repr() keeps all significant digits
+		return repr(obj.item() if isinstance(obj, numpy.generic) else obj)
+	elif isinstance(obj, type):
+		return obj.__name__
+	else:
+		return repr(obj)
+
+def getPlainAttributes(obj):
+	"""
+	Returns the dictionary with attributes of the object, which have plain values
+	(numbers, strings, arrays and containers of them).
+	"""
+	plain = (bool, int, long, float, str, unicode, numpy.ndarray, numpy.generic,
+		tuple, list, dict)
+	return dict((name, value) for name, value in obj.__dict__.items()
+		if isinstance(value, plain))
+
+def getFingerprint(*objects):
+	"""Returns hash of the values of given objects, suitable for a cache key"""
+	return hashlib.sha1(_describe(objects)).hexdigest()
+
+def makeReadOnly(obj):
+	"""Makes arrays in the (nested) object read-only"""
+	if isinstance(obj, numpy.ndarray):
+		obj.flags.writeable = False
+	elif isinstance(obj, dict):
+		for value in obj.values():
+			makeReadOnly(value)
+	elif isinstance(obj, (list, tuple)):
+		for value in obj:
+			makeReadOnly(value)
+
+
+# Data shared between calculations (see getShared()).
+# Entries live while at least one calculation holds them.
+_shared_host = weakref.WeakValueDictionary()
+_shared_device = weakref.WeakKeyDictionary()
+
+def getShared(env, key, create):
+	"""
+	Returns the object, created by create() for given environment and key
+	(which must include fingerprints of parameters it depends on),
+	reusing the existing one if some calculation still holds it.
+	Shared arrays are read-only.
+	"""
+	if env is None:
+		storage = _shared_host
+	else:
+		storage = _shared_device.setdefault(env, weakref.WeakValueDictionary())
+
+	obj = storage.get(key)
+	if obj is None:
+		obj = create()
+		makeReadOnly(obj)
+		storage[key] = obj
+
+	return obj
+
+
+class DiskCache:
+	"""
+	Persistent storage of arrays, addressed by the key (see getFingerprint()).
+	Entries are saved in .npz files in the subdirectory of the cache directory;
+	files are written atomically, so a crashed or concurrent writer
+	never leaves a broken entry.
+	When the total size exceeds max_size (in bytes),
+	the least recently used entries are removed.
+	"""
+
+	_suffix = '.npz'
+
+	def __init__(self, subdir, max_size=2 ** 30):
+		self._subdir = subdir
+		self._max_size = max_size
+
+	def _path(self, key):
+		return os.path.join(getCacheDir(self._subdir), key + self._suffix)
+
+	def get(self, key):
+		"""Returns the dictionary of arrays saved with given key, or None"""
+		try:
+			path = self._path(key)
+			with open(path, 'rb') as f:
+				npz = numpy.load(f)
+				arrays = dict((name, npz[name]) for name in npz.files)
+		except Exception:
+			# no entry, it was evicted in the meantime,
+			# or the cache directory is not accessible
+			return None
+
+		# modification time is used as the time of the last use
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+
+		return arrays
+
+	def put(self, key, arrays):
+		"""Saves the dictionary of arrays with given key"""
+		temp_path = None
+		try:
+			path = self._path(key)
+			directory = os.path.dirname(path)
+			handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+			with os.fdopen(handle, 'wb') as f:
+				numpy.savez(f, **arrays)
+			os.rename(temp_path, path)
+		except (IOError, OSError):
+			# cache is only an optimization, failing to save an entry is not critical
+			if temp_path is not None and os.path.exists(temp_path):
+				try:
+					os.remove(temp_path)
+				except OSError:
+					pass
+			return
+
+		self._evict(directory)
+
+	def _evict(self, directory):
+		entries = []
+		try:
+			names = os.listdir(directory)
+		except OSError:
+			return
+
+		for name in names:
+			if not name.endswith(self._suffix):
+				continue
+			path = os.path.join(directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+
+		total = sum(size for _, size, _ in entries)
+		for _, size, path in sorted(entries):
+			if total <= self._max_size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
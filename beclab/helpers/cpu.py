@@ -1,11 +1,54 @@
+import multiprocessing
 import numpy
 
 
+def getSlabs(ensembles, parts):
+	"""
+	Splits ensemble axis into (at most) given number of contiguous slabs,
+	returning the list of (start, stop) pairs.
+	"""
+	parts = max(1, min(parts, ensembles))
+	slab, remainder = divmod(ensembles, parts)
+
+	slabs = []
+	start = 0
+	for i in xrange(parts):
+		stop = start + slab + (1 if i < remainder else 0)
+		slabs.append((start, stop))
+		start = stop
+
+	return slabs
+
+
 class CPUEnvironment:
 
-	def __init__(self):
+	def __init__(self, threads=1, fft_threads=None, fft_backend=None):
+		"""
+		threads: number of threads for ensemble-parallel calculations
+			(ensembles are split in contiguous slabs, which are processed independently)
+		fft_threads: number of threads used by FFT (by default the cores,
+			which are not used by ensemble-parallel threads)
+		fft_backend: 'fftw' or 'numpy'; if None, the first available one is used
+			for serial runs, and numpy for ensemble-parallel ones.
+			FFTW chooses algorithms by measuring them, possibly different ones for different
+			batch sizes, so its results are not bitwise reproducible; with numpy, parallel
+			results are bitwise identical to serial ones with fft_backend='numpy'.
+		"""
 		self.gpu = False
 
+		self.threads = threads
+		self._pool = None
+
+		if fft_threads is None:
+			fft_threads = max(1, multiprocessing.cpu_count() / threads)
+		self.fft_threads = fft_threads
+
+		# numpy transforms every batch element in the same way regardless of the batch size
+		# (and releases GIL), so parallel results are bitwise identical to serial ones
+		if fft_backend is None and threads > 1:
+			fft_backend = 'numpy'
+		self.fft_backend = fft_backend
+
 	def allocate(self, shape, dtype):
 		return numpy.empty(shape, dtype=dtype)
 
@@ -26,11 +69,35 @@ class CPUEnvironment:
 		else:
 			dest.flat[:] = buf.flat
 
+	def runSlabs(self, func, ensembles):
+		"""
+		Calls func(slab, start, stop) for every slab of the ensemble axis.
+		Slabs are processed in the thread pool (numpy releases GIL in most
+		of its array operations); the function returns when all of them are finished.
+		"""
+		slabs = getSlabs(ensembles, self.threads)
+
+		if len(slabs) == 1:
+			start, stop = slabs[0]
+			func(0, start, stop)
+			return
+
+		if self._pool is None:
+			from multiprocessing.pool import ThreadPool
+			self._pool = ThreadPool(self.threads)
+
+		# map() re-raises the exception from the worker, if there was one
+		self._pool.map(lambda args: func(*args),
+			[(i, start, stop) for i, (start, stop) in enumerate(slabs)])
+
 	def __str__(self):
 		return "CPU"
 
 	def release(self):
-		pass
+		if self._pool is not None:
+			self._pool.close()
+			self._pool.join()
+			self._pool = None
 
 	def compile(self, source, constants, **kwds):
 		raise NotImplementedError("compile() called for CPU environment")
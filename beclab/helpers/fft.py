@@ -1,48 +1,146 @@
+import os
+import tempfile
+import threading
 import numpy
+import cPickle as pickle
+
+from .misc import getCacheDir
+
+
+class NumpyFFT:
+	"""Single-threaded transform from numpy; always available."""
+
+	def __init__(self, threads):
+		pass
+
+	def __call__(self, data_in, data_out, axes, inverse, coeff):
+		func = numpy.fft.ifftn if inverse else numpy.fft.fftn
+		numpy.multiply(func(data_in, axes=axes), coeff, out=data_out)
+
+
+class FFTWFFT:
+	"""
+	Multithreaded transform from pyfftw.
+	FFTW plans are created once for every combination of shape, dtype,
+	direction and placement, and the accumulated wisdom is saved on disk,
+	so that planning is fast in subsequent runs.
+	Plan objects keep references to their arrays, so each thread gets its own ones.
+	"""
+
+	_wisdom_loaded = False
+
+	def __init__(self, threads):
+		import pyfftw
+		self._pyfftw = pyfftw
+		self._threads = threads
+		self._plans = {}
+		self._loadWisdom()
+
+	@classmethod
+	def _wisdomFile(cls):
+		return os.path.join(getCacheDir(), 'fftw_wisdom')
+
+	def _loadWisdom(self):
+		if FFTWFFT._wisdom_loaded:
+			return
+		FFTWFFT._wisdom_loaded = True
+
+		try:
+			with open(self._wisdomFile(), 'rb') as f:
+				self._pyfftw.import_wisdom(pickle.load(f))
+		except Exception:
+			# no wisdom yet, or it is corrupted; plans will be measured again
+			pass
+
+	def _saveWisdom(self):
+		# plans can be created from several slab threads at once,
+		# so each write goes to its own temporary file
+		temp_path = None
+		try:
+			path = self._wisdomFile()
+			handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+			with os.fdopen(handle, 'wb') as f:
+				pickle.dump(self._pyfftw.export_wisdom(), f, protocol=2)
+			os.rename(temp_path, path)
+		except (IOError, OSError):
+			# wisdom is only an optimization, failing to save it is not critical
+			if temp_path is not None and os.path.exists(temp_path):
+				try:
+					os.remove(temp_path)
+				except OSError:
+					pass
+
+	def _getPlan(self, data_in, inplace, axes, inverse):
+		key = (data_in.shape, data_in.dtype.str, inplace, inverse,
+			threading.current_thread().ident)
+		if key not in self._plans:
+			empty = self._pyfftw.empty_aligned
+			a = empty(data_in.shape, dtype=data_in.dtype)
+			b = a if inplace else empty(data_in.shape, dtype=data_in.dtype)
+			self._plans[key] = self._pyfftw.FFTW(a, b, axes=axes,
+				direction='FFTW_BACKWARD' if inverse else 'FFTW_FORWARD',
+				flags=('FFTW_MEASURE', 'FFTW_UNALIGNED'), threads=self._threads)
+			self._saveWisdom()
+
+		return self._plans[key]
+
+	def __call__(self, data_in, data_out, axes, inverse, coeff):
+		inplace = numpy.may_share_memory(data_in, data_out)
+		plan = self._getPlan(data_in, inplace, axes, inverse)
+
+		# FFTW cannot scale the result itself, and pyfftw normalizes the inverse
+		# transform in a separate pass; this normalization is merged with coeff,
+		# so that the result is scaled in a single pass in both directions
+		if inverse:
+			coeff = coeff / plan.N
+		plan(data_in, data_out, normalise_idft=False)
+		data_out *= coeff
 
 
-class NumpyPlan3D:
-
-	def __init__(self, shape, scale):
-		self._shape = shape
-		self._scale = scale
+_CPU_BACKENDS = {
+	'fftw': FFTWFFT,
+	'numpy': NumpyFFT
+}
 
-	def execute(self, data_in, data_out=None, inverse=False, batch=1):
-		if data_out is None:
-			data_out = data_in
+# backends to try if the choice was not specified explicitly, in order of preference
+_CPU_BACKENDS_ORDER = ('fftw', 'numpy')
 
-		if inverse:
-			func = numpy.fft.ifftn
-			coeff = 1.0 / self._scale
-		else:
-			func = numpy.fft.fftn
-			coeff = self._scale
+def createCPUBackend(name=None, threads=1):
+	"""
+	Returns FFT backend with given name.
+	If name is None, the first one available is chosen.
+	"""
+	if name is not None:
+		if name not in _CPU_BACKENDS:
+			raise ValueError("Unknown FFT backend: " + str(name))
+		return _CPU_BACKENDS[name](threads)
 
-		shape = self._shape
-		data_out.flat[:] = func(data_in.reshape(batch, *shape), axes=(1, 2, 3)).flat
-		data_out *= coeff
+	for name in _CPU_BACKENDS_ORDER:
+		try:
+			return _CPU_BACKENDS[name](threads)
+		except ImportError:
+			pass
 
 
-class NumpyPlan1D:
+class CPUPlan:
 
-	def __init__(self, shape, scale):
-		self._shape = shape
+	def __init__(self, shape, scale, backend):
+		self._shape = tuple(shape)
+		self._axes = tuple(range(1, len(shape) + 1))
 		self._scale = scale
+		self._backend = backend
 
 	def execute(self, data_in, data_out=None, inverse=False, batch=1):
 		if data_out is None:
 			data_out = data_in
 
-		if inverse:
-			func = numpy.fft.ifft
-			coeff = 1.0 / self._scale
-		else:
-			func = numpy.fft.fft
-			coeff = self._scale
+		coeff = 1.0 / self._scale if inverse else self._scale
 
-		shape = self._shape
-		data_out.flat[:] = func(data_in.reshape(batch, *shape)).flat
-		data_out *= coeff
+		# views with separate batch axis; the normalization is applied
+		# during the write to data_out, so there are no additional passes
+		shape = (batch,) + self._shape
+		self._backend(data_in.reshape(shape), data_out.reshape(shape),
+			self._axes, inverse, coeff)
 
 
 def createFFTPlan(env, constants, grid):
@@ -61,12 +159,8 @@ def createFFTPlan(env, constants, grid):
 			return pyfft.cl.Plan(shape, dtype=dtype, normalize=True,
 				queue=env.queue, scale=scale)
 	else:
-		plans = {
-			1: NumpyPlan1D,
-			3: NumpyPlan3D
-		}
-
-		if len(shape) not in plans:
+		if len(shape) not in (1, 3):
 			raise ValueError("Wrong dimension")
 
-		return plans[len(shape)](shape, scale)
+		backend = createCPUBackend(env.fft_backend, env.fft_threads)
+		return CPUPlan(shape, scale, backend)
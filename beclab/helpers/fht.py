@@ -4,6 +4,7 @@ import fractions
 from numpy.polynomial import Hermite as H
 
 from .misc import tile3D, PairedCalculation
+from .cache import DiskCache, getFingerprint, getShared
 
 
 def factorial(n):
@@ -22,59 +23,100 @@ def my_hermite(n):
 
 	return func
 
-def my_h_roots(n):
+def _iterateHermiteFunctions(x, n):
 	"""
-	Recursive root finding algorithm, taken from Numerical Recipes.
-	More accurate than standard h_roots() from scipy.
+	Yields Hermite functions psi_0(x) ... psi_{n-1}(x)
+	(orthonormal Hermite polynomials multiplied by exp(-x^2 / 2)),
+	calculated using normalized three-term recurrence.
+	Values are yielded as pairs (mantissa, log of scale) to avoid overflows
+	for large n and x.
 	"""
+	p1 = numpy.ones_like(x) * numpy.pi ** (-0.25)
+	p2 = numpy.zeros_like(x)
+	log_scale = -x ** 2 / 2
+
+	for j in xrange(n):
+		yield p1, log_scale
+
+		p1, p2 = x * numpy.sqrt(2.0 / (j + 1)) * p1 - numpy.sqrt(float(j) / (j + 1)) * p2, p1
+
+		# keeping the magnitude of polynomials bounded
+		big = numpy.abs(p1) > 1e100
+		if big.any():
+			coeff = numpy.where(big, 1e-100, 1.0)
+			p1 = p1 * coeff
+			p2 = p2 * coeff
+			log_scale = log_scale - numpy.log(coeff)
+
+def getHermiteFunctions(N, x):
+	"""Returns (N, len(x)) array with values of first N Hermite functions"""
+	res = numpy.empty((N, len(x)))
+	for n, (p, log_scale) in enumerate(_iterateHermiteFunctions(x, N)):
+		res[n] = p * numpy.exp(log_scale)
+	return res
 
-	EPS = 1.0e-16
-	PIM4 = numpy.pi ** (-0.25) # 0.7511255444649425
-	MAXIT = 20 # Maximum iterations.
-
-	x = numpy.empty(n)
-	w = numpy.empty(n)
-	m = (n + 1) / 2
-
-	z = 0
-
-	for i in xrange(m):
-		if i == 0: # Initial guess for the largest root.
-			z = numpy.sqrt(float(2 * n + 1)) - 1.85575 * float(2 * n + 1) ** (-0.16667)
-		elif i == 1:
-			z -= 1.14 * float(n) ** 0.426 / z
-		elif i == 2:
-			z = 1.86 * z + 0.86 * x[0]
-		elif i == 3:
-			z = 1.91 * z + 0.91 * x[1]
-		else:
-			z = 2.0 * z + x[i - 2]
-
-		for its in xrange(MAXIT):
-			p1 = PIM4
-			p2 = 0.0
-			p3 = 0.0
-			for j in xrange(n):
-				p3 = p2
-				p2 = p1
-				p1 = z * numpy.sqrt(2.0 / (j + 1)) * p2 - numpy.sqrt(float(j) / (j + 1)) * p3
-
-			pp = numpy.sqrt(float(2 * n)) * p2
-			z1 = z
-			z = z1 - p1 / pp
-			if abs(z - z1) <= EPS:
-				break
-
-		if its >= MAXIT:
-			raise Exception("too many iterations in gauher")
-
-		x[n - 1 - i] = z
-		x[i] = -z
-		w[i] = 2.0 / (pp ** 2)
-		w[n - 1 - i] = w[i]
+def _getLastHermiteFunctions(x, n):
+	"""Returns psi_{n-1}(x) and psi_n(x) as pairs (mantissa, log of scale)"""
+	prev = last = None
+	for value in _iterateHermiteFunctions(x, n + 1):
+		prev, last = last, value
+	return prev, last
+
+def _calculateGaussHermite(n):
+	"""
+	Returns nodes of n-point Gauss-Hermite quadrature and corresponding weights,
+	multiplied by exp(x^2).
+	Nodes are eigenvalues of the Jacobi matrix (Golub-Welsch algorithm),
+	refined by Newton iterations; weights are calculated as 1 / (n psi_{n-1}(x)^2).
+	"""
+	if n == 1:
+		return numpy.zeros(1), numpy.array([numpy.sqrt(numpy.pi)])
+
+	off_diagonal = numpy.sqrt(numpy.arange(1, n) / 2.0)
+	jacobi = numpy.diag(off_diagonal, 1) + numpy.diag(off_diagonal, -1)
+	x = numpy.linalg.eigvalsh(jacobi)
+
+	for i in xrange(2):
+		(p_prev, log_prev), (p, log_scale) = _getLastHermiteFunctions(x, n)
+		x -= p / (numpy.sqrt(2.0 * n) * p_prev) * numpy.exp(log_scale - log_prev)
+
+	# the quadrature is symmetric
+	x = (x - x[::-1]) / 2
+
+	(p_prev, log_prev), _ = _getLastHermiteFunctions(x, n)
+	w = numpy.exp(-2 * log_prev) / (n * p_prev ** 2)
 
 	return x, w
 
+_gauss_hermite = {}
+_gauss_hermite_cache = DiskCache('gauss_hermite')
+
+def getGaussHermite(n):
+	"""
+	Returns nodes of n-point Gauss-Hermite quadrature and corresponding weights,
+	multiplied by exp(x^2).
+	Results are cached in memory and on disk; returned arrays are read-only.
+	"""
+	if n not in _gauss_hermite:
+		key = getFingerprint('getGaussHermite', n)
+		arrays = _gauss_hermite_cache.get(key)
+		if arrays is None:
+			x, w = _calculateGaussHermite(n)
+			_gauss_hermite_cache.put(key, dict(x=x, w=w))
+		else:
+			x, w = arrays['x'], arrays['w']
+
+		x.flags.writeable = False
+		w.flags.writeable = False
+		_gauss_hermite[n] = (x, w)
+
+	return _gauss_hermite[n]
+
+def my_h_roots(n):
+	"""Returns nodes and weights of n-point Gauss-Hermite quadrature"""
+	x, w = getGaussHermite(n)
+	return x.copy(), w * numpy.exp(-x ** 2)
+
 def getHarmonicGrid(N, l):
 	if (N - 1) * (l + 1) + 1 % 2 == 0:
 		points = ((N - 1) * (l + 1) + 1) / 2
@@ -89,10 +131,9 @@ def getHarmonicGrid(N, l):
 	# But this still requres investigation.
 	#points += 10
 
-	roots, weights = my_h_roots(points)
+	roots, scaled_weights = getGaussHermite(points)
 
-	return roots * numpy.sqrt(2.0 / (l + 1)), \
-		weights * numpy.exp(roots ** 2) * numpy.sqrt(2.0 / (l + 1))
+	return roots * numpy.sqrt(2.0 / (l + 1)), scaled_weights * numpy.sqrt(2.0 / (l + 1))
 
 def getEigenfunction(n):
 	return lambda x: my_hermite(n)(x) * numpy.exp(-(x ** 2) / 2)
@@ -104,16 +145,22 @@ def getEigenfunction3D(nx, ny, nz):
 	return lambda x, y, z: getEigenfunction(nx)(x) * \
 		getEigenfunction(ny)(y) * getEigenfunction(nz)(z)
 
-def getPMatrix(N, l):
-	x, _ = getHarmonicGrid(N, l)
-
-	res = numpy.zeros((N, len(x)))
+_p_matrices = {}
 
-	for n in range(N):
-		phi = getEigenfunction(n)
-		res[n, :] = phi(x)
+def getPMatrix(N, l, dtype=numpy.float64):
+	"""
+	Returns (N, points) matrix with values of first N Hermite functions
+	in the points of the grid for transformation order l.
+	Results are cached; returned arrays are read-only.
+	"""
+	key = (N, l, numpy.dtype(dtype).str)
+	if key not in _p_matrices:
+		x, _ = getHarmonicGrid(N, l)
+		P = getHermiteFunctions(N, x).astype(dtype)
+		P.flags.writeable = False
+		_p_matrices[key] = P
 
-	return res
+	return _p_matrices[key]
 
 class FHT1D(PairedCalculation):
 
@@ -135,15 +182,18 @@ class FHT1D(PairedCalculation):
 		self._scalar_dtype = constants.scalar.dtype
 		self._complex_dtype = constants.complex.dtype
 
-		self._weights_x = self._env.toDevice(w.astype(self._scalar_dtype))
+		key = (N, order, numpy.dtype(self._scalar_dtype).str)
+		self._weights_x = getShared(env, ('fht_weights',) + key,
+			lambda: self._env.toDevice(w.astype(self._scalar_dtype)))
 		self._xshape = (len(w),)
 
-		P = getPMatrix(self.N, self.order).astype(self._scalar_dtype)
-		self._P = self._env.toDevice(P)
+		P = getPMatrix(self.N, self.order, dtype=self._scalar_dtype)
+		self._P = getShared(env, ('fht_P',) + key, lambda: self._env.toDevice(P))
 
-		# flatten and reshape make memory linear again
+		# ascontiguousarray() makes memory linear again
 		# (transpose() just swaps strides)
-		self._P_tr = self._env.toDevice(P.transpose().flatten().reshape(50, 50))
+		self._P_tr = getShared(env, ('fht_P_tr',) + key,
+			lambda: self._env.toDevice(numpy.ascontiguousarray(P.transpose())))
 
 		self._fwd_scale = constants.scalar.cast(numpy.sqrt(scale))
 		self._inv_scale = constants.scalar.cast(1.0 / numpy.sqrt(scale))
@@ -233,7 +283,7 @@ class FHT1D(PairedCalculation):
 
 class FHT3D:
 
-	def __init__(self, N, order, scale=(1, 1, 1)):
+	def __init__(self, env, constants, grid, N, order, scale=(1, 1, 1)):
 		"""
 		N: the maximum number of harmonics (tuple (Nz, Ny, Nx))
 		(i.e. transform returns decomposition on eigenfunctions with numbers 0 .. N - 1)
@@ -241,6 +291,7 @@ class FHT3D:
 		(f() cannot have mixed order, i.e. no f() = Psi^2 + Psi)
 		"""
 
+		self._env = env
 		self.N = N
 		self.order = order
 		self.scale_coeff = numpy.sqrt(scale[0] * scale[1] * scale[2])
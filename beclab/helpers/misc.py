@@ -1,3 +1,4 @@
+import os
 import numpy
 
 class PairedCalculation:
@@ -68,3 +69,41 @@ def tile3D(x, y, z):
 	zz = numpy.transpose(numpy.tile(z, ny * nx).reshape(nx, ny, nz), axes=(2, 1, 0))
 
 	return xx, yy, zz
+
+def broadcast3D(x, y, z):
+	"""
+	Returns views of 1D arrays, which broadcast against each other
+	to (len(z), len(y), len(x)) arrays in elementwise numpy operations.
+	"""
+	return x[None, None, :], y[None, :, None], z[:, None, None]
+
+def ensembleView(data, cell_shape):
+	"""
+	Returns view of data with separate leading ensemble axis,
+	so that it can be broadcasted against arrays of shape cell_shape.
+	Works both for (ensembles,) + cell_shape and (ensembles * nvz, nvy, nvx) layouts.
+	Raises AttributeError if data cannot be reshaped without copying.
+	"""
+	view = data.view()
+	view.shape = (-1,) + tuple(cell_shape)
+	return view
+
+def getCacheDir(subdir=None):
+	"""
+	Returns (and creates, if necessary) the directory for persistent caches.
+	Location can be changed by setting BECLAB_CACHE_DIR environment variable.
+	"""
+	path = os.environ.get('BECLAB_CACHE_DIR',
+		os.path.join(os.path.expanduser('~'), '.beclab'))
+	if subdir is not None:
+		path = os.path.join(path, subdir)
+
+	if not os.path.isdir(path):
+		try:
+			os.makedirs(path)
+		except OSError:
+			# could have been created by another process in the meantime
+			if not os.path.isdir(path):
+				raise
+
+	return path
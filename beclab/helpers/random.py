@@ -1,3 +1,6 @@
+import atexit
+import threading
+import Queue
 import numpy
 
 from .typenames import single_precision, double_precision
@@ -67,19 +70,230 @@ class FakeRandom:
 		return self._env.toDevice(self._random.random_normal(size, scale=scale / numpy.sqrt(2.0), loc=loc))
 
 
+# prefetching threads of existing generators, stopped at exit
+# (daemon threads waiting on a queue fail noisily during interpreter shutdown)
+_prefetch_workers = {}
+
+@atexit.register
+def _stopPrefetchWorkers():
+	for tasks, thread in _prefetch_workers.values():
+		tasks.put(None)
+		thread.join()
+	_prefetch_workers.clear()
+
+def _runTasks(tasks, results):
+	"""Worker loop of CPURandom prefetching; does not hold a reference to the generator"""
+	while True:
+		task = tasks.get()
+		if task is None:
+			break
+
+		func, args = task
+		try:
+			func(*args)
+		except Exception as e:
+			results.put(e)
+		else:
+			results.put(None)
+
+		# the finished task must not keep the generator alive
+		task = func = args = None
+
+
 class CPURandom:
+	"""
+	Random numbers on CPU.
+	Apart from the main stream, every ensemble has its own stream
+	(used by fill_normal()), so that the result does not depend on the way
+	ensembles are split between threads.
+	Every stream is a persistent numpy.random.RandomState seeded by
+	(seed, stream number); the state of the generator consists of their states.
+	If seed is not given, it is taken from the global numpy stream
+	(so numpy.random.seed() makes the results reproducible).
+	"""
 
-	def __init__(self, env, double):
+	# number of blocks handed out by next_normal() between snapshots of streams
+	# (at most this many blocks are regenerated to discard the prefetched one)
+	_SNAPSHOT_PERIOD = 16
+
+	def __init__(self, env, double, seed=None):
 		p = double_precision if double else single_precision
 		self._scalar_dtype = p.scalar.dtype
 		self._complex_dtype = p.complex.dtype
 
+		if seed is None:
+			seed = numpy.random.randint(0, 2 ** 31 - 1)
+		self._seed = seed
+
+		self._generator = numpy.random.RandomState([seed, 0])
+		self._streams = []
+
+		# double buffering for next_normal();
+		# the following block is generated by a persistent worker thread
+		self._prefetch_key = None
+		self._prefetch_buffers = None
+		self._prefetch_pending = False
+		self._tasks = None
+		self._results = None
+
+		# states of streams used by next_normal() at some moment
+		# and the number of blocks handed out since then
+		self._snapshot = None
+		self._handed_out = 0
+
+	def __del__(self):
+		if self._tasks is not None:
+			self._tasks.put(None)
+			_prefetch_workers.pop(id(self), None)
+
+	def _getStreams(self, ensembles):
+		"""Returns the list of streams of the main stream or of given ensembles"""
+		if ensembles is None:
+			return [self._generator]
+
+		start, stop = ensembles
+		for i in xrange(len(self._streams), stop):
+			self._streams.append(numpy.random.RandomState([self._seed, i + 1]))
+		return self._streams[start:stop]
+
+	def _fill(self, stream, out):
+		# Real and imaginary parts are drawn in a single call.
+		# RandomState cannot fill an existing array, so the numbers are drawn
+		# in double precision into a temporary of the size of one stream's part
+		# and copied (and cast, if necessary) to the output.
+		view = out.view(self._scalar_dtype)
+		view[...] = stream.standard_normal(view.shape)
+
 	def rand(self, shape):
 		return numpy.random.rand(*shape).astype(self._scalar_dtype)
 
 	def random_normal(self, size, scale=1.0, loc=0.0):
-		return (numpy.random.normal(loc=loc, scale=scale / numpy.sqrt(2.0), size=size) +
-			1j * numpy.random.normal(loc=loc, scale=scale / numpy.sqrt(2.0), size=size)).astype(self._complex_dtype)
+		normal = numpy.empty(size, self._complex_dtype)
+		self.fill_normal(normal, scale=scale, loc=loc)
+		return normal
+
+	def fill_normal(self, out, scale=1.0, loc=0.0, ensembles=None):
+		"""
+		Fills contiguous complex array in place with normally distributed numbers
+		(real and imaginary parts have mean loc and variance scale ** 2 / 2).
+		ensembles: (start, stop) pair; if given, out[i] is filled from the stream
+		of ensemble start + i, otherwise the main stream is used.
+		"""
+		self._cancelPrefetch()
+		self._fillNormal(out, scale, loc, ensembles)
+
+	def _fillNormal(self, out, scale, loc, ensembles):
+		assert out.dtype == self._complex_dtype and out.flags.c_contiguous
+
+		streams = self._getStreams(ensembles)
+		if ensembles is None:
+			self._fill(streams[0], out)
+		else:
+			assert out.shape[0] == len(streams)
+			for stream, part in zip(streams, out):
+				self._fill(stream, part)
+
+		view = out.view(self._scalar_dtype)
+		if scale != numpy.sqrt(2.0):
+			view *= scale / numpy.sqrt(2.0)
+		if loc != 0:
+			view += loc
+
+	def next_normal(self, shape, ensembles=None):
+		"""
+		Returns the same numbers as fill_normal() with default scale and loc
+		for the array of given shape, but generates the next block with the same
+		parameters in background, while the caller is using this one.
+		The returned buffer is valid until the next call.
+		The sequence of numbers does not depend on the timing of the background thread.
+		"""
+		key = (tuple(shape), ensembles)
+		if key != self._prefetch_key:
+			self._cancelPrefetch()
+			self._prefetch_buffers = [numpy.empty(shape, self._complex_dtype) for i in xrange(2)]
+			self._snapshot = [stream.get_state() for stream in self._getStreams(ensembles)]
+			self._handed_out = 0
+			self._fillNormal(self._prefetch_buffers[1], 1.0, 0.0, ensembles)
+			self._prefetch_key = key
+		else:
+			self._waitPrefetch()
+
+		self._prefetch_buffers.reverse()
+		current, following = self._prefetch_buffers
+
+		# Streams are past the block being handed out, so they can be saved.
+		# Taking a snapshot is expensive for a large number of ensembles,
+		# so it is done only once in a while.
+		self._handed_out += 1
+		if self._handed_out == self._SNAPSHOT_PERIOD:
+			self._snapshot = [stream.get_state() for stream in self._getStreams(ensembles)]
+			self._handed_out = 0
+
+		if self._tasks is None:
+			self._tasks = Queue.Queue()
+			self._results = Queue.Queue()
+			thread = threading.Thread(target=_runTasks, args=(self._tasks, self._results))
+			thread.daemon = True
+			thread.start()
+			_prefetch_workers[id(self)] = (self._tasks, thread)
+
+		self._tasks.put((self._fillNormal, (following, 1.0, 0.0, ensembles)))
+		self._prefetch_pending = True
+
+		return current
+
+	def _waitPrefetch(self):
+		if not self._prefetch_pending:
+			return
+
+		self._prefetch_pending = False
+		error = self._results.get()
+		if error is not None:
+			self._prefetch_key = None
+			self._prefetch_buffers = None
+			raise error
+
+	def _cancelPrefetch(self):
+		"""
+		Discards the block generated in background and rewinds the streams,
+		so that they are past the last block handed out by next_normal()
+		"""
+		if self._prefetch_key is None:
+			return
+
+		shape, ensembles = self._prefetch_key
+		self._prefetch_key = None
+		self._prefetch_buffers = None
+
+		# if the worker failed, the state of streams is unknown anyway
+		self._waitPrefetch()
+
+		# restoring the snapshot and regenerating blocks handed out after it
+		streams = self._getStreams(ensembles)
+		view_shape = shape[1:] if ensembles is not None else shape
+		view_shape = view_shape[:-1] + (view_shape[-1] * 2,)
+		for stream, state in zip(streams, self._snapshot):
+			stream.set_state(state)
+			for i in xrange(self._handed_out):
+				stream.standard_normal(view_shape)
+
+		self._snapshot = None
+
+	def getState(self):
+		"""Returns the state of all streams (can be pickled)"""
+		self._cancelPrefetch()
+		return dict(seed=self._seed, main=self._generator.get_state(),
+			streams=[stream.get_state() for stream in self._streams])
+
+	def setState(self, state):
+		self._cancelPrefetch()
+		self._seed = state['seed']
+		self._generator.set_state(state['main'])
+		self._streams = []
+		for stream_state in state['streams']:
+			stream = numpy.random.RandomState()
+			stream.set_state(stream_state)
+			self._streams.append(stream)
 
 
 def createRandom(env, double):
@@ -0,0 +1,24 @@
+class Workspace:
+	"""
+	Pool of named temporary buffers for hot loops.
+	Each buffer is allocated on the first request and reused afterwards,
+	as long as the requested shape and dtype stay the same.
+	The number of real allocations is kept in the ``allocations`` attribute,
+	so one can check that after the first step the loop does not allocate anything.
+	"""
+
+	def __init__(self, env):
+		self._env = env
+		self._buffers = {}
+		self.allocations = 0
+
+	def get(self, name, shape, dtype):
+		buf = self._buffers.get(name)
+		if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+			buf = self._env.allocate(tuple(shape), dtype)
+			self._buffers[name] = buf
+			self.allocations += 1
+		return buf
+
+	def release(self):
+		self._buffers = {}
@@ -4,6 +4,38 @@ from .helpers import *
 from .constants import *
 
 
+def getPhaseNoise(i):
+	"""
+	Returns phase noise for given interactions
+	(complex numbers S_xj + iS_yj, j = 1..N, for every trajectory).
+	"""
+	phi = numpy.angle(i)
+
+	# Center of the distribution can be shifted to pi or -pi,
+	# making mean() return incorrect values.
+	# The following approximate method will allow us to shift the center to zero
+	# It will work only if the maximum of the distribution is clearly
+	# distinguished; otherwise it can give anything as a result
+
+	Pperp = numpy.exp(1j * phi) # transforming Pperp to distribution on the unit circle
+	Pmean = Pperp.mean() # Center of masses is supposed to be close to the center of distribution
+
+	# Normalizing the direction to the center of masses
+	# Now angle(Pmean) ~ proper mean of Pperp
+	Pmean /= numpy.abs(Pmean)
+
+	# Shifting the distribution
+	Pcent = Pperp * Pmean.conj()
+	phi_centered = numpy.angle(Pcent)
+
+	return phi_centered.std()
+
+def getPzNoise(n0, n1):
+	"""Returns Pz noise for given populations of every trajectory"""
+	Pz = (n0 - n1) / (n0 + n1)
+	return Pz.std()
+
+
 class ParticleStatistics(PairedCalculation):
 	"""
 	Calculates number of particles, energy per particle or
@@ -19,14 +51,14 @@ class ParticleStatistics(PairedCalculation):
 		self._reduce = createReduce(env, constants.scalar.dtype)
 		self._creduce = createReduce(env, constants.complex.dtype)
 
-		self._potentials = getPotentials(env, constants, grid)
+		self._potentials = getPotentials(env, self._constants, self._grid)
 
 		if isinstance(grid, HarmonicGrid):
-			self._energy = getHarmonicEnergy(env, constants, grid)
+			self._energy = getHarmonicEnergy(env, self._constants, self._grid)
 		elif isinstance(grid, UniformGrid):
-			self._energy = getPlaneWaveEnergy(env, constants, grid)
+			self._energy = getPlaneWaveEnergy(env, self._constants, self._grid)
 
-		self._dV = grid.get_dV(env)
+		self._dV = self._grid.get_dV(env)
 
 		self._prepare()
 
@@ -105,6 +137,12 @@ class ParticleStatistics(PairedCalculation):
 					nonlinear2 + differential2.x;
 			}
 
+			EXPORTED_FUNC void multiply(GLOBAL_MEM COMPLEX *data, GLOBAL_MEM SCALAR *coeffs)
+			{
+				DEFINE_INDEXES;
+				data[index] = complex_mul_scalar(data[index], coeffs[cell_index]);
+			}
+
 			EXPORTED_FUNC void multiplyScalars(GLOBAL_MEM SCALAR *data, GLOBAL_MEM SCALAR *coeffs,
 				int ensembles)
 			{
@@ -130,10 +168,15 @@ class ParticleStatistics(PairedCalculation):
 		self._kernel_invariant2comp = self._program.invariant2comp
 		self._kernel_density = self._program.density
 		self._kernel_multiplyScalars = self._program.multiplyScalars
+		self._kernel_multiply = self._program.multiply
 
-	def _cpu__kernel_calculateInteraction(self, _, res, data0, data1):
+	def _cpu__kernel_interaction(self, _, res, data0, data1):
 		self._env.copyBuffer(data0 * data1.conj(), dest=res)
 
+	def _cpu__kernel_multiply(self, _, data, coeffs):
+		view = ensembleView(data, coeffs.shape)
+		view *= coeffs
+
 	def _cpu__kernel_density(self, _, density, data, coeff, modifier):
 		self._env.copyBuffer((numpy.abs(data) ** 2 - modifier) / coeff, dest=density)
 
@@ -143,14 +186,27 @@ class ParticleStatistics(PairedCalculation):
 	def getVisibility(self, psi0, psi1):
 		N0 = self.getN(psi0)
 		N1 = self.getN(psi1)
-		interaction = self._getInteraction(psi0, psi1)
-		self._kernel_multiply(interaction.size, interaction, self._dV)
 
 		ensembles = psi0.shape[0]
-		interaction = numpy.abs(self._creduce(interaction)) / ensembles
+		interaction = numpy.abs(self.getInteractions(psi0, psi1).sum()) / ensembles
 
 		return 2.0 * interaction / (N0 + N1)
 
+	def getInteractions(self, psi0, psi1):
+		"""Returns integrated psi0 * conj(psi1) for every trajectory"""
+		interaction = self._getInteraction(psi0, psi1)
+		if not psi0.in_mspace:
+			self._kernel_multiply(interaction.size, interaction, self._dV)
+		return self._env.fromDevice(self._creduce(interaction, psi0.shape[0]))
+
+	def getPopulations(self, psi):
+		"""Returns population of every trajectory"""
+		ensembles = psi.shape[0]
+		density = self.getDensity(psi)
+		if not psi.in_mspace:
+			self._kernel_multiplyScalars(density.size, density, self._dV, numpy.int32(ensembles))
+		return self._env.fromDevice(self._reduce(density, ensembles))
+
 	def getDensity(self, psi, coeff=1):
 		if psi.type == WIGNER:
 			raise NotImplementedError()
@@ -246,50 +302,10 @@ class ParticleStatistics(PairedCalculation):
 		Warning: this function considers spin distribution ellipse to be horizontal,
 		which is not always so.
 		"""
-
-		ensembles = psi0.shape[0]
-		get = self._env.fromDevice
-		reduce = self._reduce
-		creduce = self._creduce
-
-		i = self._getInteraction(psi0, psi1)
-
-		i = get(creduce(i, ensembles)) # Complex numbers {S_xj + iS_yj, j = 1..N}
-		phi = numpy.angle(i) # normalizing
-
-		# Center of the distribution can be shifted to pi or -pi,
-		# making mean() return incorrect values.
-		# The following approximate method will allow us to shift the center to zero
-		# It will work only if the maximum of the distribution is clearly
-		# distinguished; otherwise it can give anything as a result
-
-		Pperp = numpy.exp(1j * phi) # transforming Pperp to distribution on the unit circle
-		Pmean = Pperp.mean() # Center of masses is supposed to be close to the center of distribution
-
-		# Normalizing the direction to the center of masses
-		# Now angle(Pmean) ~ proper mean of Pperp
-		Pmean /= numpy.abs(Pmean)
-
-		# Shifting the distribution
-		Pcent = Pperp * Pmean.conj()
-		phi_centered = numpy.angle(Pcent)
-
-		return phi_centered.std()
+		return getPhaseNoise(self.getInteractions(psi0, psi1))
 
 	def getPzNoise(self, psi0, psi1):
-		ensembles = psi0.shape[0]
-		get = self._env.fromDevice
-		reduce = self._reduce
-
-		n0 = self.getDensity(psi0)
-		n1 = self.getDensity(psi1)
-
-		n0 = get(reduce(n0, ensembles))
-		n1 = get(reduce(n1, ensembles))
-
-		Pz = (n0 - n1) / (n0 + n1)
-
-		return Pz.std()
+		return getPzNoise(self.getPopulations(psi0), self.getPopulations(psi1))
 
 	def getN(self, psi):
 		p = self.getAveragePopulation(psi)
@@ -377,12 +393,16 @@ class Uncertainty:
 
 		return numpy.std(n)
 
-	def getSpins(self, state1, state2):
+	def getSpinComponents(self, state1, state2):
+		"""
+		Returns integrated interaction and populations of both components
+		for every trajectory.
+		"""
 		ensembles = state1.size / self._constants.cells
 		get = self._env.fromDevice
 		reduce = self._reduce
 		creduce = self._creduce
-		dV = self._constants.dV
+		dV = 1.0 if state1.in_mspace else self._constants.dV
 
 		i = self._stats._getInteraction(state1, state2)
 		n1 = self._stats.getDensity(state1)
@@ -392,70 +412,70 @@ class Uncertainty:
 		n1 = get(reduce(n1, ensembles)) * dV
 		n2 = get(reduce(n2, ensembles)) * dV
 
-		# Si for each trajectory
-		Si = [i.real, i.imag, 0.5 * (n1 - n2)]
-		S = numpy.sqrt(Si[0] ** 2 + Si[1] ** 2 + Si[2] ** 2)
-		phi = numpy.arctan2(Si[1], Si[0])
-		yps = numpy.arccos(Si[2] / S)
+		return i, n1, n2
 
-		return phi, yps
+	def getSpins(self, state1, state2):
+		return getSpins(*self.getSpinComponents(state1, state2))
 
 	def getXiSquared(self, state1, state2):
 		"""Get squeezing coefficient; see Yun Li et al, Eur. Phys. J. B 68, 365-381 (2009)"""
+		return getXiSquared(*self.getSpinComponents(state1, state2))
 
-		ensembles = state1.size / self._constants.cells
-		get = self._env.fromDevice
-		reduce = self._reduce
-		creduce = self._creduce
-		dV = self._constants.dV
-
-		i = self._stats._getInteraction(state1, state2)
-		n1 = self._stats.getDensity(state1)
-		n2 = self._stats.getDensity(state2)
 
-		i = get(creduce(i, ensembles)) * dV
-		n1 = get(reduce(n1, ensembles)) * dV
-		n2 = get(reduce(n2, ensembles)) * dV
+def getSpins(i, n1, n2):
+	"""
+	Returns azimuthal and polar angles of the spin for every trajectory,
+	given results of Uncertainty.getSpinComponents().
+	"""
+	# Si for each trajectory
+	Si = [i.real, i.imag, 0.5 * (n1 - n2)]
+	S = numpy.sqrt(Si[0] ** 2 + Si[1] ** 2 + Si[2] ** 2)
+	phi = numpy.arctan2(Si[1], Si[0])
+	yps = numpy.arccos(Si[2] / S)
 
-		return self._getXiSquared(i, n1, n2)
+	return phi, yps
 
-	def _getXiSquared(self, i, n1, n2):
+def getXiSquared(i, n1, n2):
+	"""
+	Returns squeezing coefficient, given results of Uncertainty.getSpinComponents().
+	See Yun Li et al, Eur. Phys. J. B 68, 365-381 (2009)
+	"""
 
-		Si = [i.real, i.imag, 0.5 * (n1 - n2)] # S values for each trajectory
-		avgs = [x.mean() for x in Si] # <S_i>, i=x,y,z
+	Si = [i.real, i.imag, 0.5 * (n1 - n2)] # S values for each trajectory
+	avgs = [x.mean() for x in Si] # <S_i>, i=x,y,z
 
-		# \Delta_{ii} = 2 \Delta S_i^2
-		deltas = numpy.array([[(x * y + y * x).mean() - 2 * x.mean() * y.mean() for x in Si] for y in Si])
+	# \Delta_{ii} = 2 \Delta S_i^2
+	deltas = numpy.array([[(x * y + y * x).mean() - 2 * x.mean() * y.mean() for x in Si] for y in Si])
 
-		S = numpy.sqrt(avgs[0] ** 2 + avgs[1] ** 2 + avgs[2] ** 2) # <S>
-		phi = numpy.arctan2(avgs[1], avgs[0]) # azimuthal angle of S
-		yps = numpy.arccos(avgs[2] / S) # polar angle of S
+	S = numpy.sqrt(avgs[0] ** 2 + avgs[1] ** 2 + avgs[2] ** 2) # <S>
+	phi = numpy.arctan2(avgs[1], avgs[0]) # azimuthal angle of S
+	yps = numpy.arccos(avgs[2] / S) # polar angle of S
 
-		sin = numpy.sin
-		cos = numpy.cos
+	sin = numpy.sin
+	cos = numpy.cos
 
-		A = (sin(phi) ** 2 - cos(yps) ** 2 * cos(phi) ** 2) * 0.5 * deltas[0, 0] + \
-			(cos(phi) ** 2 - cos(yps) ** 2 * sin(phi) ** 2) * 0.5 * deltas[1, 1] - \
-			sin(yps) ** 2 * 0.5 * deltas[2, 2] - \
-			0.5 * (1 + cos(yps) ** 2) * sin(2 * phi) * deltas[0, 1] + \
-			0.5 * sin(2 * yps) * cos(phi) * deltas[2, 0] + \
-			0.5 * sin(2 * yps) * sin(phi) * deltas[1, 2]
+	A = (sin(phi) ** 2 - cos(yps) ** 2 * cos(phi) ** 2) * 0.5 * deltas[0, 0] + \
+		(cos(phi) ** 2 - cos(yps) ** 2 * sin(phi) ** 2) * 0.5 * deltas[1, 1] - \
+		sin(yps) ** 2 * 0.5 * deltas[2, 2] - \
+		0.5 * (1 + cos(yps) ** 2) * sin(2 * phi) * deltas[0, 1] + \
+		0.5 * sin(2 * yps) * cos(phi) * deltas[2, 0] + \
+		0.5 * sin(2 * yps) * sin(phi) * deltas[1, 2]
 
-		B = cos(yps) * sin(2 * phi) * (0.5 * deltas[0, 0] - 0.5 * deltas[1, 1]) - \
-			cos(yps) * cos(2 * phi) * deltas[0, 1] - \
-			sin(yps) * sin(phi) * deltas[2, 0] + \
-			sin(yps) * cos(phi) * deltas[1, 2]
+	B = cos(yps) * sin(2 * phi) * (0.5 * deltas[0, 0] - 0.5 * deltas[1, 1]) - \
+		cos(yps) * cos(2 * phi) * deltas[0, 1] - \
+		sin(yps) * sin(phi) * deltas[2, 0] + \
+		sin(yps) * cos(phi) * deltas[1, 2]
 
-		Sperp_squared = \
-			0.5 * (cos(yps) ** 2 * cos(phi) ** 2 + sin(phi) ** 2) * 0.5 * deltas[0, 0] + \
-			0.5 * (cos(yps) ** 2 * sin(phi) ** 2 + cos(phi) ** 2) * 0.5 * deltas[1, 1] + \
-			0.5 * sin(yps) ** 2 * 0.5 * deltas[2, 2] - \
-			0.25 * sin(yps) ** 2 * sin(2 * phi) * deltas[0, 1] - \
-			0.25 * sin(2 * yps) * cos(phi) * deltas[2, 0] - \
-			0.25 * sin(2 * yps) * sin(phi) * deltas[1, 2] - \
-			0.5 * numpy.sqrt(A ** 2 + B ** 2)
+	Sperp_squared = \
+		0.5 * (cos(yps) ** 2 * cos(phi) ** 2 + sin(phi) ** 2) * 0.5 * deltas[0, 0] + \
+		0.5 * (cos(yps) ** 2 * sin(phi) ** 2 + cos(phi) ** 2) * 0.5 * deltas[1, 1] + \
+		0.5 * sin(yps) ** 2 * 0.5 * deltas[2, 2] - \
+		0.25 * sin(yps) ** 2 * sin(2 * phi) * deltas[0, 1] - \
+		0.25 * sin(2 * yps) * cos(phi) * deltas[2, 0] - \
+		0.25 * sin(2 * yps) * sin(phi) * deltas[1, 2] - \
+		0.5 * numpy.sqrt(A ** 2 + B ** 2)
 
-		Na = n1.mean()
-		Nb = n2.mean()
+	Na = n1.mean()
+	Nb = n2.mean()
 
-		return (Na + Nb) * Sperp_squared / (S ** 2)
+	return (Na + Nb) * Sperp_squared / (S ** 2)
@@ -0,0 +1,75 @@
+"""
+Running large Wigner ensembles in several processes.
+"""
+
+import numpy
+import multiprocessing
+
+from .helpers.cpu import CPUEnvironment, getSlabs
+
+
+def _getSeeds(seed, number):
+	"""Returns independent seeds for given number of random streams"""
+	try:
+		from numpy.random import SeedSequence
+	except ImportError:
+		# old numpy; derive seeds from the parent stream
+		rng = numpy.random.RandomState(seed)
+		return [int(x) for x in rng.randint(0, 2 ** 31 - 1, size=number)]
+	else:
+		return [int(s.generate_state(1)[0]) for s in SeedSequence(seed).spawn(number)]
+
+def _runShard(args):
+	setup, ensembles, time, seed, fft_threads, run_kwds = args
+
+	numpy.random.seed(seed)
+	env = CPUEnvironment(fft_threads=fft_threads)
+	evolution, cloud, collectors = setup(env, ensembles)
+	evolution.run(cloud, time, callbacks=collectors, **run_kwds)
+	env.release()
+
+	return collectors
+
+def runSharded(setup, ensembles, time, processes=None, seed=None, fft_threads=None, **run_kwds):
+	"""
+	Splits the ensemble between several worker processes and merges the results.
+	setup: module-level function setup(env, ensembles) returning the tuple
+		(evolution, cloud, collectors); it is called in every worker
+		with the part of the ensemble this worker is responsible for
+	ensembles: total number of trajectories
+	processes: number of workers (by default, the number of cores)
+	seed: seed for the random streams of workers (each worker gets an independent one)
+	fft_threads: number of FFT threads in every worker (by default the cores
+		are divided between workers)
+	run_kwds: passed to evolution.run()
+	Returns the list of collectors (instances of collectors.MergeableCollector)
+	containing the data for the whole ensemble.
+	"""
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	if fft_threads is None:
+		fft_threads = max(1, multiprocessing.cpu_count() / processes)
+
+	slabs = getSlabs(ensembles, processes)
+	seeds = _getSeeds(seed, len(slabs))
+	tasks = [(setup, stop - start, time, s, fft_threads, run_kwds)
+		for (start, stop), s in zip(slabs, seeds)]
+
+	if len(tasks) == 1:
+		results = [_runShard(tasks[0])]
+	else:
+		pool = multiprocessing.Pool(len(tasks))
+		try:
+			results = pool.map(_runShard, tasks)
+		finally:
+			pool.close()
+			pool.join()
+
+	# merging in order of slabs, so that per-trajectory data
+	# is ordered in the same way as in a single run
+	collectors = results[0]
+	for shard_collectors in results[1:]:
+		for collector, other in zip(collectors, shard_collectors):
+			collector.merge(other)
+
+	return collectors
@@ -1,14 +1,274 @@
 import math
 import copy
+import numpy
 from .helpers import *
 from .globals import *
 from .constants import PSI_FUNC, WIGNER, COMP_1_minus1, COMP_2_1
 from .evolution import SplitStepEvolution
 
 
+def _getPulseMatrices(thetas, phis):
+	"""
+	Returns matrices of the ideal pulse with given rotation angle and phase
+	(of shape (2, 2) for scalar arguments, or (len(thetas), 2, 2) for arrays).
+	"""
+	half_thetas = numpy.asarray(thetas, numpy.float64) / 2.0
+	phis = numpy.asarray(phis, numpy.float64)
+
+	matrices = numpy.empty(half_thetas.shape + (2, 2), numpy.complex128)
+	matrices[..., 0, 0] = numpy.cos(half_thetas)
+	matrices[..., 0, 1] = -1j * numpy.exp(-1j * phis) * numpy.sin(half_thetas)
+	matrices[..., 1, 0] = -1j * numpy.exp(1j * phis) * numpy.sin(half_thetas)
+	matrices[..., 1, 1] = numpy.cos(half_thetas)
+	return matrices
+
+def _multiplyComponents(env, workspaces, cell_shape, a_data, b_data, matrices):
+	"""
+	Applies 2x2 matrices to the pair of components in place on CPU.
+	matrices has shape (2, 2) (same matrix for all ensembles)
+	or (ensembles, 2, 2); in the latter case the elements are broadcasted
+	over the ensemble axis.
+	Temporary buffers are taken from workspaces (one for every ensemble slab),
+	so that nothing is allocated for repeated pulses.
+	"""
+	a = ensembleView(a_data, cell_shape)
+	b = ensembleView(b_data, cell_shape)
+
+	matrices = matrices.astype(a.dtype)
+	per_ensemble = matrices.ndim == 3
+	if per_ensemble:
+		matrices = matrices.reshape((a.shape[0],) + (1,) * len(cell_shape) + (2, 2))
+
+	def process(slab, start, stop):
+		ws = workspaces[slab]
+		a_slab = a[start:stop]
+		b_slab = b[start:stop]
+		m = matrices[start:stop] if per_ensemble else matrices
+
+		a_term = ws.get('rotate_a', a_slab.shape, a_slab.dtype)
+		b_term = ws.get('rotate_b', b_slab.shape, b_slab.dtype)
+
+		# a' = m00 * a + m01 * b, b' = m10 * a + m11 * b
+		numpy.multiply(b_slab, m[..., 0, 1], out=a_term)
+		numpy.multiply(a_slab, m[..., 1, 0], out=b_term)
+		a_slab *= m[..., 0, 0]
+		a_slab += a_term
+		b_slab *= m[..., 1, 1]
+		b_slab += b_term
+
+	env.runSlabs(process, a.shape[0])
+
+def _getNoisyAngles(ensembles, theta, phi, theta_noise, phi_noise):
+	"""Returns rotation angles and phases with given noise for every trajectory"""
+	if phi_noise > 0.0:
+		phis = numpy.random.normal(size=(ensembles,), scale=phi_noise, loc=phi)
+	else:
+		phis = numpy.ones(ensembles) * phi
+
+	if theta_noise > 0.0:
+		thetas = numpy.random.normal(size=(ensembles,), scale=theta_noise, loc=theta)
+	else:
+		thetas = numpy.ones(ensembles) * theta
+
+	return thetas, phis
+
+
+class PulsePropagator:
+	"""
+	Propagates the two-component cloud during a non-ideal (finite duration) pulse on CPU.
+	Uses second order split-step method: kinetic term is applied in k-space,
+	potential and nonlinear terms in x-space, with the analytical exponent
+	of the Rabi coupling (the matrix of the ideal pulse) between their halves.
+	If dt is not given, the number of steps is chosen from the error estimate
+	obtained by step doubling at the beginning of the pulse.
+	"""
+
+	def __init__(self, env, constants, detuning, dt=None, eps=1e-6, tiny=1e-3):
+		self._env = env
+		self._constants = constants
+		self._detuning = detuning
+		self._rabi_freq = constants.w_rabi
+		self._dt = dt
+		self._eps = eps
+		self._tiny = tiny
+
+		self._plan = createFFTPlan(env, constants.shape, constants.complex.dtype)
+		self._potentials = getPotentials(env, constants)
+		self._kvectors = getKVectors(env, constants)
+
+		# temporary buffers, reused between pulses (one set for every ensemble slab)
+		self._workspaces = [Workspace(env) for i in xrange(getattr(env, 'threads', 1))]
+		self._workspace = Workspace(env)
+
+		# k-space propagation coefficients, cached by time step
+		self._kcoeffs = {}
+
+	def _getKCoeff(self, dt):
+		"""Returns coefficients of k-space propagation for dt / 2"""
+		if dt not in self._kcoeffs:
+			if len(self._kcoeffs) >= 16:
+				self._kcoeffs.clear()
+			kcoeff = numpy.exp(self._kvectors * (-1j * dt / 2))
+			self._kcoeffs[dt] = kcoeff.astype(self._constants.complex.dtype)
+		return self._kcoeffs[dt]
+
+	def _xpropagateHalf(self, ws, a, b, comp1, comp2, dt):
+		"""Propagates potential and nonlinear terms for dt / 2"""
+		shape = a.shape
+		sdtype = self._constants.scalar.dtype
+		cdtype = a.dtype
+
+		n_a = ws.get('n_a', shape, sdtype)
+		n_b = ws.get('n_b', shape, sdtype)
+		temp = ws.get('temp', shape, sdtype)
+		N = ws.get('N', shape, cdtype)
+
+		g_by_hbar = self._constants.g_by_hbar
+		g11_by_hbar = g_by_hbar[(comp1, comp1)]
+		g12_by_hbar = g_by_hbar[(comp1, comp2)]
+		g22_by_hbar = g_by_hbar[(comp2, comp2)]
+
+		l111 = self._constants.l111
+		l12 = self._constants.l12
+		l22 = self._constants.l22
+
+		numpy.abs(a, out=n_a)
+		numpy.square(n_a, out=n_a)
+		numpy.abs(b, out=n_b)
+		numpy.square(n_b, out=n_b)
+
+		N_re = N.real
+		N_im = N.imag
+
+		# N = n_a ** 2 * (-l111 / 2) + n_b * (-l12 / 2) -
+		#	1j * (V + n_a * g11_by_hbar + n_b * g12_by_hbar)
+		numpy.multiply(n_a, n_a, out=N_re)
+		N_re *= -l111 / 2
+		numpy.multiply(n_b, -l12 / 2, out=temp)
+		N_re += temp
+		numpy.multiply(n_a, -g11_by_hbar, out=N_im)
+		numpy.multiply(n_b, -g12_by_hbar, out=temp)
+		N_im += temp
+		ensembleView(N_im, self._potentials.shape)[...] -= self._potentials
+		N *= dt / 2
+		numpy.exp(N, out=N)
+		a *= N
+
+		# N = n_b * (-l22 / 2) + n_a * (-l12 / 2) -
+		#	1j * (V + n_b * g22_by_hbar + n_a * g12_by_hbar)
+		numpy.multiply(n_b, -l22 / 2, out=N_re)
+		numpy.multiply(n_a, -l12 / 2, out=temp)
+		N_re += temp
+		numpy.multiply(n_b, -g22_by_hbar, out=N_im)
+		numpy.multiply(n_a, -g12_by_hbar, out=temp)
+		N_im += temp
+		ensembleView(N_im, self._potentials.shape)[...] -= self._potentials
+		N *= dt / 2
+		numpy.exp(N, out=N)
+		b *= N
+
+	def _rabiPropagate(self, ws, a, b, dt, t, phi):
+		"""Propagates Rabi coupling term for dt using its exact exponent at time t"""
+		m = _getPulseMatrices(self._rabi_freq * dt, self._detuning * t + phi).astype(a.dtype)
+
+		a_term = ws.get('a_term', a.shape, a.dtype)
+		b_term = ws.get('b_term', b.shape, b.dtype)
+		numpy.multiply(b, m[0, 1], out=a_term)
+		numpy.multiply(a, m[1, 0], out=b_term)
+		a *= m[0, 0]
+		a += a_term
+		b *= m[1, 1]
+		b += b_term
+
+	def _propagate(self, a_data, b_data, comp1, comp2, dt, steps, phi):
+		"""Makes given number of steps; data is in x-space before and after the call"""
+		cell_shape = self._kvectors.shape
+		a = ensembleView(a_data, cell_shape)
+		b = ensembleView(b_data, cell_shape)
+
+		# the coefficient cache is not thread-safe, so it is only used from this thread
+		kcoeff_half = self._getKCoeff(dt)
+		kcoeff_full = self._getKCoeff(2 * dt)
+
+		def process(slab, start, stop):
+			ws = self._workspaces[slab]
+			a_slab = a[start:stop]
+			b_slab = b[start:stop]
+			batch = stop - start
+
+			# consecutive half-steps in k-space are joined
+			self._plan.execute(a_slab, batch=batch)
+			self._plan.execute(b_slab, batch=batch)
+			for i in xrange(steps):
+				kcoeff = kcoeff_half if i == 0 else kcoeff_full
+				a_slab *= kcoeff
+				b_slab *= kcoeff
+				self._plan.execute(a_slab, batch=batch, inverse=True)
+				self._plan.execute(b_slab, batch=batch, inverse=True)
+
+				self._xpropagateHalf(ws, a_slab, b_slab, comp1, comp2, dt)
+				self._rabiPropagate(ws, a_slab, b_slab, dt, (i + 0.5) * dt, phi)
+				self._xpropagateHalf(ws, a_slab, b_slab, comp1, comp2, dt)
+
+				self._plan.execute(a_slab, batch=batch)
+				self._plan.execute(b_slab, batch=batch)
+
+			a_slab *= kcoeff_half
+			b_slab *= kcoeff_half
+			self._plan.execute(a_slab, batch=batch, inverse=True)
+			self._plan.execute(b_slab, batch=batch, inverse=True)
+
+		self._env.runSlabs(process, a.shape[0])
+
+	def _getSteps(self, cloud, t_pulse, phi):
+		"""Chooses the number of steps, comparing one trial step with two halves of it"""
+		if self._dt is not None:
+			return max(1, int(math.ceil(t_pulse / self._dt - 1e-10)))
+
+		order = 2
+		safety = 0.9
+		ws = self._workspace
+		a = cloud.a.data
+		b = cloud.b.data
+
+		a_full = ws.get('a_full', a.shape, a.dtype)
+		b_full = ws.get('b_full', b.shape, b.dtype)
+		a_half = ws.get('a_half', a.shape, a.dtype)
+		b_half = ws.get('b_half', b.shape, b.dtype)
+		a_full[...] = a
+		b_full[...] = b
+		a_half[...] = a
+		b_half[...] = b
+
+		dt = t_pulse / 8
+		self._propagate(a_full, b_full, cloud.a.comp, cloud.b.comp, dt, 1, phi)
+		self._propagate(a_half, b_half, cloud.a.comp, cloud.b.comp, dt / 2, 2, phi)
+
+		yscal = max(numpy.abs(a_half).max(), numpy.abs(b_half).max()) + self._tiny
+		a_full -= a_half
+		b_full -= b_half
+		errmax = max(numpy.abs(a_full).max(), numpy.abs(b_full).max()) / yscal / self._eps
+
+		if errmax > 0:
+			dt = safety * dt * errmax ** (-1.0 / (order + 1))
+		else:
+			dt = t_pulse
+
+		return max(1, int(math.ceil(t_pulse / dt)))
+
+	def run(self, cloud, t_pulse, phi):
+		"""Propagates the cloud (in x-space) for the duration of the pulse"""
+		if t_pulse <= 0:
+			return
+
+		steps = self._getSteps(cloud, t_pulse, phi)
+		self._propagate(cloud.a.data, cloud.b.data, cloud.a.comp, cloud.b.comp,
+			t_pulse / steps, steps, phi)
+
+
 class Pulse(PairedCalculation):
 
-	def __init__(self, env, constants, detuning=None, starting_phase=0, dt=None):
+	def __init__(self, env, constants, detuning=None, starting_phase=0, dt=None, eps=1e-6):
 		PairedCalculation.__init__(self, env)
 		self._env = env
 		self._constants = constants
@@ -25,11 +285,17 @@ class Pulse(PairedCalculation):
 		self._potentials = getPotentials(env, constants)
 		self._kvectors = getKVectors(env, constants)
 
-		c = copy.deepcopy(constants)
-		c.dt_evo = c.t_rabi / 1e3 if dt is None else dt
-		self._evolution = SplitStepEvolution(env, c,
-			rabi_freq=c.w_rabi / 2.0 / math.pi,
-			detuning=self._detuning / 2.0 / math.pi)
+		# temporary buffers for CPU rotations (one set for every ensemble slab)
+		self._workspaces = [Workspace(env) for i in xrange(getattr(env, 'threads', 1))]
+
+		if env.gpu:
+			c = copy.deepcopy(constants)
+			c.dt_evo = c.t_rabi / 1e3 if dt is None else dt
+			self._evolution = SplitStepEvolution(env, c,
+				rabi_freq=c.w_rabi / 2.0 / math.pi,
+				detuning=self._detuning / 2.0 / math.pi)
+		else:
+			self._propagator = PulsePropagator(env, constants, self._detuning, dt=dt, eps=eps)
 
 		self._prepare()
 
@@ -96,46 +362,40 @@ class Pulse(PairedCalculation):
 				a[index] = complex_mul_scalar(a0, cos_half_theta) + complex_mul(b0, k2);
 				b[index] = complex_mul_scalar(b0, cos_half_theta) + complex_mul(a0, k3);
 			}
+
+			EXPORTED_FUNC void applyMatrices(GLOBAL_MEM COMPLEX *a,
+				GLOBAL_MEM COMPLEX *b, GLOBAL_MEM COMPLEX *matrices)
+			{
+				DEFINE_INDEXES;
+
+				COMPLEX a0 = a[index];
+				COMPLEX b0 = b[index];
+
+				int trajectory = index / ${c.cells};
+				COMPLEX m00 = matrices[trajectory * 4];
+				COMPLEX m01 = matrices[trajectory * 4 + 1];
+				COMPLEX m10 = matrices[trajectory * 4 + 2];
+				COMPLEX m11 = matrices[trajectory * 4 + 3];
+
+				a[index] = complex_mul(a0, m00) + complex_mul(b0, m01);
+				b[index] = complex_mul(a0, m10) + complex_mul(b0, m11);
+			}
 		"""
 
 		self._program = self._env.compileProgram(kernels, self._constants,
 			detuning=self._detuning, COMP_1_minus1=COMP_1_minus1, COMP_2_1=COMP_2_1)
 		self._calculateMatrix = self._program.calculateMatrix
 		self._calculateNoiseMatrixFunc = self._program.calculateNoiseMatrix
+		self._applyMatricesFunc = self._program.applyMatrices
 
 	def _cpu__applyMatrix(self, cloud, theta, phi):
-		a = cloud.a.data
-		b = cloud.b.data
-
-		a0 = a.copy()
-		b0 = b.copy()
-
-		half_theta = theta / 2.0
-		k1 = self._constants.scalar.cast(math.cos(half_theta))
-		k2 = self._constants.complex.cast(-1j * numpy.exp(-1j * phi) * math.sin(half_theta))
-		k3 = self._constants.complex.cast(-1j * numpy.exp(1j * phi) * math.sin(half_theta))
-
-		if self._constants.dim == 1:
-			a[:] = a0 * k1 + b0 * k2
-			b[:] = a0 * k3 + b0 * k1
-		else:
-			a[:,:,:] = a0 * k1 + b0 * k2
-			b[:,:,:] = a0 * k3 + b0 * k1
+		self._applyMatrices(cloud, _getPulseMatrices(theta, phi))
 
 	def _applyNoiseMatrix(self, cloud, theta, phi, theta_noise, phi_noise):
 
-		ens = self._constants.ensembles
 		dtype = self._constants.scalar.dtype
-
-		if phi_noise > 0.0:
-			phis = numpy.random.normal(size=(ens,), scale=phi_noise, loc=phi)
-		else:
-			phis = numpy.ones(ens) * phi
-
-		if theta_noise > 0.0:
-			thetas = numpy.random.normal(size=(ens,), scale=theta_noise, loc=theta)
-		else:
-			thetas = numpy.ones(ens) * theta
+		thetas, phis = _getNoisyAngles(self._constants.ensembles,
+			theta, phi, theta_noise, phi_noise)
 
 		d_phis = self._env.toDevice(phis.astype(dtype))
 		d_thetas = self._env.toDevice(thetas.astype(dtype))
@@ -146,32 +406,33 @@ class Pulse(PairedCalculation):
 		return self._calculateNoiseMatrixFunc(a_data.size, a_data, b_data, thetas, phis)
 
 	def _cpu__calculateNoiseMatrix(self, a, b, thetas, phis):
+		_multiplyComponents(self._env, self._workspaces, self._kvectors.shape,
+			a, b, _getPulseMatrices(thetas, phis))
 
-		ens = self._constants.ensembles
-
-		a0 = a.copy()
-		b0 = b.copy()
-
-		half_thetas = thetas / 2.0
-		k1 = self._constants.scalar.cast(numpy.cos(half_thetas))
-		k2 = self._constants.complex.cast(-1j * numpy.exp(-1j * phis) * numpy.sin(half_thetas))
-		k3 = self._constants.complex.cast(-1j * numpy.exp(1j * phis) * numpy.sin(half_thetas))
-
-		a_view = a.ravel()
-		b_view = b.ravel()
-		a0_view = a0.ravel()
-		b0_view = b0.ravel()
-		step = self._constants.cells
+	def _cpu__applyMatrices(self, cloud, matrices):
+		_multiplyComponents(self._env, self._workspaces, self._kvectors.shape,
+			cloud.a.data, cloud.b.data, matrices)
 
-		for e in xrange(ens):
-			start = e * step
-			stop = (e + 1) * step
+	def _gpu__applyMatrices(self, cloud, matrices):
+		if matrices.ndim == 2:
+			matrices = numpy.tile(matrices, (self._constants.ensembles, 1, 1))
+		d_matrices = self._env.toDevice(matrices.astype(self._constants.complex.dtype))
+		self._applyMatricesFunc(cloud.a.size, cloud.a.data, cloud.b.data, d_matrices)
 
-			a0_part = a0_view[start:stop]
-			b0_part = b0_view[start:stop]
+	def getMatrices(self, time, theta, theta_noise=0.0, phi_noise=0.0):
+		"""
+		Returns the matrix of the ideal pulse applied at given time
+		(one matrix for every trajectory, if there is noise), and the duration of the pulse.
+		"""
+		phi = time * self._detuning + self._starting_phase
+		t_pulse = (theta / math.pi / 2.0) * self._constants.t_rabi
 
-			a_view[start:stop] = a0_part * k1[e] + b0_part * k2[e]
-			b_view[start:stop] = a0_part * k3[e] + b0_part * k1[e]
+		if phi_noise > 0 or theta_noise > 0:
+			thetas, phis = _getNoisyAngles(self._constants.ensembles,
+				theta, phi, theta_noise, phi_noise)
+			return _getPulseMatrices(thetas, phis), t_pulse
+		else:
+			return _getPulseMatrices(theta, phi), t_pulse
 
 	def _gpu__applyMatrix(self, cloud, theta, phi):
 		self._calculateMatrix(cloud.a.size, cloud.a.data, cloud.b.data,
@@ -190,14 +451,20 @@ class Pulse(PairedCalculation):
 		elif matrix:
 			self._applyMatrix(cloud, theta, phi)
 		else:
-			self._evolution.run(cloud, t_pulse, starting_phase=phi)
+			self._applyReal(cloud, t_pulse, phi)
 
 		cloud.time += t_pulse
 
+	def _cpu__applyReal(self, cloud, t_pulse, phi):
+		self._propagator.run(cloud, t_pulse, phi)
+
+	def _gpu__applyReal(self, cloud, t_pulse, phi):
+		self._evolution.run(cloud, t_pulse, starting_phase=phi)
+
 
 class RK4Pulse(PairedCalculation):
 
-	def __init__(self, env, constants, detuning=None, starting_phase=0):
+	def __init__(self, env, constants, detuning=None, starting_phase=0, dt=None, eps=1e-6):
 		PairedCalculation.__init__(self, env)
 		self._env = env
 		self._constants = constants
@@ -214,6 +481,15 @@ class RK4Pulse(PairedCalculation):
 		self._potentials = getPotentials(env, constants)
 		self._kvectors = getKVectors(env, constants)
 
+		# temporary buffers for CPU rotations (one set for every ensemble slab)
+		self._workspaces = [Workspace(env) for i in xrange(getattr(env, 'threads', 1))]
+
+		# buffers for GPU propagation of non-ideal pulses, reused between pulses
+		self._workspace = Workspace(env)
+
+		if not env.gpu:
+			self._propagator = PulsePropagator(env, constants, self._detuning, dt=dt, eps=eps)
+
 		self._prepare()
 
 	def _cpu__prepare(self):
@@ -280,6 +556,24 @@ class RK4Pulse(PairedCalculation):
 				b[index] = complex_mul_scalar(b0, cos_half_theta) + complex_mul(a0, k3);
 			}
 
+			EXPORTED_FUNC void applyMatrices(GLOBAL_MEM COMPLEX *a,
+				GLOBAL_MEM COMPLEX *b, GLOBAL_MEM COMPLEX *matrices)
+			{
+				DEFINE_INDEXES;
+
+				COMPLEX a0 = a[index];
+				COMPLEX b0 = b[index];
+
+				int trajectory = index / ${c.cells};
+				COMPLEX m00 = matrices[trajectory * 4];
+				COMPLEX m01 = matrices[trajectory * 4 + 1];
+				COMPLEX m10 = matrices[trajectory * 4 + 2];
+				COMPLEX m11 = matrices[trajectory * 4 + 3];
+
+				a[index] = complex_mul(a0, m00) + complex_mul(b0, m01);
+				b[index] = complex_mul(a0, m10) + complex_mul(b0, m11);
+			}
+
 			INTERNAL_FUNC void propagationFunc(COMPLEX *a_res, COMPLEX *b_res,
 				COMPLEX a, COMPLEX b,
 				COMPLEX ka, COMPLEX kb,
@@ -373,41 +667,17 @@ class RK4Pulse(PairedCalculation):
 			detuning=self._detuning, COMP_1_minus1=COMP_1_minus1, COMP_2_1=COMP_2_1)
 		self._calculateMatrix = self._program.calculateMatrix
 		self._calculateNoiseMatrixFunc = self._program.calculateNoiseMatrix
+		self._applyMatricesFunc = self._program.applyMatrices
 		self._calculateRK = self._program.calculateRK
 
 	def _cpu__applyMatrix(self, cloud, theta, phi):
-		a = cloud.a.data
-		b = cloud.b.data
-
-		a0 = a.copy()
-		b0 = b.copy()
-
-		half_theta = theta / 2.0
-		k1 = self._constants.scalar.cast(math.cos(half_theta))
-		k2 = self._constants.complex.cast(-1j * numpy.exp(-1j * phi) * math.sin(half_theta))
-		k3 = self._constants.complex.cast(-1j * numpy.exp(1j * phi) * math.sin(half_theta))
-
-		if self._constants.dim == 1:
-			a[:] = a0 * k1 + b0 * k2
-			b[:] = a0 * k3 + b0 * k1
-		else:
-			a[:,:,:] = a0 * k1 + b0 * k2
-			b[:,:,:] = a0 * k3 + b0 * k1
+		self._applyMatrices(cloud, _getPulseMatrices(theta, phi))
 
 	def _applyNoiseMatrix(self, cloud, theta, phi, theta_noise, phi_noise):
 
-		ens = self._constants.ensembles
 		dtype = self._constants.scalar.dtype
-
-		if phi_noise > 0.0:
-			phis = numpy.random.normal(size=(ens,), scale=phi_noise, loc=phi)
-		else:
-			phis = numpy.ones(ens) * phi
-
-		if theta_noise > 0.0:
-			thetas = numpy.random.normal(size=(ens,), scale=theta_noise, loc=theta)
-		else:
-			thetas = numpy.ones(ens) * theta
+		thetas, phis = _getNoisyAngles(self._constants.ensembles,
+			theta, phi, theta_noise, phi_noise)
 
 		d_phis = self._env.toDevice(phis.astype(dtype))
 		d_thetas = self._env.toDevice(thetas.astype(dtype))
@@ -418,60 +688,43 @@ class RK4Pulse(PairedCalculation):
 		return self._calculateNoiseMatrixFunc(a_data.size, a_data, b_data, thetas, phis)
 
 	def _cpu__calculateNoiseMatrix(self, a, b, thetas, phis):
+		_multiplyComponents(self._env, self._workspaces, self._kvectors.shape,
+			a, b, _getPulseMatrices(thetas, phis))
 
-		ens = self._constants.ensembles
-
-		a0 = a.copy()
-		b0 = b.copy()
-
-		half_thetas = thetas / 2.0
-		k1 = self._constants.scalar.cast(numpy.cos(half_thetas))
-		k2 = self._constants.complex.cast(-1j * numpy.exp(-1j * phis) * numpy.sin(half_thetas))
-		k3 = self._constants.complex.cast(-1j * numpy.exp(1j * phis) * numpy.sin(half_thetas))
+	def _cpu__applyMatrices(self, cloud, matrices):
+		_multiplyComponents(self._env, self._workspaces, self._kvectors.shape,
+			cloud.a.data, cloud.b.data, matrices)
 
-		a_view = a.ravel()
-		b_view = b.ravel()
-		a0_view = a0.ravel()
-		b0_view = b0.ravel()
-		step = self._constants.cells
+	def _gpu__applyMatrices(self, cloud, matrices):
+		if matrices.ndim == 2:
+			matrices = numpy.tile(matrices, (self._constants.ensembles, 1, 1))
+		d_matrices = self._env.toDevice(matrices.astype(self._constants.complex.dtype))
+		self._applyMatricesFunc(cloud.a.size, cloud.a.data, cloud.b.data, d_matrices)
 
-		for e in xrange(ens):
-			start = e * step
-			stop = (e + 1) * step
-
-			a0_part = a0_view[start:stop]
-			b0_part = b0_view[start:stop]
+	def getMatrices(self, time, theta, theta_noise=0.0, phi_noise=0.0):
+		"""
+		Returns the matrix of the ideal pulse applied at given time
+		(one matrix for every trajectory, if there is noise), and the duration of the pulse.
+		"""
+		phi = time * self._detuning + self._starting_phase
+		t_pulse = (theta / math.pi / 2.0) * self._constants.t_rabi
 
-			a_view[start:stop] = a0_part * k1[e] + b0_part * k2[e]
-			b_view[start:stop] = a0_part * k3[e] + b0_part * k1[e]
+		if phi_noise > 0 or theta_noise > 0:
+			thetas, phis = _getNoisyAngles(self._constants.ensembles,
+				theta, phi, theta_noise, phi_noise)
+			return _getPulseMatrices(thetas, phis), t_pulse
+		else:
+			return _getPulseMatrices(theta, phi), t_pulse
 
 	def _gpu__applyMatrix(self, cloud, theta, phi):
 		self._calculateMatrix(cloud.a.size, cloud.a.data, cloud.b.data,
 			self._constants.scalar.cast(theta),
 			self._constants.scalar.cast(phi))
 
-	def _cpu__calculateRK(self, _, a_data, b_data, a_copy, b_copy, a_kdata, b_kdata,
-			a_res, b_res, t, dt, p, k, phi, stage):
+	def _cpu__applyReal(self, cloud, t_pulse, phi):
+		self._propagator.run(cloud, t_pulse, phi)
 
-		val_coeffs = (0.5, 0.5, 1.0, 0.0)
-		res_coeffs = (1.0 / 6.0, 1.0 / 3.0, 1.0 / 3.0, 1.0 / 6.0)
-
-		if stage == 0:
-			a = a_data.copy()
-			b = b_data.copy()
-		else:
-			a = a_res.copy()
-			b = b_res.copy()
-
-		self._propagationFunc(a, b, a_kdata, b_kdata, a_res, b_res, t, dt, phi)
-
-		a_data += a_res * (dt * res_coeffs[stage])
-		b_data += b_res * (dt * res_coeffs[stage])
-
-		a_res[:,:,:] = a_copy + a_res * (dt * val_coeffs[stage])
-		b_res[:,:,:] = b_copy + b_res * (dt * val_coeffs[stage])
-
-	def _applyReal(self, cloud, t_pulse, phi):
+	def _gpu__applyReal(self, cloud, t_pulse, phi):
 
 		batch = cloud.a.size / self._constants.cells
 		shape = cloud.a.shape
@@ -489,12 +742,13 @@ class RK4Pulse(PairedCalculation):
 		size = cloud.a.size
 		dtype = cloud.a.dtype
 
-		a_copy = self._env.allocate(shape, dtype=dtype)
-		b_copy = self._env.allocate(shape, dtype=dtype)
-		a_kdata = self._env.allocate(shape, dtype=dtype)
-		b_kdata = self._env.allocate(shape, dtype=dtype)
-		a_res = self._env.allocate(shape, dtype=dtype)
-		b_res = self._env.allocate(shape, dtype=dtype)
+		ws = self._workspace
+		a_copy = ws.get('a_copy', shape, dtype)
+		b_copy = ws.get('b_copy', shape, dtype)
+		a_kdata = ws.get('a_kdata', shape, dtype)
+		b_kdata = ws.get('b_kdata', shape, dtype)
+		a_res = ws.get('a_res', shape, dtype)
+		b_res = ws.get('b_res', shape, dtype)
 
 		for i in xrange(steps):
 			t = cast(dt * i)
@@ -522,42 +776,6 @@ class RK4Pulse(PairedCalculation):
 			func(size, cloud.a.data, cloud.b.data, a_copy, b_copy, a_kdata, b_kdata,
 				a_res, b_res, t, dt, p, k, phi, numpy.int32(3))
 
-	def _propagationFunc(self, a_data, b_data, a_kdata, b_kdata, a_res, b_res, t, dt, phi):
-
-		batch = a_data.size / self._constants.cells
-		nvz = self._constants.nvz
-
-		# FIXME: remove hardcoding (g must depend on cloud.a.comp and cloud.b.comp)
-		g_by_hbar = self._constants.g_by_hbar
-		g11_by_hbar = g_by_hbar[(COMP_1_minus1, COMP_1_minus1)]
-		g12_by_hbar = g_by_hbar[(COMP_1_minus1, COMP_2_1)]
-		g22_by_hbar = g_by_hbar[(COMP_2_1, COMP_2_1)]
-
-		l111 = self._constants.l111
-		l12 = self._constants.l12
-		l22 = self._constants.l22
-
-		n_a = numpy.abs(a_data) ** 2
-		n_b = numpy.abs(b_data) ** 2
-
-		for e in xrange(batch):
-			start = e * nvz
-			stop = (e + 1) * nvz
-			a_res[start:stop,:,:] = -1j * (a_kdata[start:stop,:,:] * self._kvectors +
-				a_data[start:stop,:,:] * self._potentials)
-			b_res[start:stop,:,:] = -1j * (b_kdata[start:stop,:,:] * self._kvectors +
-				b_data[start:stop,:,:] * self._potentials)
-
-		a_res += (n_a * n_a * (-l111 / 2) + n_b * (-l12 / 2) -
-			1j * (n_a * g11_by_hbar + n_b * g12_by_hbar)) * a_data - \
-			0.5j * self._constants.w_rabi * \
-				numpy.exp(1j * (- t * self._detuning - phi)) * b_data
-
-		b_res += (n_b * (-l22 / 2) + n_a * (-l12 / 2) -
-			1j * (n_b * g22_by_hbar + n_a * g12_by_hbar)) * b_data - \
-			0.5j * self._constants.w_rabi * \
-				numpy.exp(1j * (t * self._detuning + phi)) * a_data
-
 	def apply(self, cloud, theta, matrix=True, theta_noise=0.0, phi_noise=0.0):
 		phi = cloud.time * self._detuning + self._starting_phase
 
@@ -573,3 +791,69 @@ class RK4Pulse(PairedCalculation):
 			self._applyReal(cloud, t_pulse, phi)
 
 		cloud.time += t_pulse
+
+
+class PulseSequence:
+	"""
+	Sequence of pulses and free evolution segments, applied to a cloud by run().
+	Consecutive ideal (matrix) pulses are composed into a single matrix
+	for every trajectory and applied in one pass.
+	Matrix pulses act on every cell in the same way, so they commute with
+	Fourier transforms and with k-space propagation (which is the same
+	for both components); therefore the cloud stays in the evolution space
+	between the segments, and is transformed only at the beginning and at the end.
+	"""
+
+	def __init__(self, pulse, evolution=None):
+		self._pulse = pulse
+		self._evolution = evolution
+		self._items = []
+
+	def pulse(self, theta, matrix=True, theta_noise=0.0, phi_noise=0.0):
+		"""Adds pulse (see Pulse.apply()); noise is only supported for matrix pulses"""
+		if theta_noise > 0 or phi_noise > 0:
+			assert matrix
+		self._items.append(('pulse', (theta, matrix, theta_noise, phi_noise)))
+
+	def evolve(self, time, callbacks=None, callback_dt=0):
+		"""Adds free evolution segment (see Evolution.run())"""
+		assert self._evolution is not None
+		self._items.append(('evolve', (time, callbacks, callback_dt)))
+
+	def run(self, cloud):
+		in_evolution_space = False
+		matrices = None
+
+		for kind, params in self._items:
+			if kind == 'pulse':
+				theta, matrix, theta_noise, phi_noise = params
+				if matrix:
+					m, t_pulse = self._pulse.getMatrices(cloud.time, theta,
+						theta_noise=theta_noise, phi_noise=phi_noise)
+					matrices = m if matrices is None else numpy.matmul(m, matrices)
+					cloud.time += t_pulse
+					continue
+
+			# non-matrix pulses and evolution segments
+			# need all the preceding matrices to be applied
+			if matrices is not None:
+				self._pulse._applyMatrices(cloud, matrices)
+				matrices = None
+
+			if kind == 'pulse':
+				if in_evolution_space:
+					self._evolution._toCanonicalSpace(cloud)
+					in_evolution_space = False
+				self._pulse.apply(cloud, theta, matrix=False)
+			else:
+				time, callbacks, callback_dt = params
+				if not in_evolution_space:
+					self._evolution._toEvolutionSpace(cloud)
+					in_evolution_space = True
+				self._evolution.run(cloud, time, callbacks=callbacks,
+					callback_dt=callback_dt, in_evolution_space=True)
+
+		if matrices is not None:
+			self._pulse._applyMatrices(cloud, matrices)
+		if in_evolution_space:
+			self._evolution._toCanonicalSpace(cloud)
@@ -20,11 +20,7 @@ class Wavefunction(PairedCalculation):
 		self.in_mspace = False
 
 		if prepare:
-			if isinstance(grid, UniformGrid):
-				self._plan = createFFTPlan(env, constants, grid)
-			elif isinstance(grid, HarmonicGrid):
-				self._plan = createFHTPlan(env, constants, grid, 1)
-
+			self._plan = getPlan(env, self._constants, self._grid)
 			self._random = createRandom(env, constants.double)
 			self._prepare()
 			self._initializeMemory()
@@ -82,10 +78,12 @@ class Wavefunction(PairedCalculation):
 		self._kernel_fillEnsembles = self._program.fillEnsembles
 		self._kernel_addVacuumParticles = self._program.addVacuumParticles
 
-	def _cpu__kernel_addVacuumParticles(self, _, modespace_data, randoms, mask):
-		tile = (self.shape[0],) + (1,) * (self._grid.dim - 1)
-		modespace_data += randoms # add vacuum particles
-		modespace_data *= numpy.tile(mask, tile) # remove high-energy components
+	def _cpu__kernel_addVacuumParticles(self, _, modespace_data, randoms, modes):
+		# randoms are given only for the modes kept by the projector
+		data = modespace_data.reshape(self.shape[0], -1)
+		kept = data[:, modes] + randoms # add vacuum particles
+		data.fill(0) # remove high-energy components
+		data[:, modes] = kept
 
 	def _cpu__kernel_fillWithZeros(self, _, data):
 		data.flat[:] = numpy.zeros_like(data).flat
@@ -146,17 +144,28 @@ class Wavefunction(PairedCalculation):
 		self.data = self._data
 		self.in_mspace = False
 
-	def _addVacuumParticles(self, randoms, mask):
+	def _cpu__getVacuumNoise(self):
+		# noise is drawn only in the modes kept by the projector
+		modes = getProjectorModes(None, self._constants, self._grid)
+		randoms = numpy.empty((self.shape[0], modes.size), self._constants.complex.dtype)
+		self._random.fill_normal(randoms, scale=numpy.sqrt(0.5), ensembles=(0, self.shape[0]))
+		return randoms, modes
 
-		dtype = self.data.dtype
-		ensembles = self.shape[0]
+	def _gpu__getVacuumNoise(self):
+		randoms = self._random.random_normal(self.shape, scale=numpy.sqrt(0.5))
+		projector_mask = getProjectorMask(self._env, self._constants, self._grid)
+		return randoms, projector_mask
+
+	def _addVacuumParticles(self):
 
 		was_in_xspace = not self.in_mspace
 
 		if was_in_xspace:
 			self.toMSpace()
 
-		self._kernel_addVacuumParticles(self.size, self.data, randoms, mask)
+		# Scaling assumes that in modespace wavefunction normalized on atom number
+		randoms, projector = self._getVacuumNoise()
+		self._kernel_addVacuumParticles(self.size, self.data, randoms, projector)
 
 		if was_in_xspace:
 			self.toXSpace()
@@ -170,12 +179,7 @@ class Wavefunction(PairedCalculation):
 		assert self.type == CLASSICAL
 
 		self.createEnsembles(ensembles)
-
-		# FIXME: in fact, we only need randoms in cells where projector mask == 1
-		# Scaling assumes that in modespace wavefunction normalized on atom number
-		randoms = self._random.random_normal(self.shape, scale=numpy.sqrt(0.5))
-		projector_mask = getProjectorMask(self._env, self._constants, self._grid)
-		self._addVacuumParticles(randoms, projector_mask)
+		self._addVacuumParticles()
 
 		self.type = WIGNER
 
@@ -202,9 +206,11 @@ class TwoComponentCloud:
 		self.time = 0.0
 
 		self.psi0 = psi0.copy(prepare=prepare) \
-			if psi0 is not None else Wavefunction(env, constants, grid, type=self.type, comp=0)
+			if psi0 is not None else Wavefunction(env, constants, grid, comp=0, prepare=prepare)
 		self.psi1 = psi1.copy(prepare=prepare) \
-			if psi1 is not None else Wavefunction(env, constants, grid, type=self.type, comp=1)
+			if psi1 is not None else Wavefunction(env, constants, grid, comp=1, prepare=prepare)
+		self.psi0.type = self.type
+		self.psi1.type = self.type
 
 	def toWigner(self, ensembles):
 		self.psi0.toWigner(ensembles)